@@ -0,0 +1,61 @@
+import argparse
+import logging
+import localDnsServer
+import rootDnsServer
+import tldDnsServer
+import authoritativeDnsServer
+from helpers import ROOT_SERVER_PORT, TLD_SERVER_PORT, AUTHORITATIVE_SERVER_PORT
+from helpers import ROOT_METRICS_PORT, TLD_METRICS_PORT, AUTHORITATIVE_METRICS_PORT
+from serverLog import configureLogging
+from lookupServer import LookupServerProtocol
+
+'''
+The allInOneServer.py file runs the local, root, TLD and authoritative DNS servers in a single process.
+The local DNS server calls the lookups of the other three directly (see askInProcess in localDnsServer.py) instead of sending them datagrams, so a resolution costs no socket I/O, encoding or decoding between the servers.
+This suits embedded and test deployments, and gives a baseline to measure what the transport between the four processes costs.
+'''
+
+log = logging.getLogger("allInOneServer")
+HOSTED_SERVERS = (
+    # Module of the server, its lookup, the port the local DNS server knows it by, its metrics port
+    (rootDnsServer, rootDnsServer.findOutTld, ROOT_SERVER_PORT, ROOT_METRICS_PORT),
+    (tldDnsServer, tldDnsServer.findOutAuthoritative, TLD_SERVER_PORT, TLD_METRICS_PORT),
+    (authoritativeDnsServer, authoritativeDnsServer.findOutResultantIp, AUTHORITATIVE_SERVER_PORT,
+     AUTHORITATIVE_METRICS_PORT),
+)
+
+
+def hostServers(maxInFlight, serveMetrics=True):
+    '''
+    Purpose: Registers the root, TLD and authoritative servers with the local DNS server of this process.
+Parameters:
+maxInFlight: How many lookups of each server run at the same time (see LookupServerProtocol).
+serveMetrics: Whether the metrics of each server are served on its usual port, next to the ones of the local DNS server.
+Actions:
+The servers do not bind their ports, the local DNS server asks them without any socket.
+    '''
+    for server, lookup, port, metricsPort in HOSTED_SERVERS:
+        localDnsServer.inProcessServers[port] = LookupServerProtocol(
+            lookup, server.log, server.metrics, server.serverStats, server.LOOKUP_STAGE, maxInFlight)
+        if serveMetrics:
+            localDnsServer.inProcessMetrics.append((server.metrics, metricsPort))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local, root, TLD and authoritative DNS servers in one process")
+    localDnsServer.addLocalServerArguments(parser)
+    parser.add_argument("--zone", action="append", default=[], metavar="PATH",
+                        help="zone file, or directory of .zone and .db files, the authoritative server answers from (can be repeated)")
+    parser.add_argument("--delegations", action="append", default=[], metavar="FILE",
+                        help="file of NS and glue records in the root hints format, loaded by the root and TLD servers (can be repeated)")
+    arguments = parser.parse_args()
+    configureLogging(arguments.log_level, arguments.trace_rate)
+    if arguments.zone:
+        authoritativeDnsServer.zoneStore.paths = arguments.zone
+        log.info("Loaded %d zones", authoritativeDnsServer.zoneStore.load())
+    for fileName in arguments.delegations:
+        for server in (rootDnsServer, tldDnsServer):
+            server.delegationTable.load(fileName)
+        log.info("Loaded the delegations of %s", fileName)
+    hostServers(arguments.max_in_flight, arguments.metrics_port != 0)
+    localDnsServer.localDnsServerFromArguments(arguments)
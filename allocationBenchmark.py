@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import logging
+import socket
+import tracemalloc
+import dns.message
+import localDnsServer
+from helpers import BUFFER_SIZE
+from helpers import ServerRequest, ServerResponse, encodeRequest, nextQueryId
+from helpers import ADDRESS_TYPE_A
+from helpers import openDatagramEndpoint
+from metrics import serverMetrics
+from lookupServer import LookupServerProtocol
+from localDnsServer import LocalDnsServerProtocol
+
+'''
+The allocationBenchmark.py file measures with tracemalloc how much memory the receive and dispatch path of a server allocates for every request.
+It serves on a free port of this process either a LookupServerProtocol (the path of the root, TLD and authoritative servers), with a lookup that answers at once, or a LocalDnsServerProtocol answering DNS wire-format or text queries for a name that is in its cache, so only the serving path is measured.
+The same requests are served once by the DatagramEndpoint of helpers.py and once by the transport of loop.create_datagram_endpoint(), which the servers used before.
+For every request it reports the peak of the memory allocated from sending the request to reading its response (the short lived allocations, like the receive buffer), and the memory still allocated afterwards.
+'''
+
+TRANSPORTS = ("endpoint", "asyncio")
+SERVERS = ("lookup", "local-dns", "local-text")  # The LookupServerProtocol, and the LocalDnsServerProtocol asked over both of its protocols
+DEFAULT_REQUESTS = 5000
+WARMUP_REQUESTS = 200  # Not measured, they fill the caches of the interpreter, the event loop and the metrics
+BENCHMARK_NAME = "host1.bench.test"
+BENCHMARK_ADDRESS = "10.0.0.1"
+BENCHMARK_TTL = 3600
+
+log = logging.getLogger("allocationBenchmark")
+
+
+async def answerAtOnce(userInput, nameServer, returnMessage=None, addressType=ADDRESS_TYPE_A):
+    return ServerResponse(addresses=[BENCHMARK_ADDRESS], messages=returnMessage)
+
+
+def benchmarkServer(serverName):
+    '''
+    Purpose: Returns the function making the protocol of serverName, and the request it is sent.
+    '''
+    if serverName == "lookup":
+        serverStats = {"queries": 0, "failures": 0, "malformed": 0, "shed": 0}
+        return (lambda: LookupServerProtocol(answerAtOnce, log, serverMetrics(serverStats), serverStats,
+                                             (("stage", "benchmark"),)),
+                encodeRequest(ServerRequest(nextQueryId(), "127.0.0.1", BENCHMARK_NAME, False)))
+    # The name is answered from the cache, none of the other servers is asked
+    localDnsServer.storeInCache(BENCHMARK_NAME, BENCHMARK_ADDRESS, BENCHMARK_TTL)
+    if serverName == "local-dns":
+        requestMessage = dns.message.make_query(BENCHMARK_NAME, "A", use_edns=0).to_wire()
+    else:
+        requestMessage = BENCHMARK_NAME.encode()
+    return lambda: LocalDnsServerProtocol(localDnsServer.DEFAULT_MAX_IN_FLIGHT), requestMessage
+
+
+async def serve(serverName, transportName, requestCount):
+    '''
+    Purpose: Sends requestCount requests, one at a time, to the protocol of serverName (see SERVERS) served with transportName.
+Actions:
+Returns the average peak and retained bytes per request.
+    '''
+    loop = asyncio.get_running_loop()
+    makeProtocol, requestMessage = benchmarkServer(serverName)
+    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    serverSocket.bind(("127.0.0.1", 0))
+    if transportName == "endpoint":
+        transport, _ = openDatagramEndpoint(makeProtocol, serverSocket)
+    else:
+        transport, _ = await loop.create_datagram_endpoint(makeProtocol, sock=serverSocket)
+    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    clientSocket.setblocking(False)
+    clientSocket.connect(serverSocket.getsockname())
+    responseBuffer = bytearray(BUFFER_SIZE)
+    peakBytes = 0
+    retainedBytes = 0
+    try:
+        for request in range(WARMUP_REQUESTS + requestCount):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            await loop.sock_sendall(clientSocket, requestMessage)
+            await loop.sock_recv_into(clientSocket, responseBuffer)
+            current, peak = tracemalloc.get_traced_memory()
+            if request >= WARMUP_REQUESTS:
+                peakBytes += peak - before
+                retainedBytes += current - before
+    finally:
+        transport.close()
+        clientSocket.close()
+    return peakBytes / requestCount, retainedBytes / requestCount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory allocated by the servers for every request")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="number of requests measured")
+    parser.add_argument("--transport", choices=TRANSPORTS, action="append",
+                        help="transport to measure (can be repeated), both by default")
+    parser.add_argument("--server", choices=SERVERS, action="append",
+                        help="server path to measure (can be repeated), all of them by default")
+    arguments = parser.parse_args()
+    tracemalloc.start()
+    for serverName in arguments.server or SERVERS:
+        for transportName in arguments.transport or TRANSPORTS:
+            peakBytes, retainedBytes = asyncio.run(serve(serverName, transportName, arguments.requests))
+            print(f"{serverName} over {transportName}: {arguments.requests} requests, {peakBytes:.0f} bytes allocated "
+                  f"at the peak and {retainedBytes:.1f} bytes retained per request")
@@ -1,34 +1,159 @@
-import socket
+import argparse
+import logging
+import signal
 import dns
-import dns.resolver
-import dns.query
+import dns.asyncresolver
 import dns.message
 import dns.message
-from helpers import LOCAL_HOST, AUTHORITATIVE_SERVER_PORT, BUFFER_SIZE
+import dns.resolver
+from helpers import LOCAL_HOST, AUTHORITATIVE_SERVER_PORT
 from helpers import splitInput
 from helpers import getInput
-from helpers import customPrint
-from helpers import displayMessages
+from helpers import getNegativeTtl
+from helpers import DNS_QUERY_TIMEOUT, DNS_RESOLVER_LIFETIME
+from helpers import ServerResponse
+from helpers import ADDRESS_TYPE_A
+from helpers import STATUS_NXDOMAIN, STATUS_SERVFAIL
+from helpers import AUTHORITATIVE_METRICS_PORT
+from helpers import splitAddresses
+from helpers import transportStats, TRANSPORT_METRICS
+from workers import runWorkers, DEFAULT_WORKERS
+from serverLog import configureLogging, addLoggingArguments, debug
+from metrics import serverMetrics, serveMetrics
+from lookupServer import LookupServerProtocol, runLookupServer, DEFAULT_MAX_IN_FLIGHT
+from zoneStore import ZoneStore, ZONE_METRICS
+from zoneStore import NXDOMAIN, NODATA, REFERRAL
+from nameServerSelection import NameServerSelector, queryFastest, SELECTION_METRICS
+from delegationTable import DelegationTable, glueForNameServers, resolveNameServer, DELEGATION_METRICS
+
+log = logging.getLogger("authoritativeDnsServer")
+serverStats = {"queries": 0, "failures": 0, "malformed": 0, "shed": 0}
+zoneStore = ZoneStore()  # The zones this server answers for itself, loaded with --zone
+metrics = serverMetrics(serverStats)
+metrics.exportStats(lambda: transportStats, TRANSPORT_METRICS)
+metrics.exportStats(zoneStore.stats, ZONE_METRICS)
+selector = NameServerSelector()  # The RTT of every name server this process asks
+metrics.exportStats(selector.stats, SELECTION_METRICS)
+delegationTable = DelegationTable()  # The glue of the zones this server refers the local DNS server to
+metrics.exportStats(delegationTable.stats, DELEGATION_METRICS)
+LOOKUP_STAGE = (("stage", "findOutResultantIp"),)
+
+
+async def answerFromZones(userInput, nameServer, returnMessage=None, addressType=ADDRESS_TYPE_A):
+    '''
+    Answers the lookup of userInput from the zone files loaded in zoneStore, without asking any other server.
+Returns a ServerResponse with the addresses of addressType of the name, NXDOMAIN, or no addresses when the name has none of them.
+Returns a referral (see referralFromZones) when userInput lies below a delegation of the zones.
+Returns None when no loaded zone is authoritative for userInput, so the lookup has to be forwarded.
+    '''
+    if not zoneStore.zones:
+        return None
+    answer = zoneStore.lookup(userInput, dns.rdatatype.from_text(addressType))
+    if answer is None:
+        return None
+    if answer.kind == REFERRAL:
+        return await referralFromZones(answer, nameServer, returnMessage)
+    if answer.kind == NXDOMAIN:
+        if returnMessage is not None:
+            returnMessage.append(f"\"{userInput}\" does not exist in the local zones.")
+            returnMessage.append(f"The closest name is \"{answer.closestName}\"")
+        return ServerResponse(STATUS_NXDOMAIN, answer.ttl, messages=returnMessage)
+    if returnMessage is not None:
+        for name, rdataset in zip(answer.names, answer.rdatasets):
+            if rdataset.rdtype == dns.rdatatype.CNAME:
+                returnMessage.append(f"\"{name}\" is an alias of \"{rdataset[0].target}\"")
+    if answer.kind == NODATA:
+        if returnMessage is not None:
+            returnMessage.append(f"\"{userInput}\" has no {addressType} address in the local zones.")
+        return ServerResponse(ttl=answer.ttl, messages=returnMessage)
+    resourceRecordSet = answer.rdatasets[-1]
+    ttl = answer.ttl
+    if resourceRecordSet.rdtype == dns.rdatatype.CNAME:
+        # The alias points out of the local zones
+        target = resourceRecordSet[0].target
+        if returnMessage is not None:
+            returnMessage.append(
+                f"\"{target}\" requires another Authoritative Server Call, fetching it directly")
+        return await resolveDirectly(userInput, target, addressType, ttl, returnMessage)
+    addresses = [resourceRecord.address for resourceRecord in resourceRecordSet]
+    if returnMessage is not None:
+        returnMessage.append(
+            f"IP address of the \"{userInput}\" is \"{addresses[0]}\" (from the local zones)")
+    return ServerResponse(ttl=ttl, addresses=addresses, messages=returnMessage)
+
+
+async def referralFromZones(answer, nameServer, returnMessage=None):
+    '''
+    Refers the local DNS server to the name servers of a zone delegated by the zone files, with their glue from the zones (or else from the system resolver).
+Returns None when nameServer already lists them: the local DNS server followed the referral, so they are asked themselves.
+    '''
+    zone = answer.names[0]
+    nameServers = [resourceRecord.target for resourceRecord in answer.rdatasets[0]]
+    addresses = []
+    ttl = answer.ttl
+    for target in nameServers:
+        glueAddresses, glueTtl = zoneStore.glue(target)
+        if glueAddresses:
+            addresses.extend(glueAddresses)
+            ttl = min(ttl, glueTtl)
+    if not addresses:
+        addresses, glueTtl = await resolveNameServer(nameServers[0])
+        ttl = min(ttl, glueTtl)
+    if set(addresses) & set(splitAddresses(nameServer)):
+        return None
+    if returnMessage is not None:
+        returnMessage.append(f"\"{zone}\" is delegated to \"{nameServers[0]}\" (from the local zones)")
+    return ServerResponse(ttl=ttl, addresses=addresses, messages=returnMessage, zone=zone.to_text())
+
+
+async def resolveDirectly(userInput, target, addressType, ttl=None, returnMessage=None):
+    '''
+    Resolves target (userInput itself, or the name it is an alias of) with the system resolver, for the answers the authoritative server did not give in full.
+Returns a ServerResponse with its addresses of addressType, no addresses when it has none (NODATA), or NXDOMAIN.
+ttl caps the TTL of the answer, it is the TTL of the alias that led to target.
+    '''
+    try:
+        answer = await dns.asyncresolver.resolve(target, addressType, lifetime=DNS_RESOLVER_LIFETIME)
+    except dns.resolver.NoAnswer as error:
+        negativeTtl = getNegativeTtl(error.response())
+        if returnMessage is not None:
+            returnMessage.append(f"\"{target}\" has no {addressType} address.")
+        return ServerResponse(ttl=negativeTtl if ttl is None else min(ttl, negativeTtl), messages=returnMessage)
+    except dns.resolver.NXDOMAIN as error:
+        negativeTtl = getNegativeTtl(error.response(error.qnames()[0]))
+        if returnMessage is not None:
+            returnMessage.append(f"\"{target}\" does not exist.")
+        return ServerResponse(STATUS_NXDOMAIN, negativeTtl if ttl is None else min(ttl, negativeTtl),
+                              messages=returnMessage)
+    addresses = [resourceRecord.address for resourceRecord in answer.rrset]
+    if returnMessage is not None:
+        returnMessage.append(f"IP address of the \"{userInput}\" is \"{addresses[0]}\"")
+    return ServerResponse(ttl=answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl),
+                          addresses=addresses, messages=returnMessage)
 
 
-def findOutResultantIp(userInput, nameServer):
+async def findOutResultantIp(userInput, nameServer, returnMessage=None, addressType=ADDRESS_TYPE_A):
     '''
     findOutResultantIp function:
 Takes a user input and a name server as arguments.
-Performs a DNS query to the specified name server using the dns.query.udp method.
-Handles different response scenarios (e.g., NXDOMAIN, NOERROR) and fetches the IP address.
-Returns a list containing messages about the lookup process.
+Answers from the local zone files when one of them is authoritative for the user input (see answerFromZones).
+Otherwise performs a DNS query to the fastest of the name servers listed in nameServer (see queryFastest).
+Handles different response scenarios (e.g., NXDOMAIN, NOERROR) and fetches the IP addresses of addressType ("A" or "AAAA").
+Returns a ServerResponse with the status, TTL and every resultant IP address, no address when the name has none (NODATA), or the name servers and name of a zone delegated below the one asked (a referral).
+Messages about the lookup process are appended to returnMessage, unless it is None.
     '''
-    returnMessage = []
-    defaultResolver = dns.resolver.get_default_resolver()
-    converToDomainName = dns.name.from_text(userInput)
+    zoneResult = await answerFromZones(userInput, nameServer, returnMessage, addressType)
+    if zoneResult is not None:
+        return zoneResult
     numberOfWords = len(splitInput(userInput))
     authoritativeInput = getInput(userInput, numberOfWords)
-    customPrint("customized authoritativeInput", authoritativeInput)
-    returnMessage.append(
-        f"Looking up \"{authoritativeInput}\" on \"{nameServer}\"")
-    query = dns.message.make_query(authoritativeInput, dns.rdatatype.A)
-    response = dns.query.udp(query, nameServer)
+    debug(log, "customized authoritativeInput: %s", authoritativeInput)
+    if returnMessage is not None:
+        returnMessage.append(
+            f"Looking up \"{authoritativeInput}\" on \"{nameServer}\"")
+    wantedType = dns.rdatatype.from_text(addressType)
+    query = dns.message.make_query(authoritativeInput, wantedType)
+    response, nameServer = await queryFastest(selector, query, splitAddresses(nameServer), DNS_QUERY_TIMEOUT)
     responseCode = response.rcode()
 
     '''
@@ -36,81 +161,101 @@ Returns a list containing messages about the lookup process.
     '''
     if responseCode != dns.rcode.NOERROR:
         if responseCode == dns.rcode.NXDOMAIN:
-            returnMessage.append(f"\"{authoritativeInput}\" does not exist.")
-            returnMessage.append("Please enter a legible domain")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append(f"\"{authoritativeInput}\" does not exist.")
+                returnMessage.append("Please enter a legible domain")
+            return ServerResponse(STATUS_NXDOMAIN, getNegativeTtl(response),
+                                  messages=returnMessage)
         else:
-            returnMessage.append("Please enter a legible domain.")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append("Please enter a legible domain.")
+            return ServerResponse(STATUS_SERVFAIL, 0, messages=returnMessage)
         
-    resourceRecordSet = None
-    resourceRecord = ""
+    if len(response.answer) == 0:
+        for resourceRecordSet in response.authority:
+            if resourceRecordSet.rdtype == dns.rdatatype.SOA:
+                if returnMessage is not None:
+                    returnMessage.append(f"\"{authoritativeInput}\" has no {addressType} address.")
+                return ServerResponse(ttl=getNegativeTtl(response), messages=returnMessage)
+        for resourceRecordSet in response.authority:
+            if resourceRecordSet.rdtype == dns.rdatatype.NS:
+                # The zone of the name is delegated further, the local DNS server asks its servers next
+                nameServers = [resourceRecord.target for resourceRecord in resourceRecordSet]
+                addresses, glueTtl = await glueForNameServers(response, nameServers, delegationTable)
+                if returnMessage is not None:
+                    returnMessage.append(
+                        f"\"{resourceRecordSet.name}\" is delegated to \"{nameServers[0]}\"")
+                return ServerResponse(ttl=min(resourceRecordSet.ttl, glueTtl), addresses=selector.order(addresses),
+                                      messages=returnMessage, zone=resourceRecordSet.name.to_text())
 
     '''
     Checks the response for the answer section, and if needed, performs an additional authoritative server call.
     '''
 
-    if len(response.answer) > 0:
-        resourceRecordSet = response.answer[0]
-        resourceRecord = resourceRecordSet[0]
-        if resourceRecord.rdtype != dns.rdatatype.A: # Resource data type
+    # An alias answered without the records it points to, or no answer at all: the system resolver follows it
+    resourceRecordSet = None
+    for answerRecordSet in response.answer:
+        if answerRecordSet.rdtype == wantedType:
+            resourceRecordSet = answerRecordSet
+    if resourceRecordSet is None:
+        if returnMessage is not None:
             returnMessage.append(
                 f"\"{userInput}\" requires another Authoritative Server Call, fetching it directly")
-            answer = dns.resolver.resolve(userInput, 'A')
-            resourceRecord = answer[0]
-    else:
+        return await resolveDirectly(userInput, userInput, addressType, returnMessage=returnMessage)
+    addresses = [resourceRecord.address for resourceRecord in resourceRecordSet]
+    if returnMessage is not None:
         returnMessage.append(
-            f"\"{userInput}\" requires another Authoritative Server Call, fetching it directly")
-        answer = dns.resolver.resolve(userInput, 'A')
-        resourceRecord = answer[0]
-    finalIPAddress = str(resourceRecord)
-    returnMessage.append(
-        f"IP address of the \"{userInput}\" is \"{finalIPAddress}\"")
-    returnMessage.append(finalIPAddress)
-    return returnMessage
+            f"IP address of the \"{userInput}\" is \"{addresses[0]}\"")
+    return ServerResponse(ttl=resourceRecordSet.ttl, addresses=addresses, messages=returnMessage)
 
 
-def authoritativeDnsServer():
+def authoritativeDnsServer(reusePort=False, metricsPort=AUTHORITATIVE_METRICS_PORT, maxInFlight=DEFAULT_MAX_IN_FLIGHT):
     '''
     Sets up a UDP socket for the authoritative DNS server.
 Listens for incoming requests from clients.
-Calls findOutResultantIp to perform DNS lookups.
+Calls findOutResultantIp to perform DNS lookups, up to maxInFlight of them at the same time (see lookupServer.py).
 Sends the result back to the client.
+reusePort: Set by the workers started with --workers, so that all of them can bind the same port.
+metricsPort: The HTTP port the Prometheus metrics are served on, 0 to not serve them.
     '''
 
     '''
-    Defines the authoritativeDnsServer function, which sets up a UDP socket for the authoritative DNS server, listens for incoming requests from clients, performs DNS lookups, and sends the result back to the client. The function is enclosed in a try-except block to handle KeyboardInterrupt and other exceptions.
+    Defines the authoritativeDnsServer function, which sets up a UDP socket for the authoritative DNS server, listens for incoming requests from clients, performs DNS lookups, and sends the result back to the client. The function is enclosed in a try-except block that logs the unexpected errors, runLookupServer handles KeyboardInterrupt.
     '''
 
 
-    authoritativeDnsServerSocket = socket.socket(
-        socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        authoritativeDnsServerSocket.bind(
-            (LOCAL_HOST, AUTHORITATIVE_SERVER_PORT))
-        print(
-            f"Authoritative Server is up and running at port:{AUTHORITATIVE_SERVER_PORT}")
-        while True:
-            nameServer, _ = authoritativeDnsServerSocket.recvfrom(BUFFER_SIZE)
-            nameServer = nameServer.decode()
-            clientMessage, clientAddress = authoritativeDnsServerSocket.\
-                recvfrom(BUFFER_SIZE)
-            userInput = clientMessage.decode()
-            print(f"Talking to Client at Address:{clientAddress}")
-            print(f"Client Message:{userInput}")
-            result = findOutResultantIp(userInput, nameServer)
-            displayMessages(result)
-            serverMessage = str(result).encode()
-            authoritativeDnsServerSocket.sendto(serverMessage, clientAddress)
-    except KeyboardInterrupt:
-        print("\nStopping the server")
-        print("........")
-        print("........")
-        print("You Stopped the server")
-        exit()
-    except:
-        print("Enter Eligible Domain Name")
+        if hasattr(signal, "SIGHUP"):
+            # kill -HUP reloads the zone files while the server keeps answering
+            signal.signal(signal.SIGHUP, lambda signalNumber, frame: zoneStore.reloadInBackground())
+        serveMetrics(metrics, LOCAL_HOST, metricsPort)
+        runLookupServer("Authoritative Server", AUTHORITATIVE_SERVER_PORT, lambda: LookupServerProtocol(
+            findOutResultantIp, log, metrics, serverStats, LOOKUP_STAGE, maxInFlight), log, reusePort)
+    except Exception:
+        log.exception("The authoritative server stopped on an unexpected error")
         exit()
 
 
-authoritativeDnsServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Authoritative DNS server")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--zone", action="append", default=[], metavar="PATH",
+                        help="zone file, or directory of .zone and .db files, to answer from (can be repeated)")
+    parser.add_argument("--metrics-port", type=int, default=AUTHORITATIVE_METRICS_PORT,
+                        help="HTTP port of the Prometheus metrics (worker i uses the port + i), 0 to not serve them")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of lookups of one process running at the same time")
+    addLoggingArguments(parser)
+    arguments = parser.parse_args()
+    configureLogging(arguments.log_level, arguments.trace_rate)
+    if arguments.zone:
+        zoneStore.paths = arguments.zone
+        log.info("Loaded %d zones", zoneStore.load())
+    if arguments.workers > 1:
+        runWorkers("Authoritative Server", arguments.workers, lambda workerIndex: authoritativeDnsServer(
+                       reusePort=True, metricsPort=arguments.metrics_port and arguments.metrics_port + workerIndex,
+                       maxInFlight=arguments.max_in_flight),
+                   lambda: dict(serverStats, zones=zoneStore.stats(), selection=selector.stats()))
+    else:
+        authoritativeDnsServer(metricsPort=arguments.metrics_port, maxInFlight=arguments.max_in_flight)
@@ -0,0 +1,179 @@
+import asyncio
+import math
+import socket
+import time
+from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT
+from helpers import NXDOMAIN_RESPONSE, SERVFAIL_RESPONSE, NODATA_RESPONSE
+
+'''
+The batchResolver.py file resolves many domain names through the local DNS server at the same time, for bulk jobs such as log enrichment or warming the cache.
+'''
+
+DEFAULT_CONCURRENCY = 64
+DEFAULT_BATCH_TIMEOUT = 10.0  # Seconds to wait for the answer to one name
+STATUS_NOERROR = "NOERROR"
+STATUS_NXDOMAIN = "NXDOMAIN"
+STATUS_SERVFAIL = "SERVFAIL"
+STATUS_TIMEOUT = "TIMEOUT"
+LATENCY_PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))
+
+
+class BatchResult:
+    '''
+    Purpose: The outcome of resolving one name of a batch.
+Attributes:
+name: The domain name.
+status: STATUS_NOERROR, STATUS_NXDOMAIN, STATUS_SERVFAIL or STATUS_TIMEOUT.
+answer: The IP Address, or None when there is none.
+latency: Seconds between sending the query and getting the answer.
+    '''
+    __slots__ = ("name", "status", "answer", "latency")
+
+    def __init__(self, name, status, answer, latency):
+        self.name = name
+        self.status = status
+        self.answer = answer
+        self.latency = latency
+
+    def toDict(self):
+        return {"name": self.name, "status": self.status, "answer": self.answer,
+                "latencyMs": round(self.latency * 1000, 3)}
+
+
+class LocalServerEndpoint(asyncio.DatagramProtocol):
+    '''
+    Purpose: A UDP socket connected to the local DNS server, used for one query at a time.
+The text protocol of the local DNS server has no query id, so the socket an answer arrives on tells which query it belongs to.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.answers = asyncio.Queue()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.answers.put_nowait(data)
+
+    def error_received(self, exc):
+        self.answers.put_nowait(exc)
+
+    async def resolve(self, name, timeout):
+        # Without VERBOSE_QUERY_PREFIX the local DNS server answers with a single datagram
+        self.transport.sendto(name.encode())
+        data = await asyncio.wait_for(self.answers.get(), timeout)
+        if isinstance(data, Exception):
+            raise data
+        return data.decode()
+
+
+async def openEndpoint(serverAddress):
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(
+        LocalServerEndpoint, remote_addr=serverAddress, family=socket.AF_INET)
+    return endpoint
+
+
+async def resolveBatch(names, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_BATCH_TIMEOUT,
+                       serverAddress=(LOCAL_HOST, LOCAL_DNS_SERVER_PORT), rate=None):
+    '''
+    Purpose: Resolves every name of names through the local DNS server, keeping up to concurrency queries in flight.
+Parameters:
+names: Any iterable of domain names, it is read lazily so it can be a large file.
+concurrency: How many queries are sent without waiting for their answers.
+timeout: Seconds after which a name is reported as STATUS_TIMEOUT.
+serverAddress: The address of the local DNS server.
+rate: How many names to send per second, None sends them as fast as the answers come back.
+Actions:
+An asynchronous generator yielding a BatchResult for every name as soon as it is answered, so the order can differ from the input.
+    '''
+    names = iter(names)
+    results = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    nextSendAt = [loop.time()]  # When the next name may be sent, shared by the workers when rate is set
+
+    async def waitForTurn():
+        sendAt = nextSendAt[0]
+        nextSendAt[0] = max(sendAt, loop.time()) + 1 / rate
+        delay = sendAt - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def worker():
+        endpoint = await openEndpoint(serverAddress)
+        try:
+            for name in names:
+                if rate:
+                    await waitForTurn()
+                startedAt = time.perf_counter()
+                try:
+                    answer = await endpoint.resolve(name, timeout)
+                except (asyncio.TimeoutError, OSError):
+                    # A late answer must not be taken for the answer of the next name
+                    endpoint.transport.close()
+                    endpoint = await openEndpoint(serverAddress)
+                    results.put_nowait(BatchResult(name, STATUS_TIMEOUT, None,
+                                                   time.perf_counter() - startedAt))
+                    continue
+                latency = time.perf_counter() - startedAt
+                if answer == NXDOMAIN_RESPONSE:
+                    results.put_nowait(BatchResult(name, STATUS_NXDOMAIN, None, latency))
+                elif answer == SERVFAIL_RESPONSE:
+                    results.put_nowait(BatchResult(name, STATUS_SERVFAIL, None, latency))
+                elif answer == NODATA_RESPONSE:
+                    results.put_nowait(BatchResult(name, STATUS_NOERROR, None, latency))
+                else:
+                    results.put_nowait(BatchResult(name, STATUS_NOERROR, answer, latency))
+        finally:
+            endpoint.transport.close()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    allDone = asyncio.ensure_future(asyncio.gather(*workers))
+    try:
+        while not (allDone.done() and results.empty()):
+            nextResult = asyncio.ensure_future(results.get())
+            await asyncio.wait((nextResult, allDone), return_when=asyncio.FIRST_COMPLETED)
+            if nextResult.done():
+                yield nextResult.result()
+            else:
+                nextResult.cancel()
+        allDone.result()  # Re-raises the error of a worker, if any
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def percentile(sortedValues, fraction):
+    '''
+    Purpose: Returns the value below which the given fraction of sortedValues lies (nearest rank method).
+    '''
+    if not sortedValues:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sortedValues)))
+    return sortedValues[rank - 1]
+
+
+def summarize(results, elapsed):
+    '''
+    Purpose: Sums up a finished batch.
+Parameters:
+results: The BatchResult objects of the batch.
+elapsed: The wall clock seconds the batch took.
+Actions:
+Returns a dictionary with the number of names, the count of every status, the throughput and the latency percentiles in milliseconds.
+    '''
+    latencies = sorted(result.latency * 1000 for result in results)
+    statuses = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    summary = {
+        "names": len(latencies),
+        "statuses": statuses,
+        "elapsedSeconds": round(elapsed, 3),
+        "namesPerSecond": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    for label, fraction in LATENCY_PERCENTILES:
+        summary[label + "Ms"] = round(percentile(latencies, fraction), 3)
+    summary["maxMs"] = round(latencies[-1], 3) if latencies else 0.0
+    return summary
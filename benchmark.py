@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT, BUFFER_SIZE, STATS_QUERY_NAME
+from serverLog import LOG_LEVELS
+from batchResolver import resolveBatch, summarize, DEFAULT_CONCURRENCY, DEFAULT_BATCH_TIMEOUT
+
+'''
+The benchmark.py file measures the four servers together: it starts the root, TLD, authoritative and local DNS servers on this machine against a generated zone, so no real network is needed.
+It then replays a query mix through the local DNS server and reports the throughput, the latency percentiles, the cache hit ratio and the time spent on every hop.
+Every run is appended as one JSON line to the output file, so the results of different versions can be compared.
+The servers use their usual ports, so no other copy of them may be running at the same time.
+'''
+
+BENCHMARK_ZONE = "bench.test"
+DEFAULT_QUERIES = 20000
+DEFAULT_HOSTS = 1000
+DEFAULT_HOT_NAMES = 100
+DEFAULT_HOT_SHARE = 0.8  # Share of the queries asking for one of the hot names, the others ask for names not asked before
+DEFAULT_ZIPF_EXPONENT = 1.1
+DEFAULT_NXDOMAIN_SHARE = 0.05
+DEFAULT_OUTPUT = "benchmark-results.jsonl"
+STARTUP_TIMEOUT = 10.0  # Seconds the servers get to start answering
+ZONE_TTL = 3600
+
+
+def writeZoneFiles(directory, hostCount):
+    '''
+    Purpose: Writes the zone served by the authoritative DNS server and the delegations served by the root and TLD servers.
+Actions:
+Every name server of the benchmark is 127.0.0.1, the servers reach each other on their usual ports.
+Returns the paths of the zone file, the root delegations and the TLD delegations.
+    '''
+    zonePath = os.path.join(directory, BENCHMARK_ZONE + ".zone")
+    with open(zonePath, "w") as zoneFile:
+        zoneFile.write(f"$ORIGIN {BENCHMARK_ZONE}.\n$TTL {ZONE_TTL}\n")
+        zoneFile.write(f"@ IN SOA ns1 admin 1 3600 600 86400 {ZONE_TTL}\n@ IN NS ns1\nns1 IN A 127.0.0.1\n")
+        for host in range(hostCount):
+            zoneFile.write(f"host{host} IN A 10.{host >> 16 & 255}.{host >> 8 & 255}.{host & 255}\n")
+    tld = BENCHMARK_ZONE.rsplit(".", 1)[-1]
+    rootPath = os.path.join(directory, "root.hints")
+    with open(rootPath, "w") as rootFile:
+        rootFile.write(f"{tld}. {ZONE_TTL} IN NS ns.{tld}.\nns.{tld}. {ZONE_TTL} IN A 127.0.0.1\n")
+    tldPath = os.path.join(directory, "tld.hints")
+    with open(tldPath, "w") as tldFile:
+        tldFile.write(f"{BENCHMARK_ZONE}. {ZONE_TTL} IN NS ns1.{BENCHMARK_ZONE}.\n"
+                      f"ns1.{BENCHMARK_ZONE}. {ZONE_TTL} IN A 127.0.0.1\n")
+    return zonePath, rootPath, tldPath
+
+
+def queryMix(queryCount, hostCount, hotNames, hotShare, zipfExponent, nxdomainShare, seed):
+    '''
+    Purpose: Generates the names asked during the benchmark.
+Parameters:
+queryCount: How many names to generate.
+hostCount: How many names the zone holds.
+hotNames: How many of them are asked again and again, with Zipf distributed popularity.
+hotShare: The share of the queries asking for a hot name, the other ones ask for a name not asked before (a cold name).
+zipfExponent: How steeply the popularity of the hot names falls (the name of rank k is asked in proportion to 1 / k ** zipfExponent).
+nxdomainShare: The share of the queries asking for a name that does not exist.
+seed: The seed of the random numbers, the same seed gives the same mix.
+    '''
+    generator = random.Random(seed)
+    hotNames = max(1, min(hotNames, hostCount))
+    weights = list(itertools.accumulate(1 / rank ** zipfExponent for rank in range(1, hotNames + 1)))
+    coldHosts = itertools.cycle(range(hotNames, hostCount)) if hostCount > hotNames else None
+    missing = itertools.count()
+    for _ in range(queryCount):
+        draw = generator.random()
+        if draw < nxdomainShare:
+            yield f"missing{next(missing)}.{BENCHMARK_ZONE}"
+        elif draw < nxdomainShare + (1 - nxdomainShare) * hotShare or coldHosts is None:
+            host = generator.choices(range(hotNames), cum_weights=weights)[0]
+            yield f"host{host}.{BENCHMARK_ZONE}"
+        else:
+            yield f"host{next(coldHosts)}.{BENCHMARK_ZONE}"
+
+
+def startServers(zonePath, rootPath, tldPath, localArguments, logLevel):
+    python = sys.executable
+    here = os.path.dirname(os.path.abspath(__file__))
+    logArguments = ["--log-level", logLevel]
+    commands = [
+        [python, "rootDnsServer.py", "--delegations", rootPath] + logArguments,
+        [python, "tldDnsServer.py", "--delegations", tldPath] + logArguments,
+        [python, "authoritativeDnsServer.py", "--zone", zonePath] + logArguments,
+        [python, "localDnsServer.py", "--no-messages", "--root-server", LOCAL_HOST] + localArguments + logArguments,
+    ]
+    return [subprocess.Popen(command, cwd=here, stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+            for command in commands]
+
+
+def stopServers(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    for process in processes:
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def queryStats(timeout=1.0):
+    '''
+    Purpose: Asks the local DNS server for its counters (see STATS_QUERY_NAME), returns None when it does not answer.
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsSocket:
+        statsSocket.settimeout(timeout)
+        try:
+            statsSocket.sendto(STATS_QUERY_NAME.encode(), (LOCAL_HOST, LOCAL_DNS_SERVER_PORT))
+            data, _ = statsSocket.recvfrom(BUFFER_SIZE)
+        except OSError:
+            return None
+    return json.loads(data)
+
+
+def waitForServers(processes):
+    stopAt = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < stopAt:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args[1]} stopped with exit code {process.returncode}")
+        if queryStats(0.2) is not None:
+            # The local DNS server answers, give the other three the same time to bind their ports
+            time.sleep(0.2)
+            return
+    raise RuntimeError(f"The local DNS server did not answer within {STARTUP_TIMEOUT} seconds")
+
+
+def statsDelta(before, after):
+    '''
+    Purpose: Subtracts the counters read before the run from the ones read after it.
+    '''
+    delta = {}
+    for key, value in after.items():
+        if isinstance(value, dict):
+            delta[key] = statsDelta(before.get(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            delta[key] = value - before.get(key, 0)
+    return delta
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def runBenchmark(names, concurrency, timeout, rate):
+    results = []
+
+    async def run():
+        async for result in resolveBatch(names, concurrency, timeout, rate=rate):
+            results.append(result)
+
+    startedAt = time.perf_counter()
+    asyncio.run(run())
+    return results, time.perf_counter() - startedAt
+
+
+def benchmark(arguments):
+    '''
+    Purpose: Runs one benchmark as configured by the command line arguments and returns its result as a dictionary.
+    '''
+    config = {key: value for key, value in vars(arguments).items() if key not in ("output", "label")}
+    localArguments = ["--mode", arguments.mode]
+    with tempfile.TemporaryDirectory(prefix="dns-benchmark-") as directory:
+        zonePath, rootPath, tldPath = writeZoneFiles(directory, arguments.hosts)
+        processes = startServers(zonePath, rootPath, tldPath, localArguments, arguments.log_level)
+        try:
+            waitForServers(processes)
+            names = list(queryMix(arguments.queries, arguments.hosts, arguments.hot_names,
+                                  arguments.hot_share, arguments.zipf_exponent,
+                                  arguments.nxdomain_share, arguments.seed))
+            before = queryStats()
+            results, elapsed = runBenchmark(names, arguments.concurrency, arguments.timeout, arguments.rate)
+            after = queryStats()
+        finally:
+            stopServers(processes)
+    summary = summarize(results, elapsed)
+    if before is None or after is None:
+        raise RuntimeError("The local DNS server did not answer the stats query")
+    delta = statsDelta(before, after)
+    cacheStats = delta["cache"]
+    cacheHits = cacheStats["hits"] + cacheStats["negativeHits"] + cacheStats["staleHits"]
+    cacheLookups = cacheHits + cacheStats["misses"]
+    summary["cacheHitRatio"] = round(cacheHits / cacheLookups, 3) if cacheLookups else 0.0
+    summary["hopsSkipped"] = delta["hopsSkipped"]
+    summary["hops"] = {
+        hopName: {"queries": hop["queries"], "failures": hop["failures"],
+                  "avgMs": round(hop["seconds"] * 1000 / hop["queries"], 3) if hop["queries"] else 0.0}
+        for hopName, hop in delta["hops"].items()}
+    return {
+        "label": arguments.label,
+        "commit": gitCommit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": config,
+        "summary": summary,
+    }
+
+
+def printSummary(result):
+    summary = result["summary"]
+    print(f"{summary['names']} queries in {summary['elapsedSeconds']} s: {summary['namesPerSecond']} queries per second")
+    print(f"Statuses: {summary['statuses']}")
+    print("Latency (ms): " + ", ".join(f"{label} {summary[label + 'Ms']}"
+                                       for label in ("p50", "p95", "p99", "p999", "max")))
+    print(f"Cache hit ratio: {summary['cacheHitRatio']}, hops skipped: {summary['hopsSkipped']}")
+    for hopName, hop in summary["hops"].items():
+        print(f"{hopName}: {hop['queries']} queries, {hop['failures']} failures, {hop['avgMs']} ms on average")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the local, root, TLD and authoritative DNS servers")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES, help="number of queries to send")
+    parser.add_argument("--hosts", type=int, default=DEFAULT_HOSTS, help="number of names in the benchmark zone")
+    parser.add_argument("--hot-names", type=int, default=DEFAULT_HOT_NAMES,
+                        help="number of names asked again and again")
+    parser.add_argument("--hot-share", type=float, default=DEFAULT_HOT_SHARE,
+                        help="share of the queries asking for a hot name, the others ask for new names")
+    parser.add_argument("--zipf-exponent", type=float, default=DEFAULT_ZIPF_EXPONENT,
+                        help="how steeply the popularity of the hot names falls")
+    parser.add_argument("--nxdomain-share", type=float, default=DEFAULT_NXDOMAIN_SHARE,
+                        help="share of the queries asking for a name that does not exist")
+    parser.add_argument("--rate", type=float,
+                        help="queries per second to send, by default they are sent as fast as the servers answer")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="how many queries may be waiting for their answer at the same time")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_BATCH_TIMEOUT,
+                        help="seconds to wait for the answer to one query")
+    parser.add_argument("--mode", choices=("asyncio", "threads"), default="asyncio",
+                        help="serving mode of the local DNS server")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="warning",
+                        help="log level of the servers, their log is thrown away but still costs the time to write it")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the query mix")
+    parser.add_argument("--label", help="free text stored with the result, like the name of the change measured")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="file the result is appended to as one JSON line")
+    arguments = parser.parse_args()
+    result = benchmark(arguments)
+    printSummary(result)
+    with open(arguments.output, "a") as outputFile:
+        outputFile.write(json.dumps(result) + "\n")
+    print(f"Result appended to {arguments.output}")
@@ -1,7 +1,13 @@
 from sys import *
-from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT, BUFFER_SIZE
+from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT, BUFFER_SIZE, VERBOSE_QUERY_PREFIX
+from batchResolver import resolveBatch, summarize
+from batchResolver import DEFAULT_CONCURRENCY, DEFAULT_BATCH_TIMEOUT
+import argparse
+import asyncio
+import json
 import re
 import socket
+import time
 import helpers
 
 '''
@@ -29,7 +35,7 @@ At each level, the DNS server (root, TLD, authoritative) responds with the neces
 
 
 
-def connectClientToLocalDnsServer(message):
+def connectClientToLocalDnsServer(message, verbose=False):
     originalClientSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     '''
     A new UDP socket is created using socket.socket(socket.AF_INET, socket.SOCK_DGRAM). This sets up a socket for UDP communication.
@@ -44,6 +50,9 @@ This specifies the type of socket, and it stands for Socket Type - Datagram.
 SOCK_DGRAM indicates that the socket will be used for datagram-oriented communication, which is connectionless and operates with UDP (User Datagram Protocol).
 In the context of UDP, datagram sockets are appropriate because UDP is a connectionless protocol, and each packet is treated as an independent unit (datagram).
     '''
+    if verbose:
+        # Only then does the local DNS server send its progress message before the answer
+        message = VERBOSE_QUERY_PREFIX + message
     originalClientMessage = message.encode()
     '''
     The provided DNS query message is encoded into bytes using the encode() method. This is necessary for sending the message over the network.
@@ -56,17 +65,18 @@ In the context of UDP, datagram sockets are appropriate because UDP is a connect
     '''
     The encoded DNS query message is sent to the local DNS server using the sendto() method. The destination address is the local DNS server's address and port.
         '''
-    serverMessage, serverAddress = originalClientSocket.recvfrom(BUFFER_SIZE)
-    '''
-    The client waits to receive a response from the local DNS server using recvfrom(BUFFER_SIZE). The received message and the server's address are stored.
-    '''
-    serverMessage = serverMessage.decode()
-    '''
-    The received server message is decoded from bytes to a string, and both the server's address and the message are printed.
-    '''
-    print(f"Talking to the localDnsServer at the Address: {serverAddress}")
-    print(f"Message from {serverAddress}:")
-    print(f"{serverMessage}")
+    if verbose:
+        serverMessage, serverAddress = originalClientSocket.recvfrom(BUFFER_SIZE)
+        '''
+        The client waits to receive a response from the local DNS server using recvfrom(BUFFER_SIZE). The received message and the server's address are stored.
+        '''
+        serverMessage = serverMessage.decode()
+        '''
+        The received server message is decoded from bytes to a string, and both the server's address and the message are printed.
+        '''
+        print(f"Talking to the localDnsServer at the Address: {serverAddress}")
+        print(f"Message from {serverAddress}:")
+        print(f"{serverMessage}")
     result, _ = originalClientSocket.recvfrom(BUFFER_SIZE)
     '''
     This line receives a response from the server using the recvfrom method of the originalClientSocket socket. The received data is stored in the result variable, and the second variable (_) is used to discard the server address information.
@@ -96,25 +106,74 @@ def isValid(userInput):
         return False
 
 
-while True:
-    print()
-    print("Please Enter the domain name or \"break\" to exit: ")
-    example = "subdomain.domain.com or domain.com"
-    print(f"Example : {example}")
-    try:
-        userInput = input()
-        userInput = userInput.lower()
-        if userInput == "break":
+def interactiveClient(verbose=False):
+    '''
+    Repeatedly takes user input (a domain name) and sends it to the local DNS server, until the user enters "break".
+verbose: Whether the local DNS server is asked for its progress message before every answer.
+    '''
+    while True:
+        print()
+        print("Please Enter the domain name or \"break\" to exit: ")
+        example = "subdomain.domain.com or domain.com"
+        print(f"Example : {example}")
+        try:
+            userInput = input()
+            userInput = userInput.lower()
+            if userInput == "break":
+                print("\n...Exiting Program")
+                break
+            result = isValid(userInput)
+            if result:
+                connectClientToLocalDnsServer(userInput, verbose)
+            else:
+                print()
+                print(
+                    f"Please enter a domain name as shown in the example : {example}")
+                print()
+        except KeyboardInterrupt:
             print("\n...Exiting Program")
-            break
-        result = isValid(userInput)
-        if result:
-            connectClientToLocalDnsServer(userInput)
-        else:
-            print()
-            print(
-                f"Please enter a domain name as shown in the example : {example}")
-            print()
+            exit()
+
+
+def batchClient(fileName, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_BATCH_TIMEOUT):
+    '''
+    Resolves every name of fileName (one per line, "-" for the standard input) with many queries in flight.
+Prints one JSON line per name as soon as it is answered, then a summary of the throughput and the latencies on the standard error.
+    '''
+    nameFile = stdin if fileName == "-" else open(fileName)
+    names = (line.strip().lower() for line in nameFile
+             if line.strip() and not line.startswith("#"))
+    results = []
+
+    async def run():
+        async for result in resolveBatch(names, concurrency, timeout):
+            results.append(result)
+            print(json.dumps(result.toDict()))
+
+    startedAt = time.perf_counter()
+    try:
+        asyncio.run(run())
     except KeyboardInterrupt:
-        print("\n...Exiting Program")
-        exit()
+        print("\n...Stopping the batch", file=stderr)
+    finally:
+        if nameFile is not stdin:
+            nameFile.close()
+    summary = summarize(results, time.perf_counter() - startedAt)
+    print(json.dumps(summary), file=stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DNS client")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="resolve every name of FILE (\"-\" for the standard input) and print the results as JSON lines")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="how many names of the batch are resolved at the same time")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_BATCH_TIMEOUT,
+                        help="seconds to wait for the answer to one name of the batch")
+    parser.add_argument("--verbose", action="store_true",
+                        help="ask the local DNS server for a progress message before every answer")
+    arguments = parser.parse_args()
+    if arguments.batch:
+        batchClient(arguments.batch, arguments.concurrency, arguments.timeout)
+    else:
+        interactiveClient(arguments.verbose)
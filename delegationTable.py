@@ -0,0 +1,251 @@
+import asyncio
+import time
+import dns.asyncresolver
+import dns.name
+import dns.rdatatype
+import dns.resolver
+import dns.zone
+from dnsCache import DnsCache
+from helpers import DNS_RESOLVER_LIFETIME
+from metrics import COUNTER, GAUGE
+
+'''
+The delegationTable.py file contains the delegation table used by the root and TLD servers to answer referrals (which servers serve a zone, and at which addresses) without asking another name server.
+'''
+
+DEFAULT_MAX_DELEGATIONS = 10000
+ADDRESS_TYPES = (dns.rdatatype.A, dns.rdatatype.AAAA)
+# How the counters of DelegationTable.stats() are published by Metrics.exportStats() (see metrics.py)
+DELEGATION_METRICS = {
+    "static": ("dns_delegations_static", GAUGE, "Delegations loaded from files"),
+    "learned": ("dns_delegations_learned", GAUGE, "Delegations learned from lookups"),
+    "glue": ("dns_delegation_glue", GAUGE, "Name servers whose addresses are known"),
+    "hits": ("dns_delegation_hits_total", COUNTER, "Referrals answered from the delegation table"),
+    "negativeHits": ("dns_delegation_negative_hits_total", COUNTER, "Zones known not to exist"),
+    "misses": ("dns_delegation_misses_total", COUNTER, "Referrals not found in the delegation table"),
+    "glueHits": ("dns_delegation_glue_hits_total", COUNTER, "Name server addresses found in the table"),
+    "glueMisses": ("dns_delegation_glue_misses_total", COUNTER, "Name server addresses not found in the table"),
+}
+
+
+class Delegation:
+    '''
+    Purpose: The name servers of one zone cut and their addresses.
+Attributes:
+nameServers: The names of the name servers of the zone.
+addresses: The IP Addresses of those name servers (the glue), may be empty when none is known.
+    '''
+    __slots__ = ("nameServers", "addresses")
+
+    def __init__(self, nameServers, addresses):
+        self.nameServers = nameServers
+        self.addresses = addresses
+
+    def __len__(self):
+        return sum(len(nameServer) for nameServer in self.nameServers) + \
+            sum(len(address) for address in self.addresses)
+
+
+class DelegationTable:
+    '''
+    Purpose: Maps zone cuts (like "com." or "example.com.") to their name servers and glue addresses.
+Parameters:
+maxEntries: The maximum number of learned delegations, and of learned glue entries, kept at the same time.
+clock: The function used to read the current time, time.monotonic by default.
+Actions:
+Delegations loaded from a file with load() never expire, they are handed out with the TTL of their records.
+Delegations, glue addresses and non-existent zones learned from lookups are kept in DnsCache instances for the TTL of their records.
+Keeps hit and miss counters that can be read through stats().
+    '''
+
+    def __init__(self, maxEntries=DEFAULT_MAX_DELEGATIONS, clock=time.monotonic):
+        self.static = {}
+        self.staticGlue = {}
+        # prefetchFraction=1: referrals are not refreshed ahead of their expiry
+        self.delegations = DnsCache(maxEntries=maxEntries, prefetchFraction=1, clock=clock)
+        self.glue = DnsCache(maxEntries=maxEntries, prefetchFraction=1, clock=clock)
+        self.clock = clock
+        self.hits = 0
+        self.negativeHits = 0
+        self.misses = 0
+        self.glueHits = 0
+        self.glueMisses = 0
+
+    def load(self, fileName):
+        '''
+        Purpose: Reads delegations from a file in the master file format of the root hints (named.root).
+Parameters:
+fileName: The file to read, holding NS records for the zone cuts and A or AAAA records for the name servers.
+Actions:
+Adds every zone cut of the file to the table, with the addresses found for its name servers, and returns how many were added.
+        '''
+        zone = dns.zone.from_file(fileName, origin=dns.name.root, relativize=False,
+                                  check_origin=False)
+        nameServersOf = {}
+        for name, rdataset in zone.iterate_rdatasets():
+            if rdataset.rdtype == dns.rdatatype.NS:
+                nameServers = [resourceRecord.target.to_text() for resourceRecord in rdataset]
+                nameServersOf[name] = (nameServers, rdataset.ttl)
+            elif rdataset.rdtype in ADDRESS_TYPES:
+                key = self.makeKey(name)
+                addresses, ttl = self.staticGlue.get(key, ([], rdataset.ttl))
+                addresses.extend(resourceRecord.address for resourceRecord in rdataset)
+                self.staticGlue[key] = (addresses, min(ttl, rdataset.ttl))
+        for name, (nameServers, ttl) in nameServersOf.items():
+            addresses = []
+            for nameServer in nameServers:
+                glueAddresses, glueTtl = self.staticGlue.get(self.makeKey(nameServer), ([], ttl))
+                addresses.extend(glueAddresses)
+                ttl = min(ttl, glueTtl)
+            self.static[self.makeKey(name)] = (Delegation(nameServers, addresses), ttl)
+        return len(nameServersOf)
+
+    @staticmethod
+    def makeKey(name):
+        if not isinstance(name, str):
+            name = name.to_text()
+        name = name.lower()
+        return name if name.endswith(".") else name + "."
+
+    def lookup(self, zoneName):
+        '''
+        Purpose: Looks up the delegation of a zone cut.
+Parameters:
+zoneName: The zone cut, as text or dns.name.Name.
+Actions:
+Returns a (Delegation, ttl) pair, where ttl is how long the answer may still be cached.
+Returns (None, ttl) when the zone was learned not to exist, and None when nothing is known about it.
+        '''
+        key = self.makeKey(zoneName)
+        staticDelegation = self.static.get(key)
+        if staticDelegation is not None:
+            self.hits += 1
+            return staticDelegation
+        entry = self.delegations.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        remaining = max(0, int(entry.expiresAt - self.clock()))
+        if entry.negative:
+            self.negativeHits += 1
+            return None, remaining
+        self.hits += 1
+        return entry.value, remaining
+
+    def learn(self, zoneName, nameServers, addresses, ttl):
+        self.delegations.put(self.makeKey(zoneName), Delegation(nameServers, addresses), ttl)
+
+    def learnNonExistent(self, zoneName, ttl):
+        self.delegations.putNegative(self.makeKey(zoneName), ttl)
+
+    def lookupGlue(self, nameServer):
+        '''
+        Purpose: Returns the known addresses of a name server as an (addresses, ttl) pair, or None when none is known.
+        '''
+        key = self.makeKey(nameServer)
+        staticGlue = self.staticGlue.get(key)
+        if staticGlue is not None:
+            self.glueHits += 1
+            return staticGlue
+        entry = self.glue.get(key)
+        if entry is None:
+            self.glueMisses += 1
+            return None
+        self.glueHits += 1
+        return entry.value, max(0, int(entry.expiresAt - self.clock()))
+
+    def learnGlue(self, nameServer, addresses, ttl):
+        key = self.makeKey(nameServer)
+        if key not in self.staticGlue:
+            # lookupGlue() answers from the static glue first, a learned copy would never be read
+            self.glue.put(key, addresses, ttl)
+
+    def stats(self):
+        '''
+        Purpose: Returns the delegation table counters as a dictionary, for printing or exporting.
+        '''
+        lookups = self.hits + self.negativeHits + self.misses
+        glueLookups = self.glueHits + self.glueMisses
+        return {
+            "static": len(self.static),
+            "learned": len(self.delegations),
+            "glue": len(self.staticGlue) + len(self.glue),
+            "hits": self.hits,
+            "negativeHits": self.negativeHits,
+            "misses": self.misses,
+            "hitRate": round((self.hits + self.negativeHits) / lookups, 3) if lookups else 0.0,
+            "glueHits": self.glueHits,
+            "glueMisses": self.glueMisses,
+            "glueHitRate": round(self.glueHits / glueLookups, 3) if glueLookups else 0.0,
+        }
+
+
+def glueFromResponse(response, nameServer):
+    '''
+    Purpose: Finds the addresses of a name server in the additional section of a referral.
+Parameters:
+response: The dns.message.Message holding the NS records.
+nameServer: The dns.name.Name of the name server.
+Actions:
+Returns an (addresses, ttl) pair, or None when the response carries no glue for the name server.
+    '''
+    addresses = []
+    ttl = None
+    for resourceRecordSet in response.additional:
+        if resourceRecordSet.name == nameServer and resourceRecordSet.rdtype in ADDRESS_TYPES:
+            addresses.extend(resourceRecord.address for resourceRecord in resourceRecordSet)
+            ttl = resourceRecordSet.ttl if ttl is None else min(ttl, resourceRecordSet.ttl)
+    if not addresses:
+        return None
+    return addresses, ttl
+
+
+async def resolveNameServer(nameServer):
+    '''
+    Purpose: Looks up the A and AAAA addresses of a name server with the system resolver, returns an (addresses, ttl) pair.
+Actions:
+Asks for both types at the same time and keeps the addresses of whichever answered.
+Raises the error of the A lookup when neither type gave an address.
+    '''
+    answers = await asyncio.gather(*(dns.asyncresolver.resolve(nameServer, addressType, lifetime=DNS_RESOLVER_LIFETIME,
+                                                               raise_on_no_answer=False)
+                                     for addressType in ADDRESS_TYPES), return_exceptions=True)
+    resourceRecordSets = [answer.rrset for answer in answers
+                          if not isinstance(answer, Exception) and answer.rrset is not None]
+    if not resourceRecordSets:
+        if isinstance(answers[0], Exception):
+            raise answers[0]
+        raise dns.resolver.NoAnswer(response=answers[0].response)
+    addresses = [resourceRecord.to_text() for resourceRecordSet in resourceRecordSets
+                 for resourceRecord in resourceRecordSet]
+    return addresses, min(resourceRecordSet.ttl for resourceRecordSet in resourceRecordSets)
+
+
+async def glueForNameServers(response, nameServers, delegationTable):
+    '''
+    Purpose: Collects the addresses of every name server of a referral, so the next server can ask the fastest of them.
+Parameters:
+response: The dns.message.Message holding the NS records.
+nameServers: The dns.name.Name of every name server of the zone.
+delegationTable: The DelegationTable the glue is looked up in and learned into.
+Actions:
+Takes the addresses from the additional section of response or from the table, and only resolves the first name server (see resolveNameServer) when no address of any of them is known.
+Only the addresses from the response or the resolver are learned into the table, the ones found in it are already there.
+Returns an (addresses, ttl) pair, ttl being the smallest TTL of the glue used.
+    '''
+    addresses = []
+    ttl = None
+    for nameServer in nameServers:
+        glue = glueFromResponse(response, nameServer)
+        if glue is not None:
+            delegationTable.learnGlue(nameServer, *glue)
+        else:
+            glue = delegationTable.lookupGlue(nameServer)
+            if glue is None:
+                continue
+        addresses.extend(address for address in glue[0] if address not in addresses)
+        ttl = glue[1] if ttl is None else min(ttl, glue[1])
+    if not addresses:
+        addresses, ttl = await resolveNameServer(nameServers[0])
+        delegationTable.learnGlue(nameServers[0], addresses, ttl)
+    return addresses, ttl
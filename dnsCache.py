@@ -0,0 +1,372 @@
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from metrics import COUNTER, GAUGE
+
+'''
+The dnsCache.py file contains the cache used by the local DNS server to remember the intermediate results of a lookup (TLD server, authoritative server and final IP Address) for as long as the upstream record allows it.
+'''
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_MAX_TTL = 86400
+DEFAULT_PREFETCH_FRACTION = 0.8
+DEFAULT_PREFETCH_MIN_HITS = 3
+DEFAULT_STALE_TTL = 0  # Serving stale entries is off unless a grace period is configured
+# Snapshot file of the cache (see DnsCache.snapshot): a header, then every entry followed by its key and its value
+SNAPSHOT_MAGIC = b"DNSC"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("!4sBdI")  # magic, version, wall clock time of the snapshot, entry count
+SNAPSHOT_ENTRY = struct.Struct("!BIIBB")  # negative, remaining TTL in milliseconds, TTL, key length, value length
+# How the counters of stats() are published by Metrics.exportStats() (see metrics.py)
+CACHE_METRICS = {
+    "entries": ("dns_cache_entries", GAUGE, "Entries in the cache"),
+    "bytes": ("dns_cache_bytes", GAUGE, "Approximate bytes held by the cache"),
+    "hits": ("dns_cache_hits_total", COUNTER, "Lookups answered by a positive cache entry"),
+    "negativeHits": ("dns_cache_negative_hits_total", COUNTER, "Lookups answered by a negative cache entry"),
+    "misses": ("dns_cache_misses_total", COUNTER, "Lookups not found in the cache"),
+    "evictions": ("dns_cache_evictions_total", COUNTER, "Entries evicted to respect the size limits"),
+    "expirations": ("dns_cache_expirations_total", COUNTER, "Entries dropped because their TTL passed"),
+    "refreshes": ("dns_cache_refreshes_total", COUNTER, "Entries looked up again ahead of their expiry"),
+    "refreshFailures": ("dns_cache_refresh_failures_total", COUNTER, "Refresh-ahead lookups that failed"),
+    "staleHits": ("dns_cache_stale_hits_total", COUNTER, "Expired entries served because a server did not answer"),
+    "missesPrevented": ("dns_cache_misses_prevented_total", COUNTER, "Hits on entries that refresh-ahead kept from expiring"),
+}
+
+
+class CacheEntry:
+    '''
+    Purpose: Holds a single cached value together with the time at which it stops being valid.
+Attributes:
+value: The cached value (an IP Address), or None for a negative (NXDOMAIN) entry.
+expiresAt: The clock reading after which the entry must not be served.
+negative: True when the entry records that the name does not exist.
+size: The approximate number of bytes the entry accounts for in the byte budget.
+ttl: The TTL the entry was stored with.
+hits: How many times the entry was served since it was stored.
+refreshing: True while a refresh-ahead lookup for the entry is running.
+prefetchedFrom: When the entry replaced one by refresh-ahead, the time the old one would have expired.
+    '''
+    __slots__ = ("value", "expiresAt", "negative", "size", "ttl", "hits", "refreshing",
+                 "prefetchedFrom")
+
+    def __init__(self, value, expiresAt, negative, size, ttl):
+        self.value = value
+        self.expiresAt = expiresAt
+        self.negative = negative
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.refreshing = False
+        self.prefetchedFrom = None
+
+
+class DnsCache:
+    '''
+    Purpose: A bounded, TTL-aware cache with least recently used eviction.
+Parameters:
+maxEntries: The maximum number of entries kept before the least recently used one is evicted.
+maxBytes: An optional budget on the approximate size of the keys and values held.
+negativeTtl: The TTL used for NXDOMAIN entries when the upstream did not supply one.
+maxTtl: Upper bound applied to every TTL so a bogus record cannot pin an entry forever.
+prefetchFraction: The fraction of its TTL after which a hot entry should be refreshed ahead of expiry (1 or more disables it).
+prefetchMinHits: How many hits make an entry hot enough to be refreshed ahead of expiry.
+staleTtl: How many seconds an expired entry is kept so it can still be served when the servers are unreachable (RFC 8767), 0 disables it.
+onRemove: An optional function called with the key of every entry that leaves the cache (expired, evicted, replaced or removed).
+clock: The function used to read the current time, time.monotonic by default.
+Actions:
+Stores every entry with the TTL of the upstream record and drops it once it expires.
+Keeps hit, miss, eviction, expiration and refresh-ahead counters that can be read through stats().
+    '''
+
+    def __init__(self, maxEntries=DEFAULT_MAX_ENTRIES, maxBytes=None,
+                 negativeTtl=DEFAULT_NEGATIVE_TTL, maxTtl=DEFAULT_MAX_TTL,
+                 prefetchFraction=DEFAULT_PREFETCH_FRACTION,
+                 prefetchMinHits=DEFAULT_PREFETCH_MIN_HITS, staleTtl=DEFAULT_STALE_TTL,
+                 onRemove=None, clock=time.monotonic):
+        self.entries = OrderedDict()
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.negativeTtl = negativeTtl
+        self.maxTtl = maxTtl
+        self.prefetchFraction = prefetchFraction
+        self.prefetchMinHits = prefetchMinHits
+        self.staleTtl = staleTtl
+        self.onRemove = onRemove
+        self.clock = clock
+        self.currentBytes = 0
+        self.hits = 0
+        self.negativeHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+        self.refreshFailures = 0
+        self.missesPrevented = 0
+        self.staleHits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry.expiresAt > self.clock()
+
+    def get(self, key):
+        '''
+        Purpose: Looks up a key in the cache.
+Parameters:
+key: The cache key (a partial or full domain name).
+Actions:
+Returns the CacheEntry when it is present and not expired, marking it as most recently used.
+Returns None for an expired entry, counting the lookup as a miss, and removes it unless it may still be served stale.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = self.clock()
+        if entry.expiresAt <= now:
+            if entry.expiresAt + self.staleTtl <= now:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        if entry.negative:
+            self.negativeHits += 1
+        if entry.prefetchedFrom is not None and entry.prefetchedFrom <= self.clock():
+            # Without the refresh this lookup would have found the old entry expired
+            self.missesPrevented += 1
+            entry.prefetchedFrom = None
+        return entry
+
+    def peek(self, key):
+        '''
+        Purpose: Returns the CacheEntry of key when it is present and not expired, without counting a hit or a miss and without touching the LRU order.
+        '''
+        entry = self.entries.get(key)
+        if entry is None or entry.expiresAt <= self.clock():
+            return None
+        return entry
+
+    def getStale(self, key):
+        '''
+        Purpose: Looks up an expired entry that is still inside its stale grace period.
+Parameters:
+key: The cache key.
+Actions:
+Returns the CacheEntry when it expired less than staleTtl seconds ago, otherwise None.
+Call staleServed() when the entry is actually used to answer a client.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        now = self.clock()
+        if entry.expiresAt > now or entry.expiresAt + self.staleTtl <= now:
+            return None
+        return entry
+
+    def staleServed(self):
+        self.staleHits += 1
+
+    def shouldRefresh(self, entry):
+        '''
+        Purpose: Tells whether a hot entry should be looked up again before it expires.
+Parameters:
+entry: A CacheEntry just returned by get().
+Actions:
+Returns True, and marks the entry as being refreshed, when it had at least prefetchMinHits hits and more than prefetchFraction of its TTL has passed.
+The caller is expected to run the lookup and store its result, or call refreshFailed().
+        '''
+        if entry.refreshing or entry.hits < self.prefetchMinHits or self.prefetchFraction >= 1:
+            return False
+        remaining = entry.expiresAt - self.clock()
+        if remaining > entry.ttl * (1 - self.prefetchFraction):
+            return False
+        entry.refreshing = True
+        self.refreshes += 1
+        return True
+
+    def refreshFailed(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.refreshing = False
+        self.refreshFailures += 1
+
+    def put(self, key, value, ttl):
+        '''
+        Purpose: Stores a positive answer in the cache.
+Parameters:
+key: The cache key.
+value: The IP Address to remember.
+ttl: The TTL of the upstream record, in seconds.
+Actions:
+Replaces any previous entry for the key and evicts old entries until the limits hold again.
+        '''
+        self._store(key, value, ttl, False)
+
+    def putNegative(self, key, ttl=None):
+        '''
+        Purpose: Records that a name does not exist (NXDOMAIN).
+Parameters:
+key: The cache key.
+ttl: The negative TTL from the upstream SOA record, or None to use the default.
+        '''
+        if ttl is None:
+            ttl = self.negativeTtl
+        self._store(key, None, ttl, True)
+
+    def remove(self, key):
+        if key in self.entries:
+            self._remove(key)
+
+    def clear(self):
+        if self.onRemove is not None:
+            for key in self.entries:
+                self.onRemove(key)
+        self.entries.clear()
+        self.currentBytes = 0
+
+    def stats(self):
+        '''
+        Purpose: Returns the cache counters as a dictionary, for printing or exporting.
+        '''
+        return {
+            "entries": len(self.entries),
+            "bytes": self.currentBytes,
+            "hits": self.hits,
+            "negativeHits": self.negativeHits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "refreshes": self.refreshes,
+            "refreshFailures": self.refreshFailures,
+            "missesPrevented": self.missesPrevented,
+            "staleHits": self.staleHits,
+        }
+
+    def snapshot(self, wallClock=time.time):
+        '''
+        Purpose: Serializes the entries that have not expired yet, with their remaining TTL, for a warm start after a restart.
+Actions:
+Returns the bytes of the snapshot, the entries are written from the least to the most recently used so restore() keeps their order.
+The remaining TTLs are relative to the wall clock time written in the header, because the monotonic clock of the cache starts over in a new process.
+        '''
+        now = self.clock()
+        parts = []
+        count = 0
+        for key, entry in self.entries.items():
+            remaining = entry.expiresAt - now
+            if remaining <= 0:
+                continue
+            keyBytes = key.encode()
+            valueBytes = entry.value.encode() if entry.value is not None else b""
+            parts.append(SNAPSHOT_ENTRY.pack(entry.negative, int(remaining * 1000), entry.ttl,
+                                             len(keyBytes), len(valueBytes)))
+            parts.append(keyBytes)
+            parts.append(valueBytes)
+            count += 1
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, wallClock(), count) + b"".join(parts)
+
+    def restore(self, data, wallClock=time.time):
+        '''
+        Purpose: Loads the entries of a snapshot made by snapshot().
+Parameters:
+data: The snapshot, any bytes-like object (loadSnapshot() passes a memory map of the file).
+Actions:
+Drops the entries that expired since the snapshot was taken and evicts the oldest ones when the snapshot holds more than the limits allow.
+Returns the number of entries loaded and of entries dropped, raises ValueError when data is not a valid snapshot.
+        '''
+        try:
+            magic, version, savedAt, count = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("Not a cache snapshot of this version")
+            elapsed = max(0.0, wallClock() - savedAt)
+            now = self.clock()
+            offset = SNAPSHOT_HEADER.size
+            loaded = 0
+            dropped = 0
+            for _ in range(count):
+                negative, remaining, ttl, keyLength, valueLength = SNAPSHOT_ENTRY.unpack_from(data, offset)
+                offset += SNAPSHOT_ENTRY.size
+                key = bytes(data[offset:offset + keyLength]).decode()
+                offset += keyLength
+                value = None if negative else bytes(data[offset:offset + valueLength]).decode()
+                offset += valueLength
+                if offset > len(data):
+                    raise ValueError("Truncated cache snapshot")
+                remaining = remaining / 1000 - elapsed
+                if remaining <= 0:
+                    dropped += 1
+                    continue
+                if key in self.entries:
+                    self._remove(key)
+                size = len(key) + (len(value) if value else 0)
+                self.entries[key] = CacheEntry(value, now + remaining, bool(negative), size, ttl)
+                self.currentBytes += size
+                loaded += 1
+        except (struct.error, UnicodeDecodeError) as error:
+            raise ValueError("Truncated cache snapshot") from error
+        finally:
+            self._evict()
+        return loaded, dropped
+
+    def _store(self, key, value, ttl, negative):
+        ttl = max(0, min(int(ttl), self.maxTtl))
+        previous = self.entries.get(key)
+        if previous is not None:
+            self._remove(key)
+        if ttl == 0:
+            return
+        size = len(key) + (len(value) if value else 0)
+        entry = CacheEntry(value, self.clock() + ttl, negative, size, ttl)
+        if previous is not None and previous.refreshing:
+            entry.prefetchedFrom = previous.expiresAt
+        self.entries[key] = entry
+        self.currentBytes += size
+        self._evict()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.currentBytes -= entry.size
+        if self.onRemove is not None:
+            self.onRemove(key)
+
+    def _evict(self):
+        while len(self.entries) > self.maxEntries or \
+                (self.maxBytes is not None and self.currentBytes > self.maxBytes):
+            key, entry = self.entries.popitem(last=False)
+            self.currentBytes -= entry.size
+            self.evictions += 1
+            if self.onRemove is not None:
+                self.onRemove(key)
+
+
+def saveSnapshot(fileName, data):
+    '''
+    Purpose: Writes a snapshot made by DnsCache.snapshot() to fileName.
+Actions:
+Writes a temporary file and renames it over fileName, so a crash while writing never leaves half a snapshot behind.
+    '''
+    temporaryName = fileName + ".tmp"
+    with open(temporaryName, "wb") as snapshotFile:
+        snapshotFile.write(data)
+    os.replace(temporaryName, fileName)
+
+
+def loadSnapshot(cache, fileName):
+    '''
+    Purpose: Loads the snapshot in fileName into cache, reading it through a memory map instead of copying the whole file.
+Actions:
+Returns the (loaded, dropped) counts of DnsCache.restore(), raises OSError when the file cannot be read and ValueError when it is not a valid snapshot.
+    '''
+    with open(fileName, "rb") as snapshotFile:
+        if os.fstat(snapshotFile.fileno()).st_size == 0:
+            raise ValueError("Empty cache snapshot")
+        with mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return cache.restore(data)
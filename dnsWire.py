@@ -0,0 +1,222 @@
+import socket
+import struct
+
+'''
+The dnsWire.py file reads DNS queries and writes DNS responses in the wire format of RFC 1035, with the EDNS0 OPT record of RFC 6891, so standard tools (dig, stub resolvers, load generators) can query the local DNS server.
+Only what the local DNS server answers is supported: one question, answered with A or AAAA records, and with an SOA record in the authority section when the name does not exist or has no such records.
+It works on the bytes directly instead of building dns.message objects, which would cost more than answering a cached name.
+'''
+
+HEADER = struct.Struct("!HHHHHH")  # id, flags, question count, answer count, authority count, additional count
+QUESTION_TAIL = struct.Struct("!HH")  # type, class
+RECORD_TAIL = struct.Struct("!HHIH")  # type, class, ttl, data length
+ANSWER_A = struct.Struct("!HHHIH4s")  # name, type, class, ttl, data length, address
+ANSWER_AAAA = struct.Struct("!HHHIH16s")
+SOA_TIMERS = struct.Struct("!IIIII")  # serial, refresh, retry, expire, minimum
+OPT_RECORD = struct.Struct("!BHHIH")  # root name, type, UDP payload size, extended rcode + version + flags, data length
+FLAG_QR = 0x8000
+OPCODE_MASK = 0x7800
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_BADVERS = 16  # Extended rcode, its upper bits go into the OPT record
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+TYPE_ANY = 255
+CLASS_IN = 1
+SUPPORTED_TYPES = (TYPE_A, TYPE_AAAA, TYPE_ANY)
+QUESTION_NAME_POINTER = 0xC00C  # Compression pointer to the name of the question, which starts right after the header
+MAX_NAME_LENGTH = 255
+MAX_UDP_PAYLOAD = 512  # Largest response to a query without EDNS0
+EDNS_UDP_PAYLOAD = 1232  # The payload size announced in our responses, small enough to avoid IP fragmentation
+
+
+class WireFormatError(ValueError):
+    '''
+    Raised when a datagram is not a DNS query that can be answered.
+    '''
+
+
+class WireQuery:
+    '''
+    Purpose: A DNS query read by parseQuery().
+Attributes:
+id, flags: From the header.
+name: The name asked for, without the trailing dot ("www.example.com").
+type, qclass: The type and class asked for (TYPE_A, CLASS_IN, ...).
+question: The bytes of the question section, copied as they are into the response.
+ednsPayload: The UDP payload size announced in the OPT record, None when the query has no OPT record.
+ednsVersion: The EDNS version of the OPT record.
+    '''
+    __slots__ = ("id", "flags", "name", "type", "qclass", "question", "ednsPayload", "ednsVersion")
+
+    def __init__(self, id, flags, name, type, qclass, question, ednsPayload=None, ednsVersion=0):
+        self.id = id
+        self.flags = flags
+        self.name = name
+        self.type = type
+        self.qclass = qclass
+        self.question = question
+        self.ednsPayload = ednsPayload
+        self.ednsVersion = ednsVersion
+
+
+def isWireQuery(data):
+    '''
+    Purpose: Tells a DNS query from a query of the text protocol (a bare domain name) sent to the same port.
+A DNS query has a question count of 1 in bytes 4 and 5, a domain name never contains a NUL byte.
+    '''
+    return len(data) > HEADER.size and data[4] == 0 and data[5] == 1
+
+
+def readName(data, offset):
+    '''
+    Purpose: Reads the uncompressed name starting at offset.
+Actions:
+Returns the name (without the trailing dot) and the offset right after it.
+    '''
+    labels = []
+    length = 0
+    while True:
+        if offset >= len(data):
+            raise WireFormatError("Name runs past the end of the message")
+        labelLength = data[offset]
+        offset += 1
+        if labelLength == 0:
+            break
+        if labelLength & 0xC0:
+            # Clients never compress the only name of a query
+            raise WireFormatError("Compressed or extended label in the question")
+        length += labelLength + 1
+        if length > MAX_NAME_LENGTH or offset + labelLength > len(data):
+            raise WireFormatError("Name is too long")
+        labels.append(data[offset:offset + labelLength])
+        offset += labelLength
+    try:
+        return b".".join(labels).decode("ascii"), offset
+    except UnicodeDecodeError:
+        raise WireFormatError("Name is not ASCII") from None
+
+
+def parseQuery(data):
+    '''
+    Purpose: Reads a DNS query.
+Actions:
+Returns a WireQuery, raises WireFormatError when data is not a query with exactly one question.
+Looks for the OPT record in the additional section, any other record there is skipped.
+    '''
+    if len(data) < HEADER.size:
+        raise WireFormatError("Message is shorter than the header")
+    queryId, flags, questionCount, answerCount, authorityCount, additionalCount = HEADER.unpack_from(data)
+    if flags & FLAG_QR:
+        raise WireFormatError("Message is a response")
+    if questionCount != 1:
+        raise WireFormatError(f"Query has {questionCount} questions")
+    name, offset = readName(data, HEADER.size)
+    if offset + QUESTION_TAIL.size > len(data):
+        raise WireFormatError("Question is truncated")
+    queryType, queryClass = QUESTION_TAIL.unpack_from(data, offset)
+    offset += QUESTION_TAIL.size
+    query = WireQuery(queryId, flags, name, queryType, queryClass, bytes(data[HEADER.size:offset]))
+    if additionalCount and not (answerCount or authorityCount):
+        readOptRecord(data, offset, additionalCount, query)
+    return query
+
+
+def readOptRecord(data, offset, count, query):
+    for _ in range(count):
+        if offset < len(data) and data[offset] == 0:
+            offset += 1  # The OPT record is owned by the root name
+        else:
+            _, offset = readName(data, offset)
+        if offset + RECORD_TAIL.size > len(data):
+            raise WireFormatError("Additional record is truncated")
+        recordType, recordClass, recordTtl, dataLength = RECORD_TAIL.unpack_from(data, offset)
+        offset += RECORD_TAIL.size + dataLength
+        if recordType == TYPE_OPT:
+            query.ednsPayload = max(recordClass, MAX_UDP_PAYLOAD)
+            query.ednsVersion = (recordTtl >> 16) & 0xFF
+            return
+
+
+def answerRecord(queryType, address, ttl):
+    # The addresses of an ANY query are of one type only, the ones of the other type are left out
+    try:
+        if ":" in address:
+            if queryType in (TYPE_AAAA, TYPE_ANY):
+                return ANSWER_AAAA.pack(QUESTION_NAME_POINTER, TYPE_AAAA, CLASS_IN, ttl, 16,
+                                        socket.inet_pton(socket.AF_INET6, address))
+        elif queryType in (TYPE_A, TYPE_ANY):
+            return ANSWER_A.pack(QUESTION_NAME_POINTER, TYPE_A, CLASS_IN, ttl, 4,
+                                 socket.inet_pton(socket.AF_INET, address))
+    except OSError:
+        pass
+    return None
+
+
+def encodeName(name):
+    # The uncompressed wire form of a name, "." being the root zone
+    labels = name.rstrip(".").encode("ascii").split(b".") if name.rstrip(".") else []
+    return b"".join(bytes((len(label),)) + label for label in labels) + b"\0"
+
+
+def soaRecord(zone, ttl):
+    '''
+    Purpose: Writes the SOA record of zone for the authority section of a negative answer (RFC 2308), which tells the client how long it may cache that answer.
+The local DNS server does not get the SOA record of the zone from the other servers, only the remaining negative TTL, so the record is synthesized: its MNAME is the zone itself, its RNAME "hostmaster." in the zone, its serial and timers 0, and both its TTL and its minimum field the negative TTL.
+    '''
+    owner = encodeName(zone)
+    rdata = b"".join((owner, b"\x0ahostmaster", owner, SOA_TIMERS.pack(0, 0, 0, 0, ttl)))
+    return b"".join((owner, RECORD_TAIL.pack(TYPE_SOA, CLASS_IN, ttl, len(rdata)), rdata))
+
+
+def buildResponse(query, rcode, addresses=(), ttl=0, zone=None):
+    '''
+    Purpose: Writes the response to query.
+Parameters:
+rcode: One of the RCODE_* constants.
+addresses: The IP addresses of the answer, the ones that do not match the type asked for are left out.
+ttl: The TTL of the answer records, or of the SOA record of a negative answer, in seconds.
+zone: For an NXDOMAIN answer, or a NOERROR answer without addresses (NODATA), the zone whose SOA record (see soaRecord) goes into the authority section. None to leave it out.
+Actions:
+Returns the bytes of the response, with the TC flag and no answers when it does not fit the payload size of the client.
+    '''
+    answers = []
+    for address in addresses:
+        record = answerRecord(query.type, address, ttl)
+        if record is not None:
+            answers.append(record)
+    authority = b""
+    if zone is not None and not answers and rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        authority = soaRecord(zone, ttl)
+    extendedRcode, rcode = divmod(rcode, 16)
+    flags = FLAG_QR | FLAG_RA | (query.flags & (OPCODE_MASK | FLAG_RD)) | rcode
+    opt = b""
+    if query.ednsPayload is not None:
+        opt = OPT_RECORD.pack(0, TYPE_OPT, EDNS_UDP_PAYLOAD, extendedRcode << 24, 0)
+    size = HEADER.size + len(query.question) + sum(map(len, answers)) + len(authority) + len(opt)
+    if size > (query.ednsPayload or MAX_UDP_PAYLOAD):
+        flags |= FLAG_TC
+        answers = []
+        authority = b""
+    header = HEADER.pack(query.id, flags, 1, len(answers), 1 if authority else 0, 1 if opt else 0)
+    return b"".join((header, query.question, *answers, authority, opt))
+
+
+def buildFormatError(data):
+    '''
+    Purpose: Writes the FORMERR response to a datagram parseQuery() could not read, or returns None when it has no header to answer.
+    '''
+    if len(data) < HEADER.size:
+        return None
+    queryId, flags = struct.unpack_from("!HH", data)
+    if flags & FLAG_QR:
+        return None  # Never answer a response, two servers could bounce errors at each other forever
+    return HEADER.pack(queryId, FLAG_QR | FLAG_RA | (flags & (OPCODE_MASK | FLAG_RD)) | RCODE_FORMERR, 0, 0, 0, 0)
@@ -1,76 +1,700 @@
+import asyncio
+import collections
+import itertools
+import logging
+import random
 import socket
+import struct
+import threading
+import time
+from serverLog import debug, debugEnabled
+from metrics import COUNTER, GAUGE
 
 LOCAL_HOST = "localhost"
 LOCAL_DNS_SERVER_PORT = 53
 ROOT_SERVER_PORT = 9001
 TLD_SERVER_PORT = 9002
 AUTHORITATIVE_SERVER_PORT = 9003
+LOCAL_SHARD_BASE_PORT = 9100  # Local DNS server worker i also listens on this port + i for queries of its cache shard
+# HTTP ports of the Prometheus metrics of every server (see metrics.py), worker i of a server uses the port + i
+LOCAL_METRICS_PORT = 9200
+ROOT_METRICS_PORT = 9210
+TLD_METRICS_PORT = 9220
+AUTHORITATIVE_METRICS_PORT = 9230
 BUFFER_SIZE = 65535
+DEFAULT_TTL = 300
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_MAX_IDLE_SOCKETS = 64
+HOP_TIMEOUT = 1.5  # Seconds to wait for the first answer of a server, doubled on every retry
+HOP_RETRIES = 2
+BACKOFF_JITTER = 0.2  # Every retry timeout is randomly moved by up to 20% so retries do not line up
+DNS_QUERY_TIMEOUT = 1.0  # Timeout of the dns.query.udp calls made by the root, TLD and authoritative servers
+DNS_RESOLVER_LIFETIME = 2.0  # Total time allowed for a dns.resolver lookup
+NXDOMAIN_RESPONSE = "NXDOMAIN"
+SERVFAIL_RESPONSE = "SERVFAIL"
+NODATA_RESPONSE = "NODATA"  # The name exists but has no address, cached like an address
+STATS_QUERY_NAME = "stats.local-dns.invalid"  # Asking the local DNS server for this name returns its counters as JSON
+NAME_SERVER_SEPARATOR = ","  # The nameServer of a ServerRequest can list every address of the zone, see joinAddresses()
+MAX_NAME_SERVER_LENGTH = 255  # encodeRequest() writes the length of nameServer in one byte
+MAX_DOMAIN_NAME_LENGTH = 253  # Longest domain name in text form, without the trailing dot (RFC 1035)
+VERBOSE_QUERY_PREFIX = "verbose "  # A text query starting with this gets a progress message before the answer
+LISTEN_HOSTS = (LOCAL_HOST, "::1")  # The servers listen on every address of these, over IPv4 and IPv6 (see bindDatagramSockets)
+MAX_DATAGRAMS_PER_WAKEUP = 64  # Datagrams read from one socket before the event loop gets to the other sockets and tasks
+
+# Protocol spoken between the local, root, TLD and authoritative servers.
+# Status codes reuse the DNS rcode numbers.
+PROTOCOL_VERSION = 3
+STATUS_NOERROR = 0
+STATUS_SERVFAIL = 2
+STATUS_NXDOMAIN = 3
+FLAG_HAS_MESSAGES = 0x01
+FLAG_HAS_ZONE = 0x02
+FLAG_WANT_MESSAGES = 0x01
+FLAG_WANT_AAAA = 0x02  # The request asks for the IPv6 addresses of the name instead of the IPv4 ones
+ADDRESS_TYPE_A = "A"
+ADDRESS_TYPE_AAAA = "AAAA"
+REQUEST_HEADER = struct.Struct("!BBI")  # version, flags, query id
+RESPONSE_HEADER = struct.Struct("!BBBIIB")  # version, status, flags, query id, ttl, address count
+MESSAGE_COUNT = struct.Struct("!H")
+MESSAGE_LENGTH = struct.Struct("!H")
+ADDRESS_FAMILIES = {4: socket.AF_INET, 16: socket.AF_INET6}
 # Note:
 # We could add the buffer size variable, one for sending and one for receiving,
 # I have only used one to keep it simple. And its size is based on the max size
 # of the receiving buffer.
 
+queryIds = itertools.count(random.getrandbits(32))
+log = logging.getLogger("helpers")
+transportStats = {"wakeups": 0, "received": 0, "flushes": 0, "sent": 0}  # Counters of every DatagramEndpoint of this process
+# How transportStats is published by Metrics.exportStats() (see metrics.py)
+TRANSPORT_METRICS = {
+    "wakeups": ("dns_socket_wakeups_total", COUNTER, "Times a socket was found readable by the event loop"),
+    "received": ("dns_datagrams_received_total", COUNTER, "Datagrams received, every wakeup reads all the waiting ones"),
+    "flushes": ("dns_send_flushes_total", COUNTER, "Times the queued datagrams were sent, once per turn of the event loop at most"),
+    "sent": ("dns_datagrams_sent_total", COUNTER, "Datagrams sent"),
+}
+# How the stats() of socketPool ("threads" mode) or upstreamPool ("asyncio" mode) are published by Metrics.exportStats()
+UPSTREAM_METRICS = {
+    "idle": ("dns_upstream_idle_sockets", GAUGE, "Idle sockets kept for the blocking lookups"),
+    "inUse": ("dns_upstream_sockets_in_use", GAUGE, "Sockets used by a blocking lookup right now"),
+    "endpoints": ("dns_upstream_endpoints", GAUGE, "Endpoints shared by the asyncio lookups, one per server"),
+    "inFlight": ("dns_upstream_requests_in_flight", GAUGE, "Requests waiting for their answer on the endpoints"),
+    "created": ("dns_upstream_sockets_created_total", COUNTER, "Sockets or endpoints opened to the other servers"),
+    "reused": ("dns_upstream_sockets_reused_total", COUNTER, "Lookups that reused an open socket or endpoint"),
+    "closed": ("dns_upstream_sockets_closed_total", COUNTER, "Sockets closed because the pool was full"),
+    "unmatched": ("dns_upstream_unmatched_responses_total", COUNTER, "Late or malformed responses that matched no request"),
+    "retransmissions": ("dns_upstream_retransmissions_total", COUNTER, "Requests sent again because no answer came in time"),
+    "timeouts": ("dns_upstream_timeouts_total", COUNTER, "Lookups given up after the last retry"),
+    "errors": ("dns_upstream_errors_total", COUNTER, "ICMP errors received by the endpoints, each failing one lookup"),
+}
+
 '''
-The helpers.py file contains various utility functions and constants shared among server and client scripts, such as printing messages, input validation, and socket configuration.
+The helpers.py file contains various utility functions and constants shared among server and client scripts, such as logging the messages of a lookup, input validation, and socket configuration.
 '''
 
 
 
-def customPrint(name, value):
+def enableReusePort(serverSocket):
     '''
-    Purpose: This function is a utility for printing messages with a specific format.
+    Purpose: Lets several worker processes bind the same port, so the kernel spreads the incoming datagrams over them.
 Parameters:
-name: A string representing the name of the variable or information being printed.
-value: The value to be printed.
-Actions: Prints the provided name, value, and the type of the value.
+serverSocket: The socket to configure, before it is bound.
+Actions:
+Sets SO_REUSEPORT, raising OSError on platforms that do not have it.
     '''
-    print()
-    print(name + ":")
-    print(value)
-    print(type(value))
-    print()
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
 
-def getInputForNextServer(listOfMessages):
+def getNegativeTtl(response):
     '''
-    Purpose: Extracts the IP address of the next server from a list of messages.
+    Purpose: Finds how long an NXDOMAIN answer may be cached.
 Parameters:
-listOfMessages: A list of messages received from a server.
+response: The dns.message.Message that carried the NXDOMAIN.
 Actions:
-Cleans up each message in the list by removing leading/trailing spaces and single quotes.
-Reverses the list and extracts the first element as the IP address of the next server.
-Returns the extracted IP address.
+Returns the smaller of the SOA record TTL and its minimum field from the authority section, or DEFAULT_NEGATIVE_TTL when there is no SOA.
+    '''
+    for resourceRecordSet in response.authority:
+        for resourceRecord in resourceRecordSet:
+            if hasattr(resourceRecord, "minimum"):
+                return min(resourceRecordSet.ttl, resourceRecord.minimum)
+    return DEFAULT_NEGATIVE_TTL
+
+
+def displayMessages(listOfMessages, logger):
+
+    '''
+    Purpose: Logs a list of messages, one record each, at DEBUG level (or for a traced query, see serverLog.debug).
+Parameters:
+listOfMessages: A list of messages to be logged, or None when the server did not send any.
+logger: The logger of the server logging them.
     '''
-    cleanList = []
+    if not listOfMessages or not debugEnabled(logger):
+        return
     for message in listOfMessages:
-        message = message.strip()
-        message = message.replace("'", "")
-        cleanList.append(message)
-    ipAddressOfTld = str
-    cleanList.reverse()
-    ipAddressOfTld = cleanList[0]
-    return ipAddressOfTld
+        debug(logger, "%s", message)
+
+
+class ProtocolError(ValueError):
+    '''
+    Raised when a datagram does not follow the protocol spoken between the servers.
+    '''
+
+
+class ServerFailure(Exception):
+    '''
+    Raised when a server could not answer a lookup, so the client should get SERVFAIL_RESPONSE.
+    '''
 
 
-def displayMessages(listOfMessages):
+class UpstreamTimeout(ServerFailure):
+    '''
+    Raised when a server did not answer before the last retry or the deadline of the lookup ran out.
+    '''
+
 
+def attemptTimeouts(timeout, retries, deadline=None):
     '''
-    Purpose: Prints a list of messages, cleaning up formatting.
+    Purpose: Yields how long each attempt of a lookup may wait for its answer.
 Parameters:
-listOfMessages: A list of messages to be printed.
+timeout: The timeout of the first attempt, in seconds.
+retries: How many times the request is sent again after the first attempt.
+deadline: The time.monotonic() reading by which the whole lookup must be done, or None.
 Actions:
-Cleans up each message in the list by removing leading/trailing spaces and single quotes.
-Prints each message.
+Doubles the timeout on every retry and moves it randomly by up to BACKOFF_JITTER.
+Cuts the last attempt short at the deadline and stops once it has passed.
     '''
-    for message in listOfMessages:
-        message = message.strip()
-        message = message.replace("'", "")
-        print(message)
-    print()
+    for attempt in range(retries + 1):
+        attemptTimeout = timeout * (2 ** attempt)
+        attemptTimeout *= random.uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            attemptTimeout = min(attemptTimeout, remaining)
+        yield attemptTimeout
+
+
+class ServerRequest:
+    '''
+    Purpose: A single, self-contained lookup request sent to a root, TLD or authoritative server.
+Attributes:
+queryId: Identifies the request, the server copies it into its ServerResponse.
+nameServer: The name server the receiving server should ask.
+name: The domain name being resolved.
+wantMessages: Whether the human readable messages of the lookup should be sent back.
+addressType: ADDRESS_TYPE_A or ADDRESS_TYPE_AAAA, the type of the addresses the authoritative server answers with (the root and TLD servers refer to the same servers for both).
+    '''
+    __slots__ = ("queryId", "nameServer", "name", "wantMessages", "addressType")
+
+    def __init__(self, queryId, nameServer, name, wantMessages=True, addressType=ADDRESS_TYPE_A):
+        self.queryId = queryId
+        self.nameServer = nameServer
+        self.name = name
+        self.wantMessages = wantMessages
+        self.addressType = addressType
+
+
+class ServerResponse:
+    '''
+    Purpose: The typed result a root, TLD or authoritative server sends back for one lookup.
+Attributes:
+status: STATUS_NOERROR, STATUS_NXDOMAIN or STATUS_SERVFAIL.
+ttl: How long the answer may be cached, in seconds.
+addresses: The IP addresses of the next server to ask (or the final IP Address for the authoritative server).
+messages: The optional human readable description of the lookup, None when it was not requested.
+queryId: The queryId of the ServerRequest being answered.
+zone: Set by the authoritative server when the name lies in a zone delegated below the one it was asked about ("sub.example.com."), addresses then are the name servers of that zone.
+    '''
+    __slots__ = ("status", "ttl", "addresses", "messages", "queryId", "zone")
+
+    def __init__(self, status=STATUS_NOERROR, ttl=DEFAULT_TTL, addresses=None, messages=None,
+                 queryId=0, zone=None):
+        self.status = status
+        self.ttl = ttl
+        self.addresses = addresses if addresses is not None else []
+        self.messages = messages
+        self.queryId = queryId
+        self.zone = zone
+
+
+def nextQueryId():
+    return next(queryIds) & 0xFFFFFFFF
+
+
+def encodeRequest(request):
+    '''
+    Purpose: Serializes a ServerRequest into one datagram.
+Parameters:
+request: The ServerRequest to send.
+Actions:
+Writes the version, flags and query id header, then the name server and the name, each prefixed with its length.
+Raises ProtocolError when the name server is longer than MAX_NAME_SERVER_LENGTH or the name (without its trailing dot) longer than MAX_DOMAIN_NAME_LENGTH bytes.
+    '''
+    flags = FLAG_WANT_MESSAGES if request.wantMessages else 0
+    if request.addressType == ADDRESS_TYPE_AAAA:
+        flags |= FLAG_WANT_AAAA
+    nameServer = request.nameServer.encode()
+    name = request.name.encode()
+    if len(nameServer) > MAX_NAME_SERVER_LENGTH:
+        raise ProtocolError(f"Name server is longer than {MAX_NAME_SERVER_LENGTH} bytes")
+    if len(name.removesuffix(b".")) > MAX_DOMAIN_NAME_LENGTH:
+        raise ProtocolError(f"Name is longer than {MAX_DOMAIN_NAME_LENGTH} bytes")
+    return b"".join((REQUEST_HEADER.pack(PROTOCOL_VERSION, flags, request.queryId),
+                     bytes((len(nameServer),)), nameServer, bytes((len(name),)), name))
+
+
+def decodeRequest(data):
+    '''
+    Purpose: Parses a datagram produced by encodeRequest back into a ServerRequest.
+Parameters:
+data: The bytes received from the client, or a memoryview of them (see DatagramEndpoint), the strings are decoded from it without copying it first.
+Actions:
+Raises ProtocolError when the version is unknown or the datagram is truncated.
+    '''
+    try:
+        version, flags, queryId = REQUEST_HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        offset = REQUEST_HEADER.size
+        length = data[offset]
+        nameServer = str(data[offset + 1:offset + 1 + length], "utf-8")
+        offset += 1 + length
+        length = data[offset]
+        name = str(data[offset + 1:offset + 1 + length], "utf-8")
+        if offset + 1 + length != len(data):
+            raise ProtocolError("Malformed request")
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ProtocolError("Truncated request") from error
+    return ServerRequest(queryId, nameServer, name, bool(flags & FLAG_WANT_MESSAGES),
+                         ADDRESS_TYPE_AAAA if flags & FLAG_WANT_AAAA else ADDRESS_TYPE_A)
+
+
+def encodeResponse(response):
+    '''
+    Purpose: Serializes a ServerResponse into a datagram.
+Parameters:
+response: The ServerResponse to send.
+Actions:
+Writes the version, status, flags, query id, TTL and address count header, then every address as a length byte followed by its packed form.
+Appends the zone of a referral prefixed with its length, and the messages, each prefixed with its length, only when the response carries them.
+    '''
+    flags = FLAG_HAS_MESSAGES if response.messages is not None else 0
+    if response.zone is not None:
+        flags |= FLAG_HAS_ZONE
+    parts = [RESPONSE_HEADER.pack(PROTOCOL_VERSION, response.status, flags, response.queryId,
+                                  response.ttl, len(response.addresses))]
+    for address in response.addresses:
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        packedAddress = socket.inet_pton(family, address)
+        parts.append(bytes((len(packedAddress),)))
+        parts.append(packedAddress)
+    if response.zone is not None:
+        zone = response.zone.encode()
+        parts.append(bytes((len(zone),)))
+        parts.append(zone)
+    if response.messages is not None:
+        parts.append(MESSAGE_COUNT.pack(len(response.messages)))
+        for message in response.messages:
+            encodedMessage = message.encode()
+            parts.append(MESSAGE_LENGTH.pack(len(encodedMessage)))
+            parts.append(encodedMessage)
+    return b"".join(parts)
+
+
+def decodeResponse(data):
+    '''
+    Purpose: Parses a datagram produced by encodeResponse back into a ServerResponse.
+Parameters:
+data: The bytes received from the server, or a memoryview of them.
+Actions:
+Raises ProtocolError when the version is unknown or the datagram is truncated.
+    '''
+    try:
+        version, status, flags, queryId, ttl, addressCount = RESPONSE_HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        offset = RESPONSE_HEADER.size
+        addresses = []
+        for _ in range(addressCount):
+            length = data[offset]
+            packedAddress = data[offset + 1:offset + 1 + length]
+            if length not in ADDRESS_FAMILIES or len(packedAddress) != length:
+                raise ProtocolError("Malformed address")
+            addresses.append(socket.inet_ntop(ADDRESS_FAMILIES[length], packedAddress))
+            offset += 1 + length
+        zone = None
+        if flags & FLAG_HAS_ZONE:
+            length = data[offset]
+            zone = str(data[offset + 1:offset + 1 + length], "utf-8")
+            offset += 1 + length
+        messages = None
+        if flags & FLAG_HAS_MESSAGES:
+            messages = []
+            (messageCount,) = MESSAGE_COUNT.unpack_from(data, offset)
+            offset += MESSAGE_COUNT.size
+            for _ in range(messageCount):
+                (length,) = MESSAGE_LENGTH.unpack_from(data, offset)
+                offset += MESSAGE_LENGTH.size
+                messages.append(str(data[offset:offset + length], "utf-8"))
+                offset += length
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ProtocolError("Truncated response") from error
+    return ServerResponse(status, ttl, addresses, messages, queryId, zone)
+
+
+class DatagramEndpoint:
+    '''
+    Purpose: Serves one or more UDP sockets from the event loop (epoll on Linux), in place of the transport of loop.create_datagram_endpoint().
+Parameters:
+datagramSockets: The bound (or connected) UDP sockets, like the IPv4 and IPv6 sockets of one port (see bindDatagramSockets).
+protocol: The asyncio.DatagramProtocol the datagrams of every socket are handed to, it gets this endpoint as its transport.
+Actions:
+Every time a socket is readable, receives all the datagrams waiting on it (up to MAX_DATAGRAMS_PER_WAKEUP) instead of one, with recvfrom_into into one buffer allocated once.
+datagram_received() gets a memoryview of that buffer, it is only valid until the handler returns, so the protocol has to decode (copy) what it keeps.
+sendto() only queues the datagram, the queue is flushed once per turn of the event loop, so the responses of every request handled in that turn go out together.
+A response goes out on the socket of the family of its address, which is the socket the request came in on.
+    '''
+
+    def __init__(self, datagramSockets, protocol, bufferSize=BUFFER_SIZE):
+        self.sockets = list(datagramSockets)
+        self.socketsByFamily = {}
+        for datagramSocket in reversed(self.sockets):
+            self.socketsByFamily[datagramSocket.family] = datagramSocket
+        self.protocol = protocol
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.waiting = collections.deque()  # (data, address) queued by sendto() and not sent yet
+        self.flushScheduled = False
+        self.blockedSocket = None  # The socket the queue waits on when it was full
+        self.closing = False
+        self.loop = asyncio.get_running_loop()
+        for datagramSocket in self.sockets:
+            datagramSocket.setblocking(False)
+            self.loop.add_reader(datagramSocket.fileno(), self.readReady, datagramSocket)
+        protocol.connection_made(self)
+
+    def readReady(self, datagramSocket):
+        transportStats["wakeups"] += 1
+        for _ in range(MAX_DATAGRAMS_PER_WAKEUP):
+            try:
+                length, address = datagramSocket.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.protocol.error_received(error)
+                return
+            transportStats["received"] += 1
+            self.protocol.datagram_received(self.view[:length], address)
+            if self.closing:
+                return
+
+    def socketFor(self, address):
+        if address is None or len(self.sockets) == 1:
+            return self.sockets[0]
+        family = socket.AF_INET6 if len(address) == 4 else socket.AF_INET
+        return self.socketsByFamily.get(family, self.sockets[0])
+
+    def sendto(self, data, address=None):
+        '''
+        Queues data for address, or for the peer of a connected socket when address is None.
+        '''
+        if self.closing:
+            return
+        # bytes() returns a response that already is bytes as it is, only views and bytearrays that may change are copied
+        self.waiting.append((bytes(data), address))
+        if not self.flushScheduled and self.blockedSocket is None:
+            self.flushScheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flushScheduled = False
+        if self.blockedSocket is not None:
+            self.loop.remove_writer(self.blockedSocket.fileno())
+            self.blockedSocket = None
+        if self.closing:
+            return
+        transportStats["flushes"] += 1
+        while self.waiting:
+            data, address = self.waiting[0]
+            datagramSocket = self.socketFor(address)
+            try:
+                if address is None:
+                    datagramSocket.send(data)
+                else:
+                    datagramSocket.sendto(data, address)
+            except (BlockingIOError, InterruptedError):
+                # The rest waits until the socket can take more
+                self.blockedSocket = datagramSocket
+                self.loop.add_writer(datagramSocket.fileno(), self.flush)
+                return
+            except OSError as error:
+                self.protocol.error_received(error)
+            else:
+                transportStats["sent"] += 1
+            self.waiting.popleft()
 
+    def is_closing(self):
+        return self.closing
 
-def actAsTemporaryClient(message, connectingPort, nameServer):
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.sockets[0].getpeername()
+        if name == "sockname":
+            return self.sockets[0].getsockname()
+        if name == "socket":
+            return self.sockets[0]
+        return default
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        if self.blockedSocket is not None:
+            self.loop.remove_writer(self.blockedSocket.fileno())
+            self.blockedSocket = None
+        for datagramSocket in self.sockets:
+            self.loop.remove_reader(datagramSocket.fileno())
+            datagramSocket.close()
+        self.waiting.clear()
+        self.protocol.connection_lost(None)
+
+
+def openDatagramEndpoint(makeProtocol, datagramSockets):
+    '''
+    Purpose: The counterpart of loop.create_datagram_endpoint(makeProtocol, sock=...) for DatagramEndpoint, to be called from the event loop.
+datagramSockets is a socket or a list of sockets served together.
+Returns the endpoint (the transport of the protocol) and the protocol.
+    '''
+    if isinstance(datagramSockets, socket.socket):
+        datagramSockets = [datagramSockets]
+    protocol = makeProtocol()
+    return DatagramEndpoint(datagramSockets, protocol), protocol
+
+
+def bindDatagramSockets(port, reusePort=False, hosts=LISTEN_HOSTS):
+    '''
+    Purpose: Binds a UDP socket to port on every address of hosts, so a server answers over IPv4 and IPv6 without a thread per socket (see DatagramEndpoint).
+Parameters:
+reusePort: Set by the workers started with --workers, so that all of them can bind the same port.
+Actions:
+Raises the OSError of the first host when it cannot be bound, like a single socket would.
+The addresses of the other hosts that cannot be bound (like ::1 on a machine without IPv6) are logged and left out.
+    '''
+    datagramSockets = []
+    boundAddresses = set()
+    for host in hosts:
+        try:
+            addressInfos = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+            for family, socketType, protocol, _, address in addressInfos:
+                if address in boundAddresses:
+                    continue
+                datagramSocket = socket.socket(family, socketType, protocol)
+                try:
+                    if family == socket.AF_INET6:
+                        # Both families are bound on their own sockets
+                        datagramSocket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                    if reusePort:
+                        enableReusePort(datagramSocket)
+                    datagramSocket.bind(address)
+                except OSError:
+                    datagramSocket.close()
+                    raise
+                boundAddresses.add(address)
+                datagramSockets.append(datagramSocket)
+        except OSError as error:
+            if host == hosts[0]:
+                for datagramSocket in datagramSockets:
+                    datagramSocket.close()
+                raise
+            log.warning("Not listening on %s port %s: %r", host, port, error)
+    return datagramSockets
+
+
+class SocketPool:
+    '''
+    Purpose: Keeps connected UDP sockets to the root, TLD and authoritative servers so that blocking lookups do not open a new socket every time.
+Parameters:
+maxIdlePerUpstream: How many idle sockets are kept for each server, extra ones are closed when they are given back.
+Actions:
+acquire() hands out an idle socket for the server (or connects a new one), release() puts it back for the next lookup.
+A socket is used by one thread at a time, responses left over from an earlier lookup are told apart by their query id.
+    '''
+
+    def __init__(self, maxIdlePerUpstream=DEFAULT_MAX_IDLE_SOCKETS):
+        self.maxIdlePerUpstream = maxIdlePerUpstream
+        self.idleSockets = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.inUse = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+
+    def acquire(self, connectingAddress):
+        with self.lock:
+            idle = self.idleSockets.get(connectingAddress)
+            self.inUse += 1
+            if idle:
+                self.reused += 1
+                return idle.pop()
+            self.created += 1
+        pooledSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        pooledSocket.connect(connectingAddress)
+        return pooledSocket
+
+    def release(self, connectingAddress, pooledSocket):
+        with self.lock:
+            self.inUse -= 1
+            idle = self.idleSockets.setdefault(connectingAddress, [])
+            if len(idle) < self.maxIdlePerUpstream:
+                idle.append(pooledSocket)
+                return
+            self.closed += 1
+        pooledSocket.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": sum(len(idle) for idle in self.idleSockets.values()),
+                "inUse": self.inUse,
+                "created": self.created,
+                "reused": self.reused,
+                "closed": self.closed,
+                "retransmissions": self.retransmissions,
+                "timeouts": self.timeouts,
+            }
+
+
+class UpstreamEndpoint(asyncio.DatagramProtocol):
+    '''
+    Purpose: A long-lived datagram endpoint to one server, shared by every lookup sent to it from the event loop.
+Actions:
+Keeps the future of every request in flight by query id and completes the matching one when a response arrives.
+Responses that match no request in flight (late or malformed ones) are counted and dropped.
+An ICMP error fails one request only, the others keep waiting for their answer or their own timeout.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # In the order the requests were first sent
+        self.unmatched = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = decodeResponse(data)
+        except ProtocolError:
+            self.unmatched += 1
+            return
+        future = self.pending.pop(response.queryId, None)
+        if future is None or future.done():
+            self.unmatched += 1
+            return
+        future.set_result((response, addr))
+
+    def error_received(self, exc):
+        # A connected UDP socket reports ICMP errors without telling which request caused them, and a late one
+        # (sent while the server restarted) must not fail the requests it answers now: fail the oldest request only
+        self.errors += 1
+        for queryId, future in self.pending.items():
+            if not future.done():
+                del self.pending[queryId]
+                future.set_exception(exc)
+                return
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Upstream endpoint closed"))
+        self.pending.clear()
+
+    async def query(self, request, timeout=HOP_TIMEOUT, retries=HOP_RETRIES, deadline=None):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request.queryId] = future
+        requestMessage = encodeRequest(request)
+        try:
+            for attempt, attemptTimeout in enumerate(attemptTimeouts(timeout, retries, deadline)):
+                if attempt > 0:
+                    self.retransmissions += 1
+                # The same query id is sent again, so a late answer to an earlier attempt still counts
+                self.transport.sendto(requestMessage)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), attemptTimeout)
+                except asyncio.TimeoutError:
+                    continue
+            self.timeouts += 1
+            raise UpstreamTimeout(f"No answer from {self.transport.get_extra_info('peername')}")
+        finally:
+            self.pending.pop(request.queryId, None)
+            if not future.done():
+                future.cancel()
+
+
+class UpstreamPool:
+    '''
+    Purpose: Hands out one UpstreamEndpoint per server for the running event loop, so all asyncio lookups to a server share one socket.
+Actions:
+Creates the endpoint (a connected socket served by a DatagramEndpoint) on first use and reuses it for every following lookup, keeping pool size and reuse counters.
+    '''
+
+    def __init__(self):
+        self.endpoints = {}
+        self.loop = None
+        self.created = 0
+        self.reused = 0
+
+    async def getEndpoint(self, connectingAddress):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Endpoints belong to the loop that created them
+            self.endpoints = {}
+            self.loop = loop
+        endpoint = self.endpoints.get(connectingAddress)
+        if endpoint is not None:
+            if not endpoint.transport.is_closing():
+                self.reused += 1
+                return endpoint
+            del self.endpoints[connectingAddress]
+        upstreamSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstreamSocket.connect(connectingAddress)
+        _, endpoint = openDatagramEndpoint(UpstreamEndpoint, upstreamSocket)
+        self.endpoints[connectingAddress] = endpoint
+        self.created += 1
+        return endpoint
+
+    def close(self):
+        for endpoint in self.endpoints.values():
+            endpoint.transport.close()
+        self.endpoints = {}
+
+    def stats(self):
+        return {
+            "endpoints": len(self.endpoints),
+            "inFlight": sum(len(endpoint.pending) for endpoint in self.endpoints.values()),
+            "created": self.created,
+            "reused": self.reused,
+            "unmatched": sum(endpoint.unmatched for endpoint in self.endpoints.values()),
+            "retransmissions": sum(endpoint.retransmissions for endpoint in self.endpoints.values()),
+            "timeouts": sum(endpoint.timeouts for endpoint in self.endpoints.values()),
+            "errors": sum(endpoint.errors for endpoint in self.endpoints.values()),
+        }
+
+
+socketPool = SocketPool()
+upstreamPool = UpstreamPool()
+receiveBuffers = threading.local()  # The buffer receiveResponse() reads into, one per thread of the "threads" mode
+
+
+def actAsTemporaryClient(message, connectingPort, nameServer, wantMessages=True,
+                         timeout=HOP_TIMEOUT, retries=HOP_RETRIES, deadline=None, addressType=ADDRESS_TYPE_A):
 
     '''
     Purpose: Simulates a temporary client by sending a DNS query to a specified DNS server.
@@ -78,23 +702,89 @@ Parameters:
 message: The DNS query message to be sent.
 connectingPort: The port to connect to on the DNS server.
 nameServer: The DNS server's address.
+wantMessages: Whether the server should send back the human readable messages of the lookup.
+timeout, retries, deadline: How long to wait for an answer, how often to send the request again, and when to give up (see attemptTimeouts).
+addressType: The type of the addresses asked for (see ServerRequest).
+Actions:
+Takes a connected UDP socket from socketPool, encodes the DNS server address and query message into one ServerRequest datagram, and sends it to the specified address and port.
+Receives and decodes the server's response with the same query id, returning it as a ServerResponse, and gives the socket back to the pool.
+Sends the request again with exponential backoff when no answer comes in time, and raises UpstreamTimeout when all attempts failed.
+    '''
+    request = ServerRequest(nextQueryId(), nameServer, message, wantMessages, addressType)
+    connectingAddress = (LOCAL_HOST, connectingPort)
+    requestMessage = encodeRequest(request)
+    response = None
+    pooledSocket = socketPool.acquire(connectingAddress)
+    try:
+        for attempt, attemptTimeout in enumerate(attemptTimeouts(timeout, retries, deadline)):
+            if attempt > 0:
+                with socketPool.lock:
+                    socketPool.retransmissions += 1
+            pooledSocket.send(requestMessage)
+            response = receiveResponse(pooledSocket, request.queryId, attemptTimeout)
+            if response is not None:
+                break
+    finally:
+        socketPool.release(connectingAddress, pooledSocket)
+    if response is None:
+        with socketPool.lock:
+            socketPool.timeouts += 1
+        raise UpstreamTimeout(f"No answer from {connectingAddress}")
+    debug(log, "Message from %s:", connectingAddress)
+    return response
+
+
+def receiveResponse(pooledSocket, queryId, timeout):
+    '''
+    Purpose: Waits up to timeout seconds for the response with the given query id on a connected socket.
+Actions:
+Drops malformed responses and responses to other (earlier) requests, returns None when the time runs out.
+Reads into the buffer of the calling thread instead of allocating one for every datagram.
+    '''
+    receiveBuffer = getattr(receiveBuffers, "view", None)
+    if receiveBuffer is None:
+        receiveBuffer = receiveBuffers.view = memoryview(bytearray(BUFFER_SIZE))
+    stopAt = time.monotonic() + timeout
+    while True:
+        remaining = stopAt - time.monotonic()
+        if remaining <= 0:
+            return None
+        pooledSocket.settimeout(remaining)
+        try:
+            length = pooledSocket.recv_into(receiveBuffer)
+        except socket.timeout:
+            return None
+        try:
+            response = decodeResponse(receiveBuffer[:length])
+        except ProtocolError:
+            continue
+        if response.queryId == queryId:
+            return response
+
+
+async def actAsTemporaryClientAsync(message, connectingPort, nameServer, wantMessages=True,
+                                    timeout=HOP_TIMEOUT, retries=HOP_RETRIES, deadline=None,
+                                    addressType=ADDRESS_TYPE_A):
+
+    '''
+    Purpose: The asyncio counterpart of actAsTemporaryClient, so that many queries can wait for their servers at the same time.
+Parameters:
+message: The DNS query message to be sent.
+connectingPort: The port to connect to on the DNS server.
+nameServer: The DNS server's address.
+wantMessages: Whether the server should send back the human readable messages of the lookup.
+timeout, retries, deadline: How long to wait for an answer, how often to send the request again, and when to give up (see attemptTimeouts).
+addressType: The type of the addresses asked for (see ServerRequest).
 Actions:
-Creates a UDP socket, encodes the DNS server address and query message, and sends them to the specified address and port.
-Receives and decodes the server's response, printing the message and returning a list of messages.
+Sends the ServerRequest datagram over the shared endpoint of upstreamPool and waits for the response with its query id without blocking the event loop.
+Returns the decoded ServerResponse, like actAsTemporaryClient.
     '''
-    tempClientSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    queryMessage = message.encode()
-    nameServer = nameServer.encode()
+    request = ServerRequest(nextQueryId(), nameServer, message, wantMessages, addressType)
     connectingAddress = (LOCAL_HOST, connectingPort)
-    tempClientSocket.sendto(nameServer, connectingAddress)
-    tempClientSocket.sendto(queryMessage, connectingAddress)
-    serverMessage, serverAddress = tempClientSocket.recvfrom(BUFFER_SIZE)
-    serverMessage = serverMessage.decode()
-    print()
-    print(f"Message from {serverAddress}:")
-    listOfMessages = serverMessage.strip('[]').split(',')
-    tempClientSocket.close()
-    return listOfMessages
+    endpoint = await upstreamPool.getEndpoint(connectingAddress)
+    response, serverAddress = await endpoint.query(request, timeout, retries, deadline)
+    debug(log, "Message from %s:", serverAddress)
+    return response
 
 
 def getInput(givenInput, numberOfWords):
@@ -116,6 +806,24 @@ Returns the constructed domain name
     return returningString
 
 
+def joinAddresses(addresses):
+    '''
+    Purpose: Joins the name server addresses of a zone into the nameServer of a ServerRequest, so the server asked can pick the fastest of them.
+Actions:
+Leaves out the last addresses when all of them do not fit in MAX_NAME_SERVER_LENGTH characters.
+    '''
+    joined = addresses[0]
+    for address in addresses[1:]:
+        if len(joined) + len(address) + 1 > MAX_NAME_SERVER_LENGTH:
+            break
+        joined += NAME_SERVER_SEPARATOR + address
+    return joined
+
+
+def splitAddresses(nameServer):
+    return nameServer.split(NAME_SERVER_SEPARATOR)
+
+
 def splitInput(userInput):
 
     '''
@@ -1,172 +1,441 @@
+import argparse
+import logging
+import asyncio
+import json
 import socket
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import dns
 import dns.resolver
-from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT, BUFFER_SIZE
+from helpers import LOCAL_HOST, LOCAL_DNS_SERVER_PORT
 from helpers import ROOT_SERVER_PORT
 from helpers import TLD_SERVER_PORT
 from helpers import AUTHORITATIVE_SERVER_PORT
-from helpers import splitInput
+from helpers import LOCAL_SHARD_BASE_PORT
+from helpers import LOCAL_METRICS_PORT
+from helpers import openDatagramEndpoint, bindDatagramSockets
+from helpers import transportStats, TRANSPORT_METRICS, UPSTREAM_METRICS
 from helpers import actAsTemporaryClient
+from helpers import actAsTemporaryClientAsync
+from helpers import socketPool, upstreamPool
 from helpers import displayMessages
-from helpers import getInputForNextServer
-from helpers import customPrint
-from helpers import getInput
+from helpers import joinAddresses, splitAddresses
+from helpers import ADDRESS_TYPE_A, ADDRESS_TYPE_AAAA
+from helpers import NXDOMAIN_RESPONSE, SERVFAIL_RESPONSE, NODATA_RESPONSE, STATS_QUERY_NAME, VERBOSE_QUERY_PREFIX
+from helpers import STATUS_NOERROR, STATUS_NXDOMAIN, STATUS_SERVFAIL
+from helpers import ServerRequest, ServerResponse, decodeRequest, encodeResponse, ProtocolError
+from helpers import ServerFailure, UpstreamTimeout
+from helpers import MAX_DOMAIN_NAME_LENGTH
+from helpers import HOP_TIMEOUT, HOP_RETRIES
+from dnsCache import DnsCache
+from dnsCache import DEFAULT_PREFETCH_FRACTION, DEFAULT_PREFETCH_MIN_HITS
+from dnsCache import DEFAULT_STALE_TTL
+from dnsCache import CACHE_METRICS
+from dnsCache import saveSnapshot, loadSnapshot
+from workers import runWorkers, DEFAULT_WORKERS
+from dnsWire import isWireQuery, parseQuery, buildResponse, buildFormatError, WireFormatError
+from dnsWire import RCODE_NOERROR, RCODE_SERVFAIL, RCODE_NXDOMAIN, RCODE_NOTIMP, RCODE_BADVERS
+from dnsWire import OPCODE_MASK, CLASS_IN, SUPPORTED_TYPES, TYPE_AAAA
+from zoneTrie import ZoneTrie
+from serverLog import configureLogging, addLoggingArguments, startTrace, debug, debugEnabled, tracingEnabled
+from metrics import Metrics, serveMetrics, rcodeLabels
+from metrics import COUNTER, GAUGE, HISTOGRAM, STAGE_DURATION, RESPONSES, IN_FLIGHT
 
-cache = {}
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = None  # No byte budget by default, only the entry count is bounded
+
+SERVING_MODES = ("asyncio", "threads")
+CLIENT_PROTOCOLS = ("auto", "dns", "text")  # "auto" answers DNS wire-format queries and text queries on the same port
+DEFAULT_MAX_IN_FLIGHT = 256
+RESOLUTION_DEADLINE = 5.0  # Seconds after which the client gets SERVFAIL_RESPONSE
+HOP_DURATION = "dns_hop_duration_seconds"
+HOP_RESPONSES = "dns_hop_responses_total"
+HOP_FAILURES = "dns_hop_failures_total"
+QUERY_DURATION = "dns_query_duration_seconds"
+CACHE_STAGE = (("stage", "cache"),)
+DEFAULT_SNAPSHOT_INTERVAL = 60.0  # Seconds between two snapshots of the cache
+# The servers asked with the name servers of the zone of i labels of a name (the root servers for i = 0), each hands out the name servers of the zone one label deeper, see resolveFromServers()
+DELEGATION_HOPS = ((ROOT_SERVER_PORT, "Root Result"), (TLD_SERVER_PORT, "TLD Result"))
+MAX_REFERRALS = 8  # Zones delegated below the one asked that one resolution follows
+# How serverStats, singleFlightStats and the lookups in flight are published
+LOCAL_SERVER_METRICS = {
+    "queries": ("dns_queries_total", COUNTER, "Client queries received"),
+    "malformed": ("dns_malformed_requests_total", COUNTER, "Client datagrams that were not a query this server answers"),
+    "servfails": ("dns_servfails_total", COUNTER, "Client queries that failed or missed their deadline"),
+    "forwarded": ("dns_shard_forwarded_total", COUNTER, "Client queries forwarded to the worker owning their cache shard"),
+    "forwardFailures": ("dns_shard_forward_failures_total", COUNTER, "Forwarded queries the other worker did not answer"),
+    "shardQueries": ("dns_shard_queries_total", COUNTER, "Queries forwarded to this worker by the other workers"),
+    "hopsSkipped": ("dns_hops_skipped_total", COUNTER, "Server lookups saved by the cache"),
+    "lookups": ("dns_upstream_lookups_total", COUNTER, "Lookups sent to the root, TLD and authoritative servers"),
+    "coalesced": ("dns_coalesced_lookups_total", COUNTER, "Lookups that waited for the same lookup already in flight"),
+    "inFlightLookups": ("dns_in_flight_lookups", GAUGE, "Lookups waiting for the root, TLD or authoritative server"),
+}
+
+log = logging.getLogger("localDnsServer")
+zoneTrie = ZoneTrie()  # The zones whose server is in the cache, see resolveQuery()
+cache = DnsCache(maxEntries=CACHE_MAX_ENTRIES, maxBytes=CACHE_MAX_BYTES, onRemove=zoneTrie.remove)
+servingMode = "asyncio"
+clientProtocol = "auto"
+maxInFlightQueries = DEFAULT_MAX_IN_FLIGHT
+upstreamExecutor = None  # Only set in "threads" mode, see runLocalDnsServer()
+wantMessages = True  # Ask the other servers for the human readable messages of every logged lookup
+hopTimeout = HOP_TIMEOUT
+hopRetries = HOP_RETRIES
+resolutionDeadline = RESOLUTION_DEADLINE
+backgroundTasks = set()  # Refresh-ahead lookups, referenced here so they are not garbage collected
+inFlightLookups = {}  # (port, searchKey) -> future of the lookup currently asking that server
+singleFlightStats = {"lookups": 0, "coalesced": 0}
+workerIndex = 0
+workerCount = 1
+shardCount = 1  # With cache sharding every worker caches the names of its own shard, see shardOf(), otherwise every name it is asked
+rootServerAddress = None  # The name servers the root DNS server asks (comma separated), set to the ones of the system resolver when the process starts serving
+metricsPort = LOCAL_METRICS_PORT  # Worker i serves its metrics on this port + i, 0 to not serve them
+inProcessServers = {}  # Port -> LookupServerProtocol of a server hosted in this process, asked without any socket (see allInOneServer.py)
+inProcessMetrics = []  # (Metrics, port) of the servers hosted in this process, served next to the metrics of this server
+snapshotFile = None  # Where the cache is saved to and loaded from, None to always start cold
+snapshotInterval = DEFAULT_SNAPSHOT_INTERVAL
+hopNames = {ROOT_SERVER_PORT: "root", TLD_SERVER_PORT: "tld", AUTHORITATIVE_SERVER_PORT: "authoritative"}
+hopLabels = {port: (("hop", hopName),) for port, hopName in hopNames.items()}
+serverStats = {"queries": 0, "malformed": 0, "servfails": 0, "forwarded": 0, "forwardFailures": 0, "shardQueries": 0,
+               "hopsSkipped": 0}
+NOERROR_LABELS = rcodeLabels(STATUS_NOERROR)
+clientResponseLabels = {NXDOMAIN_RESPONSE: rcodeLabels(STATUS_NXDOMAIN), SERVFAIL_RESPONSE: rcodeLabels(STATUS_SERVFAIL)}
+metrics = Metrics()
+metrics.describe(HOP_DURATION, HISTOGRAM, "Time spent asking the root, TLD and authoritative servers, by hop")
+metrics.describe(HOP_RESPONSES, COUNTER, "Answers of the root, TLD and authoritative servers, by hop and rcode")
+metrics.describe(HOP_FAILURES, COUNTER, "Lookups of a hop that got no usable answer (timeouts, errors), by hop")
+metrics.describe(QUERY_DURATION, HISTOGRAM, "Time from a client query to its answer")
+metrics.describe(STAGE_DURATION, HISTOGRAM, "Time spent looking names up in the cache")
+metrics.describe(RESPONSES, COUNTER, "Answers sent to clients, by rcode")
+metrics.describe(IN_FLIGHT, GAUGE, "Client queries being resolved or waiting for a free slot")
+metrics.exportStats(cache.stats, CACHE_METRICS)
+metrics.exportStats(lambda: transportStats, TRANSPORT_METRICS)
+metrics.exportStats(lambda: upstreamStats(), UPSTREAM_METRICS)
+metrics.exportStats(lambda: dict(serverStats, **singleFlightStats, inFlightLookups=len(inFlightLookups)),
+                    LOCAL_SERVER_METRICS)
 
 
 def fetchFromCache(searchKey):
-    ipAddress = cache.get(searchKey)
-    print(f"\"{searchKey}\" found in cache")
-    print(f"IP Address of \"{searchKey}\" is \"{ipAddress}\"")
-    return ipAddress
+    startedAt = time.perf_counter()
+    entry = cache.get(searchKey)
+    metrics.observe(STAGE_DURATION, time.perf_counter() - startedAt, CACHE_STAGE)
+    if entry is None:
+        return None
+    debug(log, "\"%s\" found in cache", searchKey)
+    if entry.negative:
+        debug(log, "\"%s\" does not exist (cached)", searchKey)
+    else:
+        debug(log, "IP Address of \"%s\" is \"%s\"", searchKey, entry.value)
+    return entry
+
 
+def storeInCache(searchKey, ipAddress, ttl):
+    if ipAddress is None:
+        cache.putNegative(searchKey, ttl)
+    else:
+        cache.put(searchKey, ipAddress, ttl)
+    if searchKey.endswith(".") and searchKey in cache.entries:
+        # Zone keys (ending with a dot) are indexed by the trie, final answers are looked up directly
+        zoneTrie.insert(searchKey)
 
-def generalServerHandler(userInput, nameServer, connectedPort, message):
-    result = actAsTemporaryClient(userInput, connectedPort, nameServer)
+
+async def generalServerHandler(userInput, nameServer, connectedPort, message, deadline=None,
+                               addressType=ADDRESS_TYPE_A):
+    labels = hopLabels[connectedPort]
+    # The messages of the servers are only asked for when they will be logged
+    askForMessages = wantMessages and debugEnabled(log)
+    startedAt = time.perf_counter()
+    try:
+        inProcessServer = inProcessServers.get(connectedPort)
+        if inProcessServer is not None:
+            result = await askInProcess(inProcessServer, userInput, nameServer, askForMessages, deadline, addressType)
+        elif upstreamExecutor is None:
+            result = await actAsTemporaryClientAsync(
+                userInput, connectedPort, nameServer, askForMessages, hopTimeout, hopRetries, deadline, addressType)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                upstreamExecutor, actAsTemporaryClient, userInput, connectedPort, nameServer,
+                askForMessages, hopTimeout, hopRetries, deadline, addressType)
+    except BaseException:
+        metrics.increment(HOP_FAILURES, labels)
+        raise
+    finally:
+        metrics.observe(HOP_DURATION, time.perf_counter() - startedAt, labels)
+    metrics.increment(HOP_RESPONSES, labels + rcodeLabels(result.status))
     '''
     The actAsTemporaryClient function is called to simulate a DNS query to the specified nameServer at the given connectedPort. The result is stored in the result variable.
+    In "asyncio" mode the same query is made by actAsTemporaryClientAsync without blocking the event loop, in "threads" mode the blocking actAsTemporaryClient runs on the thread pool.
     '''
-    print(message + ":")
+    debug(log, "%s:", message)
 
     '''
-    A message indicating the type of server (e.g., Root, TLD, Authoritative) is printed, and the displayMessages function is used to print the details of the DNS query result.
+    A message indicating the type of server (e.g., Root, TLD, Authoritative) is logged, and the displayMessages function is used to log the details of the DNS query result.
     '''
 
-    displayMessages(result)
-    ipAddress = getInputForNextServer(result)
+    displayMessages(result.messages, log)
+    if result.status == STATUS_NXDOMAIN:
+        debug(log, "Returned NXDOMAIN")
+        return None, result.ttl
+    if connectedPort == AUTHORITATIVE_SERVER_PORT and result.status == STATUS_NOERROR and not result.addresses:
+        # The name exists without an address (like the apex of a zone), cached for the TTL of the answer
+        debug(log, "Returned no IP Address (NODATA)")
+        return NODATA_RESPONSE, result.ttl
+    if result.status != STATUS_NOERROR or not result.addresses:
+        raise ServerFailure(f"{message} for \"{userInput}\" failed with status {result.status}")
+    if result.zone is not None:
+        # A referral to the name servers of a zone below the one asked, see resolveFromServers()
+        debug(log, "Referred to the servers of \"%s\"", result.zone)
+        return Referral(result.zone.lower(), joinAddresses(result.addresses), result.ttl), result.ttl
+    # Every address of the name, or every name server of the zone (the next hop asks the fastest of them, see nameServerSelection.py)
+    ipAddress = joinAddresses(result.addresses)
 
     '''
-    The getInputForNextServer function is called to extract the IP address for the next server from the result. This IP address is typically used in the next step of the DNS resolution process.
+    The result carries the IP address for the next server as a typed field. This IP address is typically used in the next step of the DNS resolution process, it is the IP address of the server to which the next DNS query should be directed.
     '''
 
+    debug(log, "Returned IP Address : %s", ipAddress)
+    return ipAddress, result.ttl
+
+
+class Referral:
     '''
-    In the context of the getInputForNextServer function, it is responsible for extracting the IP address of the server to which the next DNS query should be directed.
+    The answer of the authoritative server when the name lies in a zone delegated below the one it was asked about.
+zone: The cache key of that zone ("sub.example.com.").
+nameServers: The addresses of its name servers, joined like the other zone entries of the cache (see joinAddresses).
+ttl: How long they may be cached.
     '''
+    __slots__ = ("zone", "nameServers", "ttl")
 
-    print("Returned IP Address :", ipAddress)
-    return ipAddress
+    def __init__(self, zone, nameServers, ttl):
+        self.zone = zone
+        self.nameServers = nameServers
+        self.ttl = ttl
 
 
-def localDnsServer():
+async def askInProcess(server, userInput, nameServer, askForMessages, deadline=None, addressType=ADDRESS_TYPE_A):
     '''
-    Binds and listens on a UDP socket for the local DNS server.
-Handles incoming client requests, performs root, TLD, and authoritative server lookups.
-Maintains a cache to store intermediate results.
-Sends the final IP address back to the client.
+    Asks a server hosted in this process (see allInOneServer.py) by calling it directly: no datagram, no encoding and no retries.
+Raises UpstreamTimeout when deadline passes first, like a server that does not answer.
     '''
-    localDnsServerSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # try:
-    localDnsServerSocket.bind((LOCAL_HOST, LOCAL_DNS_SERVER_PORT))
-    print(
-        f"localDNS is up and running and I am listening at Port:{LOCAL_DNS_SERVER_PORT}")
-    while True:
-        clientMessage, clientAddress = localDnsServerSocket.recvfrom(
-            BUFFER_SIZE)
-        userInput = clientMessage.decode()
-        print(f"Talking to the Client at the Address:{clientAddress}")
-        print(f"Client Message:{userInput}")
-        message = f"Hang in there client, I will get the IP Address of the \"{userInput}\""
-        message = message.encode()
-        '''
-        
-The line message = message.encode() is encoding the string variable message into bytes. In Python, strings are Unicode by default, and encoding is the process of converting a Unicode string into a sequence of bytes using a specific encoding scheme.
+    request = ServerRequest(0, nameServer, userInput, askForMessages, addressType)
+    remaining = None if deadline is None else deadline - time.monotonic()
+    try:
+        return await asyncio.wait_for(server.answer(request), remaining)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout(f"No answer for \"{userInput}\" before the deadline") from None
 
 
-In network communication, data is transmitted between devices as a sequence of bytes. Textual data, such as strings, needs to be converted into a format that can be transmitted over the network, and this conversion is done through encoding
+async def lookupAndCache(searchKey, userInput, nameServer, connectedPort, message, deadline=None,
+                         addressType=ADDRESS_TYPE_A):
+    '''
+    Asks the server at connectedPort about userInput and stores the answer in the cache under searchKey.
+Concurrent lookups of the same searchKey on the same server are coalesced: only the first one sends a query, the others wait for its result.
+Returns the IP addresses from the answer (see joinAddresses), or None when the server reported NXDOMAIN.
+addressType is the type of the addresses the authoritative server is asked for.
+A Referral is returned without being cached, the caller stores it under the key of its zone once it checked it.
+    '''
+    flightKey = (connectedPort, searchKey)
+    pendingLookup = inFlightLookups.get(flightKey)
+    if pendingLookup is not None:
+        singleFlightStats["coalesced"] += 1
+        debug(log, "Waiting for the lookup of \"%s\" that is already in flight", searchKey)
+        return await asyncio.shield(pendingLookup)
+    singleFlightStats["lookups"] += 1
+    pendingLookup = asyncio.get_running_loop().create_future()
+    # Nobody may be waiting on it, so retrieve the exception here to keep asyncio quiet
+    pendingLookup.add_done_callback(
+        lambda future: future.cancelled() or future.exception())
+    inFlightLookups[flightKey] = pendingLookup
+    try:
+        ipAddress, ttl = await generalServerHandler(
+            userInput, nameServer, connectedPort, message, deadline, addressType)
+        if not isinstance(ipAddress, Referral):
+            storeInCache(searchKey, ipAddress, ttl)
+        pendingLookup.set_result(ipAddress)
+        return ipAddress
+    except asyncio.CancelledError:
+        # The waiting lookups have their own deadlines, let them fail instead of being cancelled
+        pendingLookup.set_exception(ServerFailure(f"Lookup of \"{searchKey}\" was abandoned"))
+        raise
+    except Exception as error:
+        pendingLookup.set_exception(error)
+        raise
+    finally:
+        del inFlightLookups[flightKey]
 
-        '''
-        localDnsServerSocket.sendto(message, clientAddress)
-        '''     
-The line localDnsServerSocket.sendto(message, clientAddress) is sending a message (in the form of bytes) from the local DNS server to the client address using a UDP (User Datagram Protocol) socket.
-        '''
-        defaultResolver = dns.resolver.get_default_resolver()
-        '''  
-The line defaultResolver = dns.resolver.get_default_resolver() is creating an instance of the default DNS resolver provided by the dnspython library. In DNS (Domain Name System), a resolver is responsible for making DNS queries and resolving domain names to their corresponding IP addresses.
 
-dns.resolver: This is a module in the dnspython library that provides functionality for making DNS queries.
+async def lookupOrServeStale(searchKey, userInput, nameServer, connectedPort, message, deadline=None,
+                             addressType=ADDRESS_TYPE_A):
+    '''
+    Like lookupAndCache, but falls back to an expired cache entry for searchKey (RFC 8767 serve-stale).
+When such an entry exists and the server does not answer within one hop timeout, or fails, the stale value is returned right away.
+The lookup keeps running in the background and updates the cache if it succeeds later.
+    '''
+    staleEntry = cache.getStale(searchKey)
+    if staleEntry is None:
+        return await lookupAndCache(searchKey, userInput, nameServer, connectedPort, message, deadline, addressType)
+    return await raceWithStale(staleEntry, searchKey, lookupAndCache(
+        searchKey, userInput, nameServer, connectedPort, message, deadline, addressType))
 
-dns.resolver.get_default_resolver(): This is a function that returns the default DNS resolver configured on the system. The default resolver is typically used to handle DNS queries unless a specific resolver is specified.
 
-defaultResolver: This variable is assigned the instance of the default DNS resolver. It can be used to make DNS queries and resolve domain names.
+async def raceWithStale(staleEntry, searchKey, lookup):
+    '''
+    Awaits the lookup coroutine, but returns the value of staleEntry (the expired cache entry of searchKey) when the lookup fails or has not succeeded within one hop timeout.
+The lookup keeps running in the background and updates the cache if it succeeds later.
+    '''
+    lookup = asyncio.ensure_future(lookup)
+    backgroundTasks.add(lookup)
+    lookup.add_done_callback(backgroundTasks.discard)
+    # Nobody may be waiting on it anymore, so retrieve the exception here to keep asyncio quiet
+    lookup.add_done_callback(lambda future: future.cancelled() or future.exception())
+    try:
+        return await asyncio.wait_for(asyncio.shield(lookup), hopTimeout)
+    except (asyncio.TimeoutError, ServerFailure, OSError) as error:
+        log.warning("Serving stale \"%s\" because the lookup did not succeed: %r", searchKey, error)
+        cache.staleServed()
+        return staleEntry.value
 
 
-In the provided code, defaultResolver is a variable that holds an instance of the default DNS resolver provided by the dnspython library
+def refreshAhead(entry, searchKey, userInput, nameServer, connectedPort, message, addressType=ADDRESS_TYPE_A):
+    '''
+    Starts a background lookup of searchKey when the cache says the entry is hot and close to expiring.
+The client is answered from the cache right away, the new answer replaces the entry when the lookup finishes.
+    '''
+    if not cache.shouldRefresh(entry):
+        return
+    debug(log, "Refreshing \"%s\" ahead of its expiry", searchKey)
+    task = asyncio.ensure_future(refreshEntry(
+        searchKey, userInput, nameServer, connectedPort, message, addressType))
+    backgroundTasks.add(task)
+    task.add_done_callback(backgroundTasks.discard)
 
-        '''
 
+async def refreshEntry(searchKey, userInput, nameServer, connectedPort, message, addressType=ADDRESS_TYPE_A):
+    try:
+        await lookupAndCache(searchKey, userInput, nameServer, connectedPort, message,
+                             time.monotonic() + resolutionDeadline, addressType)
+    except Exception as error:
+        log.warning("Could not refresh \"%s\": %r", searchKey, error)
+        cache.refreshFailed(searchKey)
 
-        
 
-        rootNameServer = defaultResolver.nameservers[0]
+async def resolveQuery(userInput, deadline=None, addressType=ADDRESS_TYPE_A):
+    '''
+    Performs the root, TLD, and authoritative server lookups for a single client query.
+deadline is the time.monotonic() reading by which every lookup must be done.
+addressType is the type of the addresses asked for, the answers of each type are cached under their own key (see answerKey).
+Answers from the cache when it holds the final answer, otherwise starts from the deepest zone whose server is cached (found with zoneTrie), skipping the servers above it.
+Stores every intermediate result in the cache.
+Returns the final IP addresses (see joinAddresses), NXDOMAIN_RESPONSE when the domain does not exist, or NODATA_RESPONSE when it has no address of addressType.
+    '''
 
-        '''
+    '''
 
-        In the context of the Domain Name System (DNS), nameservers are specialized servers on the internet that store DNS information and help in the process of translating human-readable domain names (like www.example.com) into numerical IP addresses (like 192.168.1.1).
+    In the context of the Domain Name System (DNS), nameservers are specialized servers on the internet that store DNS information and help in the process of translating human-readable domain names (like www.example.com) into numerical IP addresses (like 192.168.1.1).
 
-        There are different types of nameservers, including:
+    There are different types of nameservers, including:
 
-        Root Nameservers: These are the highest-level nameservers in the DNS hierarchy. They provide information about the Top-Level Domain (TLD) nameservers.
+    Root Nameservers: These are the highest-level nameservers in the DNS hierarchy. They provide information about the Top-Level Domain (TLD) nameservers.
 
-        Top-Level Domain (TLD) Nameservers: These nameservers handle the next level of the hierarchy, representing domain extensions like .com, .org, .net, etc.
+    Top-Level Domain (TLD) Nameservers: These nameservers handle the next level of the hierarchy, representing domain extensions like .com, .org, .net, etc.
 
-        Authoritative Nameservers: These are nameservers designated to store and provide authoritative information about specific domains. Each domain has its set of authoritative nameservers.
+    Authoritative Nameservers: These are nameservers designated to store and provide authoritative information about specific domains. Each domain has its set of authoritative nameservers.
 
-        Recursive Nameservers: These nameservers perform the task of resolving queries on behalf of clients by recursively querying other nameservers in the DNS hierarchy until the final IP address is obtained.
+    Recursive Nameservers: These nameservers perform the task of resolving queries on behalf of clients by recursively querying other nameservers in the DNS hierarchy until the final IP address is obtained.
+    '''
 
 
-        defaultResolver: This variable holds an instance of the default DNS resolver provided by the dnspython library. A DNS resolver is responsible for making DNS queries to resolve domain names to their corresponding IP addresses.
+    cachedAnswer = answerFromCache(userInput, addressType)
+    if cachedAnswer is not None:
+        return cachedAnswer
+    userInput = userInput.rstrip(".").lower()
+    labels = userInput.split(".")
+    searchKey = answerKey(userInput, addressType)
+    resolution = resolveFromServers(userInput, labels, deadline, addressType)
+    staleAnswer = cache.getStale(searchKey)
+    if staleAnswer is None:
+        return await resolution
+    # Serve the expired answer after one hop timeout of the whole resolution, not one per server on the way
+    finalIpAddress = await raceWithStale(staleAnswer, searchKey, resolution)
+    return NXDOMAIN_RESPONSE if finalIpAddress is None else finalIpAddress
 
-        defaultResolver.nameservers: This attribute of the resolver contains a list of IP addresses representing the nameservers that the resolver is configured to use. Nameservers are servers that hold DNS information, and the resolver queries them to obtain the necessary information.
 
-        [0]: The [0] indexing is used to access the first item in the list of nameservers. In DNS resolution, the root DNS server is typically the initial point of contact in the hierarchy.
+def answerFromCache(userInput, addressType=ADDRESS_TYPE_A):
+    '''
+    Returns the answer for userInput when none of the servers has to be asked: the cached IP addresses, NXDOMAIN_RESPONSE or NODATA_RESPONSE, or None when the answer is not cached.
+Starts refreshing a hot answer ahead of its expiry.
+It does not wait for anything, so the queries answered from the cache need no task (see LocalDnsServerProtocol.answerFromCacheNow).
+    '''
+    userInput = userInput.rstrip(".").lower()  # Names are cached case-insensitively, the final answer under the name itself
+    if not userInput:
+        # The root zone has no address, and there is no zone above it to ask
+        return NODATA_RESPONSE
+    labels = userInput.split(".")
+    searchKey = answerKey(userInput, addressType)
+    cachedAnswer = fetchFromCache(searchKey)
+    if cachedAnswer is None:
+        return None
+    # The final answer is still cached, none of the servers has to be asked
+    serverStats["hopsSkipped"] += delegationHops(labels) + 1
+    zoneCut, depth = zoneTrie.deepestCut(userInput, cache.__contains__)
+    zoneEntry = cache.peek(zoneCut) if depth >= delegationHops(labels) else None
+    if zoneEntry is not None and not zoneEntry.negative:
+        refreshAhead(cachedAnswer, searchKey, userInput, zoneEntry.value,
+                     AUTHORITATIVE_SERVER_PORT, "Authoritative Result (refresh)", addressType)
+    return NXDOMAIN_RESPONSE if cachedAnswer.negative else cachedAnswer.value
 
-        rootNameServer: This variable is assigned the IP address of the root DNS server. The root DNS server is a crucial part of the DNS infrastructure, and it provides information about the Top-Level Domain (TLD) servers.
-        '''
 
+def cachedInThisWorker(userInput, addressType=ADDRESS_TYPE_A):
+    '''
+    Returns the cache entry of the final answer for userInput when it is in the cache of this worker and has not expired, without counting a hit or a miss, None otherwise.
+    '''
+    if shardCount > 1 and shardOf(userInput) != workerIndex:
+        return None
+    return cache.peek(answerKey(userInput.rstrip(".").lower(), addressType))
 
-        splitResult = splitInput(userInput)
 
-        '''
-        Original User Input: subdomain.example.com
-        Split Subdomains: ['subdomain', 'example', 'com']
-        '''
+def answerKey(userInput, addressType):
+    # The cache key of the final answer: the name itself for its A addresses, "www.example.com/AAAA" for the others
+    return userInput if addressType == ADDRESS_TYPE_A else f"{userInput}/{addressType}"
 
 
-        splitResult.reverse()
-        rootInput, tldInput, *_ = splitResult
-        tldInput = tldInput + "." + rootInput
+def delegationHops(labels):
+    # How many of DELEGATION_HOPS lead to the zone the authoritative server is asked with: none for the root zone, only the root server for "com"
+    return min(len(labels), len(DELEGATION_HOPS))
 
-        '''
-        rootInput: com
-        tldInput: example.subdomain
-        _ (ignored): []
-        '''
 
-        authoritativeInput = getInput(userInput, len(splitResult))
-        authoritativeInput = authoritativeInput[:-1]
-        '''
-        The user input "subdomain.example.com" is split into subdomains, resulting in splitResult as ['subdomain', 'example', 'com'].
+def zoneKey(labels, depth):
+    # The cache key of the zone made of the last depth labels of a name: "example.com." for depth 2 of www.example.com
+    return ".".join(labels[len(labels) - depth:]) + "."
 
-        The getInput function generates the authoritativeInput by concatenating the subdomains in reverse order with dots between them. The resulting string is 'com.example.subdomain'.
 
-        The last character ('n') is then removed from authoritativeInput using slicing ([:-1]), resulting in the final authoritativeInput string: 'com.example.subdomain'
-        '''
-        customPrint("rootInput", rootInput)
-        customPrint("tldInput", tldInput)
-        customPrint("_", _) # _ (ignored): []
-        customPrint("authoritativeInput", authoritativeInput)
-        if bool(cache) and rootInput in cache:
+async def resolveFromServers(userInput, labels, deadline=None, addressType=ADDRESS_TYPE_A):
+    '''
+    Asks the root, TLD and authoritative servers for userInput (split into its labels), starting from the deepest zone whose server is cached, and returns the final IP addresses of addressType or NXDOMAIN_RESPONSE.
+Follows the referrals of the authoritative server to the zones delegated below the one it was asked about, and caches them as deeper zones of the trie.
+    '''
+    nameServer = rootServerAddress
+    depth = 0
+    zoneCut, cutDepth = zoneTrie.deepestCut(userInput, cache.__contains__)
+    cachedEntry = fetchFromCache(zoneCut) if zoneCut is not None else None
+    debug(log, "Deepest known zone of \"%s\": %s", userInput, zoneCut)
+    if cachedEntry is not None:
 
-            # pass the root input which is com in this case as key and returns IP address 
+        # Start from the deepest zone whose server is known: "example.com." skips the root and TLD servers, "com." only the root server
 
-            tldNameServer = fetchFromCache(rootInput)
-        else:
+        if cachedEntry.negative:
+            return NXDOMAIN_RESPONSE
+        depth = cutDepth
+        nameServer = cachedEntry.value
+        serverStats["hopsSkipped"] += min(depth, delegationHops(labels))
+        refreshZoneAhead(cachedEntry, labels, depth, userInput)
 
 
 
-            '''
-            Let’s take a look at a simple example. Suppose the host cse.nyu.edu desires 
+    '''
+    Let’s take a look at a simple example. Suppose the host cse.nyu.edu desires 
 the IP address of gaia.cs.umass.edu. Also suppose that NYU’s local DNS 
 server for cse.nyu.edu is called dns.nyu.edu and that an authoritative DNS 
 server for gaia.cs.umass.edu is called dns.umass.edu. As shown in 
@@ -179,60 +448,603 @@ servers. The TLD server takes note of the umass.edu suffix and responds with
 the IP address of the authoritative DNS server for the University of Massachusetts, 
 namely, dns.umass.edu. Finally, the local DNS server resends the query messsage directly to dns.umass.edu, which responds with the IP address of gaia 
 .cs.umass.edu
-            '''
+    '''
 
 
 
-            rootMessage = "Root Result"
-            tldNameServer = generalServerHandler(
-                userInput, rootNameServer, ROOT_SERVER_PORT, rootMessage) # PERFORM A DNS QUERY TO ROOT SERVER
-            '''
-            If the root input is not found in the cache, the generalServerHandler function is called to perform a DNS query to the root server. The result (tldNameServer) is then stored in the cache
+    while depth < delegationHops(labels):
+        connectedPort, message = DELEGATION_HOPS[depth]
+        depth += 1
+        nameServer = await lookupOrServeStale( # PERFORM A DNS QUERY TO THE ROOT OR TLD SERVER
+            zoneKey(labels, depth), userInput, nameServer, connectedPort, message, deadline)
+        '''
+        generalServerHandler (called through lookupOrServeStale and lookupAndCache) sends the DNS query to the root server, which returns the IP addresses of the TLD servers ("com."), then to the TLD server, which returns the IP addresses of the authoritative servers ("example.com."). Each result is stored in the cache and indexed by zoneTrie.
+        '''
+        if nameServer is None:
+            return NXDOMAIN_RESPONSE
+    authoritativeMessage = "Authoritative Result"
+    for _ in range(MAX_REFERRALS + 1):
+        finalIpAddress = await lookupOrServeStale( # PERFORM A DNS QUERY TO AUTHORITATIVE SERVER
+            answerKey(userInput, addressType), userInput, nameServer, AUTHORITATIVE_SERVER_PORT, authoritativeMessage,
+            deadline, addressType)
+        if not isinstance(finalIpAddress, Referral):
+            break
+        referralDepth = len(finalIpAddress.zone.rstrip(".").split("."))
+        if referralDepth <= depth or referralDepth > len(labels) or zoneKey(labels, referralDepth) != finalIpAddress.zone:
+            raise ServerFailure(f"Referral of \"{userInput}\" to \"{finalIpAddress.zone}\" does not lead below the zone asked")
+        # The name lies in a zone delegated below the one asked, its servers are asked next and cached as a deeper zone cut
+        storeInCache(finalIpAddress.zone, finalIpAddress.nameServers, finalIpAddress.ttl)
+        depth = referralDepth
+        nameServer = finalIpAddress.nameServers
+    else:
+        raise ServerFailure(f"More than {MAX_REFERRALS} referrals for \"{userInput}\"")
 
-            generalServerHandler calls  actAsTemporaryClient which sends the DNS query to the root server
-            '''
-        cache[rootInput] = tldNameServer
-        tldMessage = "TLD Result"
-        authoritativeServer = generalServerHandler( # PERFORM A DNS QUERY TO TLD SERVER
-            userInput, tldNameServer, TLD_SERVER_PORT, tldMessage)
-        
+    '''
+    The generalServerHandler function is called again, this time to perform the DNS resolution process for the authoritative DNS server. It simulates a DNS query to the authoritative server, retrieves the result, and returns the final IP address associated with the user's input. The obtained IP address is stored in the finalIpAddress variable.
+    '''
+
+
+    if debugEnabled(log):
+        # Building these dictionaries costs as much as the lookup, only do it when they are logged
+        debug(log, "cache: %s", cache.stats())
+        debug(log, "singleFlight: %s", dict(singleFlightStats))
+        debug(log, "zoneTrie: %s", {"zones": len(zoneTrie), "hopsSkipped": serverStats["hopsSkipped"]})
+        debug(log, "upstreamSockets: %s", upstreamStats())
+    if finalIpAddress is None:
+        return NXDOMAIN_RESPONSE
+    debug(log, "Final IP Address : %s", finalIpAddress)
+    return finalIpAddress
+
+
+def refreshZoneAhead(entry, labels, depth, userInput):
+    '''
+    Refreshes the cached name servers of the zone of depth labels ahead of their expiry, by asking the server that handed them out with the name servers of the zone above.
+The zones learned from referrals are not refreshed ahead, they are asked for again once they expired.
+    '''
+    if depth > delegationHops(labels):
+        return
+    connectedPort, message = DELEGATION_HOPS[depth - 1]
+    nameServer = rootServerAddress
+    if depth > 1:
+        parentEntry = cache.peek(zoneKey(labels, depth - 1))
+        if parentEntry is None or parentEntry.negative:
+            return
+        nameServer = parentEntry.value
+    refreshAhead(entry, zoneKey(labels, depth), userInput, nameServer, connectedPort, message + " (refresh)")
+
+
+def answerTtl(userInput, addressType=ADDRESS_TYPE_A):
+    '''
+    Returns how many more seconds the final answer for userInput stays in the cache, the TTL of DNS wire-format answers.
+Answers resolved by another worker are not in this cache, that worker sends their TTL along (see forwardToShard).
+    '''
+    entry = cache.peek(answerKey(userInput.rstrip(".").lower(), addressType))
+    return max(0, int(entry.expiresAt - cache.clock())) if entry is not None else 0
+
+
+def negativeAnswerZone(userInput):
+    '''
+    Returns the zone the SOA record of a negative wire-format answer for userInput is owned by: the deepest zone of the name whose servers are cached, or the root zone (see buildResponse in dnsWire.py).
+    '''
+    def knownZone(key):
+        entry = cache.peek(key)
+        return entry is not None and not entry.negative
+
+    zoneCut, _ = zoneTrie.deepestCut(userInput.rstrip(".").lower(), knownZone)
+    return zoneCut or "."
+
+
+def wireAddressType(query):
+    # ANY is answered with the A records only, like the minimal answers of RFC 8482
+    return ADDRESS_TYPE_AAAA if query.type == TYPE_AAAA else ADDRESS_TYPE_A
+
+
+def wireResponse(query, finalIpAddress, ttl):
+    '''
+    Returns the DNS wire-format response to query for the answer of resolveForClient.
+    '''
+    if finalIpAddress == NXDOMAIN_RESPONSE:
+        return buildResponse(query, RCODE_NXDOMAIN, ttl=ttl, zone=negativeAnswerZone(query.name))
+    if finalIpAddress == SERVFAIL_RESPONSE:
+        return buildResponse(query, RCODE_SERVFAIL)
+    if finalIpAddress == NODATA_RESPONSE:
+        return buildResponse(query, RCODE_NOERROR, ttl=ttl, zone=negativeAnswerZone(query.name))
+    return buildResponse(query, RCODE_NOERROR, splitAddresses(finalIpAddress), ttl)
+
+
+def shardOf(userInput):
+    '''
+    Returns the index of the worker whose cache holds userInput.
+The hash is the same in every worker process (unlike hash(), which is randomized per process).
+    '''
+    return zlib.crc32(userInput.lower().encode()) % shardCount
+
+
+async def resolveWithDeadline(userInput, addressType=ADDRESS_TYPE_A):
+    '''
+    Resolves userInput within resolutionDeadline seconds and returns the answer for the client: the IP addresses of addressType, NODATA_RESPONSE, NXDOMAIN_RESPONSE or SERVFAIL_RESPONSE.
+    '''
+    deadline = time.monotonic() + resolutionDeadline
+    try:
+        return await asyncio.wait_for(resolveQuery(userInput, deadline, addressType), resolutionDeadline)
+    except asyncio.TimeoutError:
+        log.warning("Could not resolve \"%s\" within %s seconds", userInput, resolutionDeadline)
+    except Exception as error:
+        log.warning("Could not resolve \"%s\": %r", userInput, error)
+    serverStats["servfails"] += 1
+    return SERVFAIL_RESPONSE
+
+
+async def forwardToShard(userInput, shard, addressType=ADDRESS_TYPE_A):
+    '''
+    Asks the worker that owns the cache shard of userInput to resolve it, so every name is cached by one worker only.
+Resolves the name in this worker when the other one cannot be reached (for example while it is being restarted).
+Returns the answer and the seconds it stays in the cache of the other worker.
+    '''
+    serverStats["forwarded"] += 1
+    try:
+        # The other worker answers SERVFAIL_RESPONSE itself once its deadline has passed
+        result = await actAsTemporaryClientAsync(
+            userInput, LOCAL_SHARD_BASE_PORT + shard, "", False, resolutionDeadline + hopTimeout, 0,
+            addressType=addressType)
+    except UpstreamTimeout as error:
+        log.warning("Worker %d did not answer for \"%s\": %r", shard, userInput, error)
+        serverStats["forwardFailures"] += 1
+        return SERVFAIL_RESPONSE, 0
+    except ProtocolError as error:
+        log.warning("Cannot forward \"%s\" to worker %d: %r", userInput, shard, error)
+        serverStats["forwardFailures"] += 1
+        return SERVFAIL_RESPONSE, 0
+    except OSError as error:
+        log.warning("Worker %d cannot be reached for \"%s\": %r", shard, userInput, error)
+        serverStats["forwardFailures"] += 1
+        return await resolveWithDeadline(userInput, addressType), answerTtl(userInput, addressType)
+    if result.status == STATUS_NXDOMAIN:
+        return NXDOMAIN_RESPONSE, result.ttl
+    if result.status == STATUS_NOERROR and not result.addresses:
+        return NODATA_RESPONSE, result.ttl
+    if result.status != STATUS_NOERROR:
+        return SERVFAIL_RESPONSE, 0
+    return joinAddresses(result.addresses), result.ttl
+
+
+class LocalDnsServerProtocol(asyncio.DatagramProtocol):
+    '''
+    Receives client queries on the local DNS server socket and resolves each of them in its own task.
+The queries answered from the cache of this worker, and the ones that are refused, are answered right away from datagram_received() without a task.
+At most maxInFlight resolutions run at the same time, the others wait for a free slot.
+    '''
+
+    def __init__(self, maxInFlight):
+        self.inFlight = asyncio.Semaphore(maxInFlight)
+        self.tasks = set()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, clientMessage, clientAddress):
+        if clientProtocol != "text" and isWireQuery(clientMessage):
+            try:
+                query = parseQuery(clientMessage)
+            except WireFormatError as error:
+                self.rejectWireQuery(clientMessage, clientAddress, error)
+                return
+            response = self.answerWireQueryNow(query)
+            if response is not None:
+                self.transport.sendto(response, clientAddress)
+                return
+            handler = self.handleWireClient(query, clientAddress)
+        elif clientProtocol != "dns":
+            # clientMessage is a view of the receive buffer (see DatagramEndpoint), the task gets the decoded name
+            try:
+                userInput = str(clientMessage, "utf-8")
+            except UnicodeDecodeError:
+                serverStats["malformed"] += 1
+                debug(log, "Query from %s is not UTF-8", clientAddress)
+                return
+            response = self.answerTextQueryNow(userInput)
+            if response is not None:
+                self.transport.sendto(response, clientAddress)
+                return
+            handler = self.handleClient(userInput, clientAddress)
+        else:
+            self.rejectWireQuery(clientMessage, clientAddress, "not a DNS query")
+            return
+        task = asyncio.ensure_future(handler)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def rejectWireQuery(self, clientMessage, clientAddress, error):
+        serverStats["malformed"] += 1
+        debug(log, "Malformed DNS query from %s: %s", clientAddress, error)
+        response = buildFormatError(clientMessage)
+        if response is not None:
+            self.transport.sendto(response, clientAddress)
+
+    def answerWireQueryNow(self, query):
         '''
-        The generalServerHandler function is called to perform the DNS resolution process for the TLD server. It simulates a DNS query to the TLD server, retrieves the result, and returns the IP address of the authoritative DNS server for the specific domain. The obtained IP address is stored in the authoritativeServer variable.
+        Returns the response to a DNS wire-format query when it needs no resolution: an error for a query that is not resolved, or the answer from the cache of this worker.
+Returns None when the query has to be resolved by handleWireClient.
         '''
+        if query.ednsVersion:
+            return buildResponse(query, RCODE_BADVERS)
+        if query.flags & OPCODE_MASK or query.qclass != CLASS_IN or query.type not in SUPPORTED_TYPES:
+            # Only standard queries for addresses are resolved, the other servers know nothing else
+            return buildResponse(query, RCODE_NOTIMP)
+        addressType = wireAddressType(query)
+        if tracingEnabled() or cachedInThisWorker(query.name, addressType) is None:
+            return None
+        finalIpAddress = self.answerFromCacheNow(query.name, addressType)
+        return wireResponse(query, finalIpAddress, answerTtl(query.name, addressType))
 
-        cache[tldInput] = authoritativeServer
-        authoritativeMessage = "Authoritative Result"
-        finalIpAddress = generalServerHandler( # PERFORM A DNS QUERY TO AUTHORITATIVE SERVER
-            userInput, authoritativeServer, AUTHORITATIVE_SERVER_PORT, authoritativeMessage)
-        
+    async def handleWireClient(self, query, clientAddress):
         '''
-        The generalServerHandler function is called again, this time to perform the DNS resolution process for the authoritative DNS server. It simulates a DNS query to the authoritative server, retrieves the result, and returns the final IP address associated with the user's input. The obtained IP address is stored in the finalIpAddress variable.
+        Answers a DNS wire-format query, with a single response datagram.
         '''
+        startTrace()
+        debug(log, "DNS query for \"%s\" (type %d) from %s", query.name, query.type, clientAddress)
+        addressType = wireAddressType(query)
+        finalIpAddress, ttl = await self.resolveForClient(query.name, addressType)
+        self.transport.sendto(wireResponse(query, finalIpAddress, ttl), clientAddress)
 
+    def answerTextQueryNow(self, userInput):
+        '''
+        Returns the response to a query of the text protocol when its address is in the cache of this worker, None when it has to be answered by handleClient.
+        '''
+        if tracingEnabled() or userInput.startswith(VERBOSE_QUERY_PREFIX) or userInput == STATS_QUERY_NAME:
+            return None
+        entry = cachedInThisWorker(userInput)
+        if entry is None or entry.value == NODATA_RESPONSE:
+            # An IPv6-only name is answered with its IPv6 address, which handleClient looks up
+            return None
+        return splitAddresses(self.answerFromCacheNow(userInput))[0].encode()
 
-        cache[authoritativeInput] = finalIpAddress
-        customPrint("cache", cache)
-        print()
-        print(f"Final IP Address : {finalIpAddress}")
-        print()
-        serverMessage = finalIpAddress.encode()
-        localDnsServerSocket.sendto(serverMessage, clientAddress) # is responsible for sending the final IP address obtained from the authoritative DNS server back to the client.
+    def answerFromCacheNow(self, userInput, addressType=ADDRESS_TYPE_A):
+        '''
+        Answers a client query whose final answer is in the cache of this worker (see cachedInThisWorker), counted like the queries of resolveForClient.
+        '''
+        serverStats["queries"] += 1
+        startedAt = time.perf_counter()
+        finalIpAddress = answerFromCache(userInput, addressType)
+        metrics.observe(QUERY_DURATION, time.perf_counter() - startedAt)
+        metrics.increment(RESPONSES, clientResponseLabels.get(finalIpAddress, NOERROR_LABELS))
+        return finalIpAddress
 
+    async def resolveForClient(self, userInput, addressType=ADDRESS_TYPE_A):
         '''
-        localDnsServerSocket: This is a UDP socket created by the local DNS server to handle incoming DNS queries and send responses.
+        Resolves the name of a client query, in this worker or in the worker owning its cache shard.
+Returns the IP addresses of addressType (see joinAddresses), NXDOMAIN_RESPONSE, NODATA_RESPONSE or SERVFAIL_RESPONSE, and the TTL of the answer.
+        '''
+        serverStats["queries"] += 1
+        startedAt = time.perf_counter()
+        metrics.increment(IN_FLIGHT)
+        try:
+            shard = shardOf(userInput) if shardCount > 1 else workerIndex
+            if shard != workerIndex:
+                finalIpAddress, ttl = await forwardToShard(userInput, shard, addressType)
+            else:
+                async with self.inFlight:
+                    finalIpAddress = await resolveWithDeadline(userInput, addressType)
+                ttl = answerTtl(userInput, addressType)
+        finally:
+            metrics.decrement(IN_FLIGHT)
+        metrics.observe(QUERY_DURATION, time.perf_counter() - startedAt)
+        metrics.increment(RESPONSES, clientResponseLabels.get(finalIpAddress, NOERROR_LABELS))
+        return finalIpAddress, ttl
+
+    async def handleClient(self, userInput, clientAddress):
+        '''
+        Answers a query of the text protocol with a single datagram: the first IPv4 address of the name (or IPv6 address, when it has no IPv4 one), NODATA_RESPONSE, NXDOMAIN_RESPONSE or SERVFAIL_RESPONSE.
+Queries starting with VERBOSE_QUERY_PREFIX first get a progress message, in a datagram of its own.
+        '''
+        verbose = userInput.startswith(VERBOSE_QUERY_PREFIX)
+        if verbose:
+            userInput = userInput[len(VERBOSE_QUERY_PREFIX):]
+        if userInput == STATS_QUERY_NAME:
+            # Not a domain name, the benchmark (and anyone else) reads the counters of this worker this way
+            self.transport.sendto(json.dumps(collectStats()).encode(), clientAddress)
+            return
+        if len(userInput.rstrip(".")) > MAX_DOMAIN_NAME_LENGTH:
+            # No domain name is this long, and it would not fit the requests to the other servers
+            serverStats["malformed"] += 1
+            debug(log, "Query from %s is too long to be a domain name", clientAddress)
+            self.transport.sendto(SERVFAIL_RESPONSE.encode(), clientAddress)
+            return
+        startTrace()
+        debug(log, "Talking to the Client at the Address:%s", clientAddress)
+        debug(log, "Client Message:%s", userInput)
+        if verbose:
+            message = f"Hang in there client, I will get the IP Address of the \"{userInput}\""
+            message = message.encode()
+            '''
+
+The line message = message.encode() is encoding the string variable message into bytes. In Python, strings are Unicode by default, and encoding is the process of converting a Unicode string into a sequence of bytes using a specific encoding scheme.
+
+
+In network communication, data is transmitted between devices as a sequence of bytes. Textual data, such as strings, needs to be converted into a format that can be transmitted over the network, and this conversion is done through encoding
+
+            '''
+            self.transport.sendto(message, clientAddress)
+            '''
+The line self.transport.sendto(message, clientAddress) is sending a message (in the form of bytes) from the local DNS server to the client address using a UDP (User Datagram Protocol) socket.
+            '''
+        finalIpAddress, _ = await self.resolveForClient(userInput)
+        if finalIpAddress == NODATA_RESPONSE:
+            # The text protocol asks for any address, an IPv6-only name is answered with its IPv6 address
+            finalIpAddress, _ = await self.resolveForClient(userInput, ADDRESS_TYPE_AAAA)
+        serverMessage = splitAddresses(finalIpAddress)[0].encode()  # The text protocol answers with one address
+        self.transport.sendto(serverMessage, clientAddress) # is responsible for sending the final IP address obtained from the authoritative DNS server back to the client.
+
+        '''
+        self.transport: This is the UDP transport of the local DNS server socket, used to handle incoming DNS queries and send responses.
 
         sendto(serverMessage, clientAddress): This method sends the serverMessage (which contains the final IP address) to the address specified by clientAddress. In the context of DNS, this is the client's address to which the DNS response is directed.
         '''
 
-    # except KeyboardInterrupt:
-    #     print("\nStopping the server")
-    #     print("........")
-    #     print("........")
-    #     print("You Stopped the server")
-    #     exit()
-    # except:
-    #     print("Something went wrong")
-    #     exit()
+
+class ShardProtocol(asyncio.DatagramProtocol):
+    '''
+    Receives the queries other workers forward to this worker because the name belongs to its cache shard (see forwardToShard).
+They use the binary protocol of helpers.py, and count towards the same maxInFlight limit as the client queries.
+    '''
+
+    def __init__(self, inFlight):
+        self.inFlight = inFlight
+        self.tasks = set()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, workerAddress):
+        try:
+            request = decodeRequest(data)
+        except ProtocolError as error:
+            log.warning("Ignoring malformed request from %s: %s", workerAddress, error)
+            return
+        task = asyncio.ensure_future(self.handleWorker(request, workerAddress))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handleWorker(self, request, workerAddress):
+        serverStats["shardQueries"] += 1
+        startTrace()
+        async with self.inFlight:
+            finalIpAddress = await resolveWithDeadline(request.name, request.addressType)
+        ttl = answerTtl(request.name, request.addressType)
+        if finalIpAddress == NXDOMAIN_RESPONSE:
+            response = ServerResponse(STATUS_NXDOMAIN, ttl)
+        elif finalIpAddress == SERVFAIL_RESPONSE:
+            response = ServerResponse(STATUS_SERVFAIL, 0)
+        elif finalIpAddress == NODATA_RESPONSE:
+            response = ServerResponse(ttl=ttl)
+        else:
+            response = ServerResponse(ttl=ttl, addresses=splitAddresses(finalIpAddress))
+        response.queryId = request.queryId
+        self.transport.sendto(encodeResponse(response), workerAddress)
+
+
+def snapshotFileName():
+    # Every worker keeps its own cache, so it keeps its own snapshot
+    return f"{snapshotFile}.{workerIndex}" if workerCount > 1 else snapshotFile
+
+
+def warmStart():
+    '''
+    Loads the snapshot of the cache saved by the last run, if there is one, so the first queries do not all go to the other servers.
+    '''
+    fileName = snapshotFileName()
+    try:
+        loaded, dropped = loadSnapshot(cache, fileName)
+    except FileNotFoundError:
+        log.info("No cache snapshot at %s, starting with an empty cache", fileName)
+        return
+    except (OSError, ValueError) as error:
+        log.warning("Could not load the cache snapshot %s: %r", fileName, error)
+        return
+    for key in cache.entries:
+        if key.endswith("."):
+            zoneTrie.insert(key)
+    log.info("Loaded %d cache entries from %s (%d had expired)", loaded, fileName, dropped)
+
+
+def saveCacheSnapshot():
+    try:
+        saveSnapshot(snapshotFileName(), cache.snapshot())
+    except OSError as error:
+        log.warning("Could not save the cache snapshot %s: %r", snapshotFileName(), error)
+        return
+    log.info("Saved the cache to %s", snapshotFileName())
+
+
+async def saveSnapshotsPeriodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(snapshotInterval)
+        # Only the serialization needs the cache, the file is written without blocking the queries
+        data = cache.snapshot()
+        try:
+            await loop.run_in_executor(None, saveSnapshot, snapshotFileName(), data)
+        except OSError as error:
+            log.warning("Could not save the cache snapshot %s: %r", snapshotFileName(), error)
+
+
+async def serveLocalDnsServer(maxInFlight):
+    # Clients may ask over IPv4 or IPv6, the shards of the other workers only over IPv4
+    localDnsServerSockets = bindDatagramSockets(LOCAL_DNS_SERVER_PORT, workerCount > 1)
+    transport, protocol = openDatagramEndpoint(lambda: LocalDnsServerProtocol(maxInFlight), localDnsServerSockets)
+    shardTransport = None
+    if shardCount > 1:
+        shardSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        shardSocket.bind((LOCAL_HOST, LOCAL_SHARD_BASE_PORT + workerIndex))
+        shardTransport, _ = openDatagramEndpoint(lambda: ShardProtocol(protocol.inFlight), shardSocket)
+    snapshotTask = None
+    if snapshotFile and snapshotInterval > 0:
+        snapshotTask = asyncio.ensure_future(saveSnapshotsPeriodically())
+    log.info("localDNS is up and running and I am listening at Port:%s", LOCAL_DNS_SERVER_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        if shardTransport is not None:
+            shardTransport.close()
+        upstreamPool.close()
+        if snapshotFile:
+            if snapshotTask is not None:
+                snapshotTask.cancel()
+            saveCacheSnapshot()
+
+
+def runLocalDnsServer(index=0):
+    '''
+    Runs the local DNS server in this process, as worker number index when it was started with more than one worker.
+    '''
+    global upstreamExecutor, workerIndex, rootServerAddress
+    workerIndex = index
+    if rootServerAddress is None:
+        rootServerAddress = joinAddresses(dns.resolver.get_default_resolver().nameservers)
+    serveMetrics(metrics, LOCAL_HOST, metricsPort and metricsPort + index)
+    for serverMetrics, serverMetricsPort in inProcessMetrics:
+        serveMetrics(serverMetrics, LOCAL_HOST, serverMetricsPort and serverMetricsPort + index)
+    if snapshotFile:
+        warmStart()
+    if servingMode == "threads":
+        upstreamExecutor = ThreadPoolExecutor(max_workers=maxInFlightQueries)
+    try:
+        asyncio.run(serveLocalDnsServer(maxInFlightQueries))
+    except KeyboardInterrupt:
+        log.info("Stopping the server")
+    finally:
+        if upstreamExecutor is not None:
+            upstreamExecutor.shutdown(wait=False)
+            upstreamExecutor = None
+
+
+def collectStats():
+    return dict(serverStats, cache=cache.stats(), singleFlight=dict(singleFlightStats),
+                hops=hopSummary(), zones=len(zoneTrie), transport=dict(transportStats), upstream=upstreamStats())
+
+
+def upstreamStats():
+    # The blocking lookups of the "threads" mode use socketPool, the asyncio ones upstreamPool
+    return upstreamPool.stats() if upstreamExecutor is None else socketPool.stats()
+
+
+def hopSummary():
+    '''
+    Returns the number of lookups, failed lookups and seconds spent on every hop, read from the metrics.
+    '''
+    hops = {}
+    for port, hopName in hopNames.items():
+        histogram = metrics.value(HOP_DURATION, hopLabels[port])
+        hops[hopName] = {"queries": histogram.count if histogram else 0,
+                         "failures": metrics.value(HOP_FAILURES, hopLabels[port]),
+                         "seconds": histogram.sum if histogram else 0.0}
+    return hops
+
+
+def localDnsServer(mode="asyncio", maxInFlight=DEFAULT_MAX_IN_FLIGHT, includeMessages=True,
+                   timeout=HOP_TIMEOUT, retries=HOP_RETRIES, deadline=RESOLUTION_DEADLINE,
+                   prefetchFraction=DEFAULT_PREFETCH_FRACTION,
+                   prefetchMinHits=DEFAULT_PREFETCH_MIN_HITS, staleTtl=DEFAULT_STALE_TTL,
+                   workers=DEFAULT_WORKERS, rootServer=None, metricsHttpPort=LOCAL_METRICS_PORT,
+                   cacheSnapshot=None, cacheSnapshotInterval=DEFAULT_SNAPSHOT_INTERVAL, protocol="auto",
+                   shardCache=False):
+    '''
+    Binds and listens on a UDP socket for the local DNS server.
+Handles incoming client requests concurrently, performs root, TLD, and authoritative server lookups.
+Maintains a cache to store intermediate results.
+Sends the final IP address back to the client.
+mode: "asyncio" talks to the other servers without blocking, "threads" runs the blocking lookups on a thread pool.
+maxInFlight: The maximum number of client queries being resolved at the same time.
+includeMessages: Whether the other servers are asked for the human readable messages of their lookups.
+timeout, retries: How long to wait for each server before asking again, and how many times to ask again.
+deadline: Seconds after which a client query is answered with SERVFAIL_RESPONSE.
+prefetchFraction, prefetchMinHits: Cache entries with at least prefetchMinHits hits are looked up again in the background once prefetchFraction of their TTL has passed.
+staleTtl: How many seconds expired cache entries may still be served when a server does not answer, 0 disables it.
+workers: How many worker processes share the port.
+shardCache: Whether the workers split the cache between them by name (see shardOf). A name is then cached and resolved once for all workers, but the queries of (workers - 1) / workers of the names cost one more datagram to the worker owning them and back. Without it every worker caches every name it is asked, which answers the cache hits fastest but resolves and stores every name once per worker.
+rootServer: The name servers the root DNS server should ask (comma separated), instead of the ones of the system resolver.
+metricsHttpPort: The HTTP port the Prometheus metrics are served on (worker i uses this port + i), 0 to not serve them.
+protocol: "dns" answers DNS wire-format queries (see dnsWire.py), "text" the bare domain names client.py sends, "auto" both.
+cacheSnapshot: The file the cache is loaded from at startup and saved to every cacheSnapshotInterval seconds and at shutdown (worker i uses the file name + ".i"), None to not keep the cache across restarts.
+    '''
+    global servingMode, maxInFlightQueries, wantMessages, hopTimeout, hopRetries, resolutionDeadline
+    global workerCount, shardCount, rootServerAddress, metricsPort, snapshotFile, snapshotInterval, clientProtocol
+    clientProtocol = protocol
+    rootServerAddress = rootServer
+    snapshotFile = cacheSnapshot
+    snapshotInterval = cacheSnapshotInterval
+    metricsPort = metricsHttpPort
+    servingMode = mode
+    maxInFlightQueries = maxInFlight
+    wantMessages = includeMessages
+    hopTimeout = timeout
+    hopRetries = retries
+    resolutionDeadline = deadline
+    cache.prefetchFraction = prefetchFraction
+    cache.prefetchMinHits = prefetchMinHits
+    cache.staleTtl = staleTtl
+    workerCount = workers
+    shardCount = workers if shardCache else 1
+    if workers > 1:
+        runWorkers("localDNS", workers, runLocalDnsServer, collectStats)
+    else:
+        runLocalDnsServer()
+
+
+def addLocalServerArguments(parser):
+    '''
+    Adds the command line options of the local DNS server to parser, allInOneServer.py shares them.
+    '''
+    parser.add_argument("--mode", choices=SERVING_MODES, default="asyncio",
+                        help="how lookups to the root, TLD and authoritative servers are made")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of client queries resolved at the same time")
+    parser.add_argument("--no-messages", action="store_true",
+                        help="do not ask the other servers for the human readable lookup messages")
+    parser.add_argument("--timeout", type=float, default=HOP_TIMEOUT,
+                        help="seconds to wait for a server before asking again (doubled on every retry)")
+    parser.add_argument("--retries", type=int, default=HOP_RETRIES,
+                        help="how many times a server is asked again before giving up")
+    parser.add_argument("--deadline", type=float, default=RESOLUTION_DEADLINE,
+                        help="seconds after which a client query is answered with SERVFAIL")
+    parser.add_argument("--prefetch-fraction", type=float, default=DEFAULT_PREFETCH_FRACTION,
+                        help="fraction of the TTL after which hot cache entries are refreshed (1 disables it)")
+    parser.add_argument("--prefetch-min-hits", type=int, default=DEFAULT_PREFETCH_MIN_HITS,
+                        help="hits after which a cache entry counts as hot")
+    parser.add_argument("--serve-stale", type=float, default=DEFAULT_STALE_TTL, metavar="SECONDS",
+                        help="keep expired cache entries this long and serve them when a server does not answer")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes sharing the port, each with its own cache")
+    parser.add_argument("--shard-cache", action="store_true",
+                        help="split the cache between the workers by name, a worker forwards the names of the others to them")
+    parser.add_argument("--root-server", metavar="ADDRESS[,ADDRESS...]",
+                        help="name servers the root DNS server asks (the fastest first), instead of the ones of the system resolver")
+    parser.add_argument("--metrics-port", type=int, default=LOCAL_METRICS_PORT,
+                        help="HTTP port of the Prometheus metrics (worker i uses the port + i), 0 to not serve them")
+    parser.add_argument("--cache-snapshot", metavar="FILE",
+                        help="keep the cache in this file across restarts (worker i uses FILE.i)")
+    parser.add_argument("--snapshot-interval", type=float, default=DEFAULT_SNAPSHOT_INTERVAL, metavar="SECONDS",
+                        help="seconds between two snapshots of the cache, 0 to only save it at shutdown")
+    parser.add_argument("--protocol", choices=CLIENT_PROTOCOLS, default="auto",
+                        help="DNS wire-format queries, the text protocol of client.py, or both (auto)")
+    addLoggingArguments(parser)
+
+
+def localDnsServerFromArguments(arguments):
+    localDnsServer(arguments.mode, arguments.max_in_flight, not arguments.no_messages,
+                   arguments.timeout, arguments.retries, arguments.deadline,
+                   arguments.prefetch_fraction, arguments.prefetch_min_hits,
+                   arguments.serve_stale, arguments.workers, arguments.root_server,
+                   arguments.metrics_port, arguments.cache_snapshot, arguments.snapshot_interval,
+                   arguments.protocol, arguments.shard_cache)
 
 
-localDnsServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local DNS server")
+    addLocalServerArguments(parser)
+    arguments = parser.parse_args()
+    configureLogging(arguments.log_level, arguments.trace_rate)
+    localDnsServerFromArguments(arguments)
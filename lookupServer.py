@@ -0,0 +1,128 @@
+import asyncio
+import time
+from helpers import ServerResponse, encodeResponse
+from helpers import decodeRequest, ProtocolError
+from helpers import STATUS_SERVFAIL
+from helpers import openDatagramEndpoint, bindDatagramSockets
+from helpers import displayMessages
+from serverLog import startTrace, debug
+from metrics import rcodeLabels
+from metrics import STAGE_DURATION, RESPONSES, IN_FLIGHT, DECODE_STAGE, ENCODE_STAGE
+
+'''
+The lookupServer.py file contains the asyncio serving loop shared by the root, TLD and authoritative servers.
+Every request is looked up in its own task, so a process keeps answering while hundreds of its lookups wait for other name servers.
+'''
+
+DEFAULT_MAX_IN_FLIGHT = 256  # Lookups of one server process running at the same time
+DEFAULT_MAX_QUEUED = 1024  # Requests waiting for a free slot, the ones past this are answered with SERVFAIL right away
+
+
+class LookupServerProtocol(asyncio.DatagramProtocol):
+    '''
+    Purpose: Receives the requests of the binary protocol of helpers.py and answers each of them from its own task.
+The request is decoded before the datagram handler returns, the buffer it was received in is reused for the next one (see DatagramEndpoint).
+Parameters:
+lookup: The coroutine function of the server (findOutTld, findOutAuthoritative or findOutResultantIp), called with the name, the name server, the list the messages go to (None when they were not asked for) and the type of the addresses asked for.
+log: The logger of the server.
+metrics: The Metrics of the server (see serverMetrics in metrics.py).
+serverStats: The counters of the server.
+lookupStage: The labels the time spent in lookup is observed with.
+maxInFlight: How many lookups run at the same time, the others wait for a free slot.
+maxQueued: How many requests may wait for a slot. Past this the server is overloaded, and new requests are answered with SERVFAIL at once instead of piling up (the local DNS server then fails fast or serves stale answers).
+    '''
+
+    def __init__(self, lookup, log, metrics, serverStats, lookupStage,
+                 maxInFlight=DEFAULT_MAX_IN_FLIGHT, maxQueued=DEFAULT_MAX_QUEUED):
+        self.lookup = lookup
+        self.log = log
+        self.metrics = metrics
+        self.serverStats = serverStats
+        self.lookupStage = lookupStage
+        self.inFlight = asyncio.Semaphore(maxInFlight)
+        self.maxTasks = maxInFlight + maxQueued
+        self.tasks = set()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, clientMessage, clientAddress):
+        startedAt = time.perf_counter()
+        try:
+            request = decodeRequest(clientMessage)
+        except ProtocolError as error:
+            self.log.warning("Ignoring malformed request from %s: %s", clientAddress, error)
+            self.serverStats["malformed"] += 1
+            return
+        self.metrics.observe(STAGE_DURATION, time.perf_counter() - startedAt, DECODE_STAGE)
+        if len(self.tasks) >= self.maxTasks:
+            self.serverStats["shed"] += 1
+            self.metrics.increment(RESPONSES, rcodeLabels(STATUS_SERVFAIL))
+            self.sendResponse(ServerResponse(STATUS_SERVFAIL, 0, queryId=request.queryId), clientAddress)
+            return
+        task = asyncio.ensure_future(self.handleRequest(request, clientAddress))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handleRequest(self, request, clientAddress):
+        startTrace()
+        debug(self.log, "Talking to Client at Address:%s", clientAddress)
+        debug(self.log, "Client Message:%s", request.name)
+        result = await self.answer(request)
+        displayMessages(result.messages, self.log)
+        self.sendResponse(result, clientAddress)
+
+    async def answer(self, request):
+        '''
+        Looks request up and returns its ServerResponse, a failed lookup is answered with SERVFAIL.
+The local DNS server calls this directly when the server runs in its process (see allInOneServer.py).
+        '''
+        self.serverStats["queries"] += 1
+        async with self.inFlight:
+            self.metrics.increment(IN_FLIGHT)
+            lookupStartedAt = time.perf_counter()
+            try:
+                result = await self.lookup(request.name, request.nameServer,
+                                           [] if request.wantMessages else None, request.addressType)
+            except Exception as error:
+                self.log.warning("Lookup of \"%s\" failed: %r", request.name, error)
+                self.serverStats["failures"] += 1
+                result = ServerResponse(STATUS_SERVFAIL, 0)
+            finally:
+                self.metrics.decrement(IN_FLIGHT)
+            self.metrics.observe(STAGE_DURATION, time.perf_counter() - lookupStartedAt, self.lookupStage)
+        result.queryId = request.queryId
+        self.metrics.increment(RESPONSES, rcodeLabels(result.status))
+        return result
+
+    def sendResponse(self, result, clientAddress):
+        encodeStartedAt = time.perf_counter()
+        serverMessage = encodeResponse(result)
+        self.metrics.observe(STAGE_DURATION, time.perf_counter() - encodeStartedAt, ENCODE_STAGE)
+        self.transport.sendto(serverMessage, clientAddress)
+
+
+def runLookupServer(serverName, port, makeProtocol, log, reusePort=False):
+    '''
+    Purpose: Serves a root, TLD or authoritative server on port, over IPv4 and IPv6, until it is stopped with Ctrl+C (or SIGTERM, in a worker).
+Parameters:
+serverName: The name logged when the server is up.
+makeProtocol: Returns the LookupServerProtocol of the server, called once the event loop runs.
+reusePort: Set by the workers started with --workers, so that all of them can bind the same port.
+    '''
+
+    async def serve():
+        serverSockets = bindDatagramSockets(port, reusePort)
+        transport, _ = openDatagramEndpoint(makeProtocol, serverSockets)
+        log.info("%s is up and running at port:%s (%s)", serverName, port,
+                 ", ".join(serverSocket.getsockname()[0] for serverSocket in serverSockets))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        log.info("You Stopped the server")
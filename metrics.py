@@ -0,0 +1,233 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dns.rcode
+
+'''
+The metrics.py file keeps the counters, gauges and latency histograms of a server and serves them over HTTP in the Prometheus text format.
+Every server process has one Metrics instance, updated from its own thread, and a small HTTP server thread that only reads it.
+'''
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+log = logging.getLogger("metrics")
+STAGE_DURATION = "dns_stage_duration_seconds"
+RESPONSES = "dns_responses_total"
+IN_FLIGHT = "dns_in_flight_queries"
+DECODE_STAGE = (("stage", "decode"),)
+ENCODE_STAGE = (("stage", "encode"),)
+# How the serverStats of the root, TLD and authoritative servers are published
+SERVER_METRICS = {
+    "queries": ("dns_queries_total", COUNTER, "Queries received"),
+    "failures": ("dns_lookup_failures_total", COUNTER, "Lookups that raised an error and were answered with SERVFAIL"),
+    "malformed": ("dns_malformed_requests_total", COUNTER, "Requests that could not be decoded"),
+    "shed": ("dns_shed_requests_total", COUNTER, "Requests answered with SERVFAIL right away because too many were waiting"),
+}
+rcodeLabelsCache = {}
+
+
+class Histogram:
+    '''
+    Purpose: Counts observed values (like durations in seconds) into buckets with the given upper bounds.
+    '''
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last one counts the values above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricFamily:
+    __slots__ = ("kind", "help", "buckets", "samples")
+
+    def __init__(self, kind, help, buckets):
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+        self.samples = {}  # labels -> value, or Histogram for histograms
+
+
+class Metrics:
+    '''
+    Purpose: The metrics of one server process.
+Actions:
+Every metric is declared once with describe(), then updated with increment(), decrement(), setGauge() or observe().
+Labels are given as a tuple of (name, value) pairs, so they can be prepared once and reused on the hot path.
+exportStats() publishes the counters a module already keeps in a dictionary (like the stats() of DnsCache), they are read when the metrics are rendered.
+    '''
+
+    def __init__(self):
+        self.families = {}
+        self.exported = []
+
+    def describe(self, name, kind, help, buckets=LATENCY_BUCKETS):
+        self.families[name] = MetricFamily(kind, help, buckets)
+
+    def increment(self, name, labels=(), amount=1):
+        samples = self.families[name].samples
+        samples[labels] = samples.get(labels, 0) + amount
+
+    def decrement(self, name, labels=(), amount=1):
+        self.increment(name, labels, -amount)
+
+    def setGauge(self, name, value, labels=()):
+        self.families[name].samples[labels] = value
+
+    def observe(self, name, value, labels=()):
+        family = self.families[name]
+        histogram = family.samples.get(labels)
+        if histogram is None:
+            histogram = family.samples[labels] = Histogram(family.buckets)
+        histogram.observe(value)
+
+    def value(self, name, labels=()):
+        '''
+        Purpose: Returns the current value of a counter or gauge (0 when never updated), or the Histogram of a histogram (None when never updated).
+        '''
+        family = self.families[name]
+        return family.samples.get(labels, None if family.kind == HISTOGRAM else 0)
+
+    def exportStats(self, readStats, table):
+        '''
+        Purpose: Publishes counters kept elsewhere.
+Parameters:
+readStats: A function returning a dictionary of numbers.
+table: Maps the keys of that dictionary to (metric name, kind, help) triples, the other keys are left out.
+        '''
+        for metricName, kind, help in table.values():
+            self.describe(metricName, kind, help)
+        self.exported.append((readStats, table))
+
+    def render(self):
+        '''
+        Purpose: Returns every metric in the Prometheus text exposition format.
+        '''
+        for readStats, table in self.exported:
+            stats = readStats()
+            for key, (metricName, kind, help) in table.items():
+                if key in stats:
+                    self.families[metricName].samples[()] = stats[key]
+        lines = []
+        for name, family in list(self.families.items()):
+            samples = list(family.samples.items())
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for labels, value in sorted(samples):
+                if family.kind == HISTOGRAM:
+                    lines.extend(renderHistogram(name, labels, value))
+                else:
+                    lines.append(f"{name}{formatLabels(labels)} {formatValue(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def renderHistogram(name, labels, histogram):
+    counts = list(histogram.counts)
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, counts):
+        cumulative += count
+        yield f"{name}_bucket{formatLabels(labels + (('le', formatValue(bound)),))} {cumulative}"
+    cumulative += counts[-1]
+    yield f"{name}_bucket{formatLabels(labels + (('le', '+Inf'),))} {cumulative}"
+    yield f"{name}_sum{formatLabels(labels)} {formatValue(histogram.sum)}"
+    yield f"{name}_count{formatLabels(labels)} {cumulative}"
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escapeLabelValue(value)}"' for key, value in labels) + "}"
+
+
+def escapeLabelValue(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(int(value))
+
+
+def rcodeLabels(status):
+    '''
+    Purpose: Returns the labels of a status of helpers.py (they are DNS rcode numbers), like (("rcode", "NXDOMAIN"),).
+    '''
+    labels = rcodeLabelsCache.get(status)
+    if labels is None:
+        try:
+            name = dns.rcode.to_text(status)
+        except ValueError:
+            name = str(status)
+        labels = rcodeLabelsCache[status] = (("rcode", name),)
+    return labels
+
+
+def serverMetrics(serverStats):
+    '''
+    Purpose: Creates the Metrics of a root, TLD or authoritative server.
+Actions:
+Declares the time spent in every stage of a request (decode, the findOut* lookup, encode), the responses by rcode and the queries being looked up, and publishes serverStats.
+    '''
+    metrics = Metrics()
+    metrics.describe(STAGE_DURATION, HISTOGRAM, "Time spent decoding requests, looking them up and encoding responses")
+    metrics.describe(RESPONSES, COUNTER, "Responses sent, by rcode")
+    metrics.describe(IN_FLIGHT, GAUGE, "Queries being looked up")
+    metrics.exportStats(lambda: serverStats, SERVER_METRICS)
+    return metrics
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None  # Set on the subclass made by serveMetrics()
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every scrape would otherwise print a line between the messages of the server
+        pass
+
+
+def serveMetrics(metrics, host, port):
+    '''
+    Purpose: Serves the metrics on http://host:port/metrics from a background thread.
+Actions:
+Returns the HTTP server, or None when port is 0 (metrics disabled) or cannot be bound, a server keeps running without its metrics rather than not starting.
+    '''
+    if not port:
+        return None
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"metrics": metrics})
+    try:
+        httpServer = ThreadingHTTPServer((host, port), handler)
+    except OSError as error:
+        log.warning("Could not serve the metrics on port %d: %r", port, error)
+        return None
+    httpServer.daemon_threads = True
+    thread = threading.Thread(target=httpServer.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    log.info("Metrics are served at http://%s:%d/metrics", host, port)
+    return httpServer
@@ -0,0 +1,185 @@
+import asyncio
+import random
+import time
+import dns.asyncquery
+import dns.exception
+import dns.rcode
+from helpers import DNS_QUERY_TIMEOUT
+from metrics import COUNTER, GAUGE
+
+'''
+The nameServerSelection.py file picks which of the name servers of a zone the root, TLD and authoritative servers ask.
+It keeps a smoothed round trip time (RTT) per server address, asks the fastest one first, asks the next one as well when the first is slow to answer, and leaves servers that keep failing alone for a while.
+'''
+
+RTT_SMOOTHING = 0.3  # Weight of a new measurement in the smoothed RTT
+RTT_HALF_LIFE = 60.0  # Seconds after which the RTT of a server that was not asked counts half, so slow servers are tried again
+INITIAL_RTT_MAX = 0.032  # Servers never asked get a random RTT below this, so they are tried before known slow ones
+MAX_RTT = 10.0
+STAGGER_FACTOR = 2.0  # The next server is asked when the first has not answered within this many times its RTT
+MIN_STAGGER = 0.02  # Seconds
+MAX_STAGGER = 0.4
+FAILURE_THRESHOLD = 3  # Failures in a row after which a server is backed off
+BACKOFF_BASE = 1.0  # Seconds, doubled for every failure past the threshold
+BACKOFF_MAX = 60.0
+FAILED_RCODES = (dns.rcode.SERVFAIL, dns.rcode.REFUSED)
+# How the counters of NameServerSelector.stats() are published by Metrics.exportStats() (see metrics.py)
+SELECTION_METRICS = {
+    "queries": ("dns_upstream_queries_total", COUNTER, "Queries sent to name servers"),
+    "hedged": ("dns_upstream_hedged_queries_total", COUNTER, "Queries sent to another name server because the first was slow or failed"),
+    "failures": ("dns_upstream_failures_total", COUNTER, "Name server queries that timed out or were answered with SERVFAIL or REFUSED"),
+    "backedOff": ("dns_upstream_backed_off_servers", GAUGE, "Name servers left alone after failing repeatedly"),
+}
+
+
+class ServerRtt:
+    __slots__ = ("rtt", "updatedAt", "failures", "backoffUntil")
+
+    def __init__(self, rtt, updatedAt):
+        self.rtt = rtt
+        self.updatedAt = updatedAt
+        self.failures = 0  # Failures in a row
+        self.backoffUntil = 0.0
+
+
+class NameServerSelector:
+    '''
+    Purpose: Tracks the RTT and the failures of every name server address asked by this process.
+Parameters:
+clock: The function used to read the current time, time.monotonic by default.
+Actions:
+order() sorts the addresses of a zone from the most to the least promising, recordRtt(), recordSlower() and recordFailure() update a server after every query.
+The RTT of a server decays while it is not asked, so a server that was slow once gets another chance later on.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.servers = {}
+        self.clock = clock
+        self.queries = 0
+        self.hedged = 0
+        self.failures = 0
+
+    def server(self, address):
+        server = self.servers.get(address)
+        if server is None:
+            server = self.servers[address] = ServerRtt(random.uniform(0, INITIAL_RTT_MAX), self.clock())
+        return server
+
+    def rtt(self, address, now=None):
+        server = self.server(address)
+        idle = (self.clock() if now is None else now) - server.updatedAt
+        return server.rtt * 0.5 ** (idle / RTT_HALF_LIFE)
+
+    def order(self, addresses):
+        '''
+        Purpose: Returns addresses sorted by decayed RTT, with the backed off servers last (they are still asked when nothing else is left).
+        '''
+        now = self.clock()
+        return sorted(addresses, key=lambda address: (self.server(address).backoffUntil > now,
+                                                      self.rtt(address, now)))
+
+    def staggerDelay(self, address):
+        return min(max(STAGGER_FACTOR * self.rtt(address), MIN_STAGGER), MAX_STAGGER)
+
+    def recordRtt(self, address, rtt):
+        now = self.clock()
+        server = self.server(address)
+        current = self.rtt(address, now)
+        server.rtt = min(current + RTT_SMOOTHING * (rtt - current), MAX_RTT)
+        server.updatedAt = now
+        server.failures = 0
+        server.backoffUntil = 0.0
+
+    def recordSlower(self, address, elapsed):
+        '''
+        Purpose: Notes that a server asked elapsed seconds ago has not answered yet, while another one has.
+Only raises its RTT to at least elapsed, its failures and backoff are left as they are: it has not answered, so it must not count as a success.
+        '''
+        now = self.clock()
+        server = self.server(address)
+        current = self.rtt(address, now)
+        if elapsed > current:
+            server.rtt = min(elapsed, MAX_RTT)
+            server.updatedAt = now
+
+    def recordFailure(self, address):
+        now = self.clock()
+        server = self.server(address)
+        server.rtt = min(max(self.rtt(address, now) * 2, MIN_STAGGER), MAX_RTT)
+        server.updatedAt = now
+        server.failures += 1
+        self.failures += 1
+        if server.failures >= FAILURE_THRESHOLD:
+            backoff = min(BACKOFF_BASE * 2 ** (server.failures - FAILURE_THRESHOLD), BACKOFF_MAX)
+            server.backoffUntil = now + backoff
+
+    def stats(self):
+        now = self.clock()
+        return {
+            "servers": len(self.servers),
+            "queries": self.queries,
+            "hedged": self.hedged,
+            "failures": self.failures,
+            "backedOff": sum(1 for server in self.servers.values() if server.backoffUntil > now),
+        }
+
+
+async def queryFastest(selector, query, addresses, timeout=DNS_QUERY_TIMEOUT, port=53):
+    '''
+    Purpose: Sends query to the name servers of a zone, starting with the fastest, and returns the first usable response.
+Parameters:
+selector: The NameServerSelector of this process.
+query: The dns.message.Message to send.
+addresses: The IP addresses of the name servers of the zone.
+timeout: Seconds to wait for a usable response in total.
+Actions:
+Asks the next server as well whenever the last one asked has not answered within its stagger delay (see staggerDelay) or failed (no answer, SERVFAIL or REFUSED).
+Returns (response, address), the last SERVFAIL or REFUSED response when no server gave a better one, and raises dns.exception.Timeout when none answered.
+    '''
+    candidates = selector.order(dict.fromkeys(addresses))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    pending = {}  # Query task -> (address, time it was sent)
+    failedResponse = None
+    sent = 0
+    try:
+        while candidates or pending:
+            now = loop.time()
+            if now >= deadline:
+                break
+            wait = deadline - now
+            if candidates:
+                address = candidates.pop(0)
+                if sent:
+                    selector.hedged += 1
+                selector.queries += 1
+                sent += 1
+                task = asyncio.ensure_future(dns.asyncquery.udp(query, address, timeout=wait, port=port))
+                pending[task] = (address, selector.clock())
+                if candidates:
+                    wait = min(wait, selector.staggerDelay(address))
+            done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                address, sentAt = pending.pop(task)
+                try:
+                    response = task.result()
+                except (OSError, dns.exception.DNSException):
+                    selector.recordFailure(address)
+                    continue
+                if response.rcode() in FAILED_RCODES:
+                    selector.recordFailure(address)
+                    failedResponse = (response, address)
+                    continue
+                answeredAt = selector.clock()
+                selector.recordRtt(address, answeredAt - sentAt)
+                for pendingAddress, pendingSentAt in pending.values():
+                    selector.recordSlower(pendingAddress, answeredAt - pendingSentAt)
+                return response, address
+        for address, _ in pending.values():
+            selector.recordFailure(address)
+        if failedResponse is not None:
+            return failedResponse
+        raise dns.exception.Timeout(timeout=timeout)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,22 +1,44 @@
-import socket
+import argparse
+import logging
 import dns
-import dns.resolver
-import dns.query
-import dns.name
 import dns.message
-import warnings
-from helpers import LOCAL_HOST, ROOT_SERVER_PORT, BUFFER_SIZE
+from helpers import LOCAL_HOST, ROOT_SERVER_PORT
 from helpers import splitInput
 from helpers import getInput
-from helpers import customPrint
-from helpers import displayMessages
-
-
-def findOutTld(userInput, localNameServer):
+from helpers import getNegativeTtl
+from helpers import DNS_QUERY_TIMEOUT
+from helpers import ServerResponse
+from helpers import ADDRESS_TYPE_A
+from helpers import STATUS_NXDOMAIN, STATUS_SERVFAIL
+from helpers import ROOT_METRICS_PORT
+from helpers import splitAddresses
+from helpers import transportStats, TRANSPORT_METRICS
+from workers import runWorkers, DEFAULT_WORKERS
+from serverLog import configureLogging, addLoggingArguments, debug
+from metrics import serverMetrics, serveMetrics
+from lookupServer import LookupServerProtocol, runLookupServer, DEFAULT_MAX_IN_FLIGHT
+from delegationTable import DelegationTable, glueForNameServers, DELEGATION_METRICS
+from nameServerSelection import NameServerSelector, queryFastest, SELECTION_METRICS
+
+log = logging.getLogger("rootDnsServer")
+serverStats = {"queries": 0, "failures": 0, "malformed": 0, "shed": 0}
+delegationTable = DelegationTable()  # Referrals loaded with --delegations or learned from earlier lookups
+metrics = serverMetrics(serverStats)
+metrics.exportStats(lambda: transportStats, TRANSPORT_METRICS)
+metrics.exportStats(delegationTable.stats, DELEGATION_METRICS)
+selector = NameServerSelector()  # The RTT of every name server this process asks
+metrics.exportStats(selector.stats, SELECTION_METRICS)
+LOOKUP_STAGE = (("stage", "findOutTld"),)
+
+
+async def findOutTld(userInput, localNameServer, returnMessage=None, addressType=ADDRESS_TYPE_A):
     '''
     Takes user input and the local DNS server as arguments.
 Performs a DNS query to the local DNS server for the TLD (Top-Level Domain) information.
-Returns messages about the lookup process.
+localNameServer may list several addresses (see joinAddresses in helpers.py), the fastest one is asked (see queryFastest).
+Returns a ServerResponse with the status, TTL and the IP addresses of the TLD servers, fastest first.
+Messages about the lookup process are appended to returnMessage, unless it is None.
+addressType is not used, the TLD servers are the same whatever type of address is resolved.
     '''
 
     '''
@@ -24,9 +46,7 @@ Returns messages about the lookup process.
 
     Initialization:
 
-    returnMessage: A list to store messages about the DNS lookup process.
-    defaultResolver: Retrieves the default DNS resolver.
-    converToDomainName: Converts the user input into a DNS name.
+    returnMessage: A list to store messages about the DNS lookup process, or None when nobody asked for them (then no message is even formatted).
     numberOfWords: Set to 1, indicating that only the root domain is considered initially.
     rootInput: Obtains the root domain from the user input using the getInput function.
     message: A message indicating that the function is aware of the root domain.
@@ -49,31 +69,48 @@ Returns messages about the lookup process.
     Appends messages about the TLD server name and its IP address.
     Return:
 
-    Returns the list of messages (returnMessage), providing insights into the DNS lookup process for the TLD.
+    Returns a ServerResponse carrying the status, the TTL, the IP address of the TLD server and the list of messages (returnMessage), providing insights into the DNS lookup process for the TLD.
     '''
 
 
-    returnMessage = []
-    defaultResolver = dns.resolver.get_default_resolver()
-    converToDomainName = dns.name.from_text(userInput)
     numberOfWords = 1
     rootInput = getInput(userInput, numberOfWords)
-    customPrint("Customized rootInput", rootInput)
-    message = f"I dont know the address of \"{userInput}\" but I know the address of \"{rootInput}\""
-    returnMessage.append(message)
-    returnMessage.append(
-        f"Looking up \"{rootInput}\" on \"{localNameServer}\"")
+    debug(log, "Customized rootInput: %s", rootInput)
+    if returnMessage is not None:
+        message = f"I dont know the address of \"{userInput}\" but I know the address of \"{rootInput}\""
+        returnMessage.append(message)
+        returnMessage.append(
+            f"Looking up \"{rootInput}\" on \"{localNameServer}\"")
+    knownDelegation = delegationTable.lookup(rootInput)
+    if knownDelegation is not None:
+        delegation, ttl = knownDelegation
+        if delegation is None:
+            if returnMessage is not None:
+                returnMessage.append(f"\"{rootInput}\" does not exist (delegation table).")
+                returnMessage.append("Please enter a legible domain")
+            return ServerResponse(STATUS_NXDOMAIN, ttl, messages=returnMessage)
+        if delegation.addresses:
+            if returnMessage is not None:
+                returnMessage.append(
+                    f"\"{delegation.nameServers[0]}\" is TLD Server for \"{rootInput}\" (delegation table)")
+                returnMessage.append(
+                    f"IP Address of \"{delegation.nameServers[0]}\" is \"{delegation.addresses[0]}\"")
+            return ServerResponse(ttl=ttl, addresses=selector.order(delegation.addresses), messages=returnMessage)
     query = dns.message.make_query(rootInput, dns.rdatatype.NS)
-    response = dns.query.udp(query, localNameServer)
+    response, localNameServer = await queryFastest(selector, query, splitAddresses(localNameServer), DNS_QUERY_TIMEOUT)
     responseCode = response.rcode()
     if responseCode != dns.rcode.NOERROR:
         if responseCode == dns.rcode.NXDOMAIN:
-            returnMessage.append(f"\"{rootInput}\" does not exist.")
-            returnMessage.append("Please enter a legible domain")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append(f"\"{rootInput}\" does not exist.")
+                returnMessage.append("Please enter a legible domain")
+            negativeTtl = getNegativeTtl(response)
+            delegationTable.learnNonExistent(rootInput, negativeTtl)
+            return ServerResponse(STATUS_NXDOMAIN, negativeTtl, messages=returnMessage)
         else:
-            returnMessage.append("Please enter a legible domain.")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append("Please enter a legible domain.")
+            return ServerResponse(STATUS_SERVFAIL, 0, messages=returnMessage)
     '''
     Initialize Variables:
 
@@ -124,61 +161,66 @@ In the code snippet you provided earlier, the logic checks both the authority an
         resourceRecordSet = response.answer[0]
     resourceRecord = resourceRecordSet[0]
     if resourceRecord.rdtype == dns.rdatatype.SOA:
-        returnMessage.append(
-            f"Same server is TLD Server for \"{rootInput}\"")
-    else:
-        tldServerName = resourceRecord.target
+        if returnMessage is not None:
+            returnMessage.append(
+                f"Same server is TLD Server for \"{rootInput}\"")
+        return ServerResponse(ttl=resourceRecordSet.ttl, addresses=[localNameServer],
+                              messages=returnMessage)
+    tldServerName = resourceRecord.target
+    if returnMessage is not None:
         returnMessage.append(
             f"\"{tldServerName}\" is TLD Server for \"{rootInput}\"")
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
-        ipAddressofTld = defaultResolver.query(
-            tldServerName).rrset[0].to_text()
+    # Every TLD server of the zone is handed out, not only the first one, so the next hop can pick the fastest
+    glueAddresses, glueTtl = await glueForNameServers(
+        response, [resourceRecord.target for resourceRecord in resourceRecordSet], delegationTable)
+    tldAddresses = selector.order(glueAddresses)
+    if returnMessage is not None:
         returnMessage.append(
-            f"IP Address of \"{tldServerName}\" is \"{ipAddressofTld}\"")
-        returnMessage.append(str(tldServerName))
-        returnMessage.append(ipAddressofTld)
-    return returnMessage
+            f"IP Addresses of the TLD Servers for \"{rootInput}\" are \"{', '.join(tldAddresses)}\"")
+    ttl = min(resourceRecordSet.ttl, glueTtl)
+    nameServers = [resourceRecord.target.to_text() for resourceRecord in resourceRecordSet]
+    delegationTable.learn(rootInput, nameServers, glueAddresses, ttl)
+    return ServerResponse(ttl=ttl, addresses=tldAddresses, messages=returnMessage)
 
 
-def rootDnsServer():
+def rootDnsServer(reusePort=False, metricsPort=ROOT_METRICS_PORT, maxInFlight=DEFAULT_MAX_IN_FLIGHT):
     '''
     Sets up a UDP socket for the root DNS server.
 Listens for incoming requests from local DNS servers.
-Calls findOutTld to perform TLD lookups.
+Calls findOutTld to perform TLD lookups, up to maxInFlight of them at the same time (see lookupServer.py).
 Sends the result back to the local DNS server.
+reusePort: Set by the workers started with --workers, so that all of them can bind the same port.
+metricsPort: The HTTP port the Prometheus metrics are served on, 0 to not serve them.
     '''
-    rootDnsServerSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # This line creates a UDP (User Datagram Protocol) socket for communication. AF_INET specifies the address family (IPv4), and SOCK_DGRAM specifies the socket type (UDP).
     try:
-        '''
-        The try block attempts to bind the socket to the root DNS server's address (LOCAL_HOST) and port (ROOT_SERVER_PORT). If successful, it prints a message indicating that the server is running.
-        '''
-        rootDnsServerSocket.bind((LOCAL_HOST, ROOT_SERVER_PORT))
-        print(f"Root Server is up and running at port:{ROOT_SERVER_PORT}")
-        while True:
-            localNameServer, _ = rootDnsServerSocket.recvfrom(BUFFER_SIZE)
-            localNameServer = localNameServer.decode()
-            clientMessage, clientAddress = rootDnsServerSocket.recvfrom(
-                BUFFER_SIZE)
-            userInput = clientMessage.decode()
-            # Receives the DNS query message and address from the client and decodes the message.
-            print(f"Talking to Client at Address:{clientAddress}")
-            print(f"Client Message:{userInput}")
-            result = findOutTld(userInput, localNameServer)
-            # Calls the findOutTld function to perform Top-Level Domain (TLD) lookups based on the user's input and the local DNS server's address.
-            displayMessages(result)
-            # Prints the messages obtained from the TLD lookup process.
-            serverMessage = str(result).encode()
-            # Encodes the result as a string, sends it back to the client using the UDP socket, and repeats the loop for the next request.
-            rootDnsServerSocket.sendto(serverMessage, clientAddress)
-    except KeyboardInterrupt:
-        print("\nStopping the server")
-        print("........")
-        print("........")
-        print("You Stopped the server")
-        exit()
-    except:
-        print("Something went wrong")
+        serveMetrics(metrics, LOCAL_HOST, metricsPort)
+        # Every request is decoded, looked up with findOutTld in its own task, encoded with the binary protocol from helpers.py and sent back
+        runLookupServer("Root Server", ROOT_SERVER_PORT, lambda: LookupServerProtocol(
+            findOutTld, log, metrics, serverStats, LOOKUP_STAGE, maxInFlight), log, reusePort)
+    except Exception:
+        log.exception("The root server stopped on an unexpected error")
         exit()
 
 
-rootDnsServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Root DNS server")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--delegations", action="append", default=[], metavar="FILE",
+                        help="file of NS and glue records in the root hints format to answer referrals from (can be repeated)")
+    parser.add_argument("--metrics-port", type=int, default=ROOT_METRICS_PORT,
+                        help="HTTP port of the Prometheus metrics (worker i uses the port + i), 0 to not serve them")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of lookups of one process running at the same time")
+    addLoggingArguments(parser)
+    arguments = parser.parse_args()
+    configureLogging(arguments.log_level, arguments.trace_rate)
+    for fileName in arguments.delegations:
+        log.info("Loaded %d delegations from %s", delegationTable.load(fileName), fileName)
+    if arguments.workers > 1:
+        runWorkers("Root Server", arguments.workers, lambda workerIndex: rootDnsServer(
+                       reusePort=True, metricsPort=arguments.metrics_port and arguments.metrics_port + workerIndex,
+                       maxInFlight=arguments.max_in_flight),
+                   lambda: dict(serverStats, delegations=delegationTable.stats(), selection=selector.stats()))
+    else:
+        rootDnsServer(metricsPort=arguments.metrics_port, maxInFlight=arguments.max_in_flight)
@@ -0,0 +1,133 @@
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+'''
+The serverLog.py file sets up the logging of the four servers: leveled loggers, sampled tracing of single queries, and a log writer thread so the servers never wait for the terminal or the disk.
+Messages are given as a format string and its arguments (log.debug("Looking up %s", name)), they are only formatted when the level is enabled, and then by the writer thread.
+'''
+
+LOG_LEVELS = ("debug", "info", "warning", "error")
+DEFAULT_LOG_LEVEL = "info"  # Start, stop and problems only, "debug" logs every step of every lookup like the servers used to
+DEFAULT_TRACE_RATE = 0.0
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+currentTrace = contextvars.ContextVar("currentTrace", default=0)  # The id of the traced query being handled, 0 when it is not traced
+traceRate = DEFAULT_TRACE_RATE
+logQueue = None
+logWriter = None
+queueHandler = None
+queueListener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Purpose: Hands the log records to the writer thread without formatting them first.
+The arguments of a record must not be changed after it was logged, they are formatted later.
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+def configureLogging(level=DEFAULT_LOG_LEVEL, sampleRate=DEFAULT_TRACE_RATE, stream=None):
+    '''
+    Purpose: Sets up the logging of a server process, to be called once before it starts serving.
+Parameters:
+level: The lowest level written, one of LOG_LEVELS.
+sampleRate: The share of the queries traced at DEBUG level even when level is higher (see startTrace).
+stream: Where the log is written, the standard output by default.
+Actions:
+Sends every record through a queue to a writer thread, which formats and writes it.
+The writer is started again in processes forked from this one (the workers of workers.py), and stopped (writing what is left) at exit or by stopLogWriter().
+    '''
+    global traceRate, logWriter, queueHandler
+    traceRate = sampleRate
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    # The event loop logs every selector it picks at DEBUG level, which is not about our queries
+    logging.getLogger("asyncio").setLevel(max(root.level, logging.INFO))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    logWriter = logging.StreamHandler(stream or sys.stdout)
+    logWriter.setFormatter(logging.Formatter(LOG_FORMAT))
+    queueHandler = DeferredQueueHandler(None)
+    root.addHandler(queueHandler)
+    startLogWriter()
+    atexit.register(stopLogWriter)
+
+
+def startLogWriter():
+    global logQueue, queueListener
+    logQueue = queue.SimpleQueue()
+    queueHandler.queue = logQueue
+    queueListener = logging.handlers.QueueListener(logQueue, logWriter)
+    queueListener.start()
+
+
+def stopLogWriter():
+    global queueListener
+    if queueListener is not None:
+        queueListener.stop()
+        queueListener = None
+
+
+def restartLogWriterInChild():
+    # The writer thread does not survive fork(), and the records queued in the parent are written by the parent
+    global queueListener
+    if queueHandler is not None and queueListener is not None:
+        queueListener = None
+        startLogWriter()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restartLogWriterInChild)
+
+
+def startTrace():
+    '''
+    Purpose: Decides whether the query now being handled is traced, with the probability given to configureLogging().
+Actions:
+Sets the trace of the current context (an asyncio task keeps its own), and returns the trace id, or 0 when the query is not traced.
+    '''
+    traceId = (random.getrandbits(32) or 1) if traceRate > 0 and random.random() < traceRate else 0
+    currentTrace.set(traceId)
+    return traceId
+
+
+def tracingEnabled():
+    # Whether some queries are traced, they have to be handled in a task of their own (see startTrace)
+    return traceRate > 0
+
+
+def debugEnabled(logger):
+    '''
+    Purpose: Tells whether debug() would write anything, to skip the work of preparing its arguments otherwise.
+    '''
+    return currentTrace.get() != 0 or logger.isEnabledFor(logging.DEBUG)
+
+
+def debug(logger, message, *args):
+    '''
+    Purpose: Logs a step of a lookup at DEBUG level, also when DEBUG is disabled but the current query is traced.
+Traced records carry the trace id, so the steps of one query can be picked out of the interleaved log.
+    '''
+    traceId = currentTrace.get()
+    if traceId:
+        record = logger.makeRecord(logger.name, logging.DEBUG, "(trace)", 0, f"[trace {traceId:08x}] {message}",
+                                   args, None)
+        logger.handle(record)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+
+
+def addLoggingArguments(parser):
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default=DEFAULT_LOG_LEVEL,
+                        help="lowest level logged, \"warning\" leaves only the problems and keeps the hot path quiet")
+    parser.add_argument("--trace-rate", type=float, default=DEFAULT_TRACE_RATE,
+                        help="share of the queries logged step by step even when the level is above \"debug\"")
@@ -0,0 +1,113 @@
+import asyncio
+import dns.message
+import dns.name
+import dns.rrset
+import pytest
+import delegationTable
+from delegationTable import DelegationTable, glueFromResponse, glueForNameServers
+
+HINTS = """.                 3600000 IN NS a.root-servers.net.
+a.root-servers.net. 3600000 IN A 198.41.0.4
+a.root-servers.net. 3600000 IN AAAA 2001:503:ba3e::2:30
+com.              172800 IN NS a.gtld-servers.net.
+com.              172800 IN NS b.gtld-servers.net.
+a.gtld-servers.net. 86400 IN A 192.5.6.30
+b.gtld-servers.net. 86400 IN A 192.33.14.30
+"""
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def table(tmp_path, clock):
+    hintsFile = tmp_path / "named.root"
+    hintsFile.write_text(HINTS)
+    table = DelegationTable(clock=clock)
+    assert table.load(str(hintsFile)) == 2
+    return table
+
+
+def referral(additional):
+    response = dns.message.make_response(dns.message.make_query("www.example.com.", "A"))
+    for name, rdtype, ttl, *addresses in additional:
+        response.additional.append(dns.rrset.from_text(name, ttl, "IN", rdtype, *addresses))
+    return response
+
+
+def testStaticDelegationsCarryTheirGlue(table):
+    delegation, ttl = table.lookup("COM")
+    assert delegation.nameServers == ["a.gtld-servers.net.", "b.gtld-servers.net."]
+    assert delegation.addresses == ["192.5.6.30", "192.33.14.30"]
+    assert ttl == 86400
+    delegation, _ = table.lookup(dns.name.root)
+    assert delegation.addresses == ["198.41.0.4", "2001:503:ba3e::2:30"]
+    assert table.lookup("org.") is None
+    assert table.stats()["misses"] == 1
+
+
+def testLearnedDelegationExpires(table, clock):
+    table.learn("example.com", ["ns1.example.com."], ["10.0.0.53"], 300)
+    clock.now += 100
+    delegation, ttl = table.lookup("example.com.")
+    assert delegation.addresses == ["10.0.0.53"] and ttl == 200
+    clock.now += 200
+    assert table.lookup("example.com.") is None
+
+
+def testNonExistentZone(table, clock):
+    table.learnNonExistent("nope.", 60)
+    clock.now += 10
+    assert table.lookup("nope") == (None, 50)
+    assert table.stats()["negativeHits"] == 1
+
+
+def testLearnedGlueDoesNotShadowStaticGlue(table, clock):
+    table.learnGlue("a.gtld-servers.net.", ["10.9.9.9"], 60)
+    assert table.lookupGlue("a.gtld-servers.net") == (["192.5.6.30"], 86400)
+    assert len(table.glue) == 0
+    table.learnGlue("ns1.example.com", ["10.0.0.53"], 60)
+    clock.now += 15
+    assert table.lookupGlue("ns1.example.com.") == (["10.0.0.53"], 45)
+    assert table.lookupGlue("ns2.example.com.") is None
+
+
+def testGlueFromResponse():
+    response = referral([("ns1.example.com.", "A", 300, "10.0.0.1", "10.0.0.2"),
+                         ("ns1.example.com.", "AAAA", 120, "2001:db8::53"),
+                         ("ns2.example.com.", "A", 300, "10.0.0.3")])
+    assert glueFromResponse(response, dns.name.from_text("ns1.example.com.")) == \
+        (["10.0.0.1", "10.0.0.2", "2001:db8::53"], 120)
+    assert glueFromResponse(response, dns.name.from_text("ns3.example.com.")) is None
+
+
+def testGlueForNameServersLearnsOnlyNewGlue(table, monkeypatch):
+    async def failingResolve(nameServer):
+        raise AssertionError("the glue was known")
+    monkeypatch.setattr(delegationTable, "resolveNameServer", failingResolve)
+    table.learnGlue("ns2.example.com.", ["10.0.0.2"], 30)
+    learned = []
+    monkeypatch.setattr(table, "learnGlue", lambda *args: learned.append(args))
+    response = referral([("ns1.example.com.", "A", 300, "10.0.0.1")])
+    nameServers = [dns.name.from_text(name) for name in ("ns1.example.com.", "ns2.example.com.", "ns3.example.com.")]
+    assert asyncio.run(glueForNameServers(response, nameServers, table)) == (["10.0.0.1", "10.0.0.2"], 30)
+    assert learned == [(nameServers[0], ["10.0.0.1"], 300)]
+
+
+def testGlueForNameServersResolvesTheFirstWhenNoneIsKnown(table, monkeypatch):
+    async def resolve(nameServer):
+        return ["10.0.0.7"], 90
+    monkeypatch.setattr(delegationTable, "resolveNameServer", resolve)
+    nameServers = [dns.name.from_text("ns1.example.net.")]
+    assert asyncio.run(glueForNameServers(referral([]), nameServers, table)) == (["10.0.0.7"], 90)
+    assert table.lookupGlue("ns1.example.net.") == (["10.0.0.7"], 90)
@@ -0,0 +1,173 @@
+import pytest
+from dnsCache import DnsCache, saveSnapshot, loadSnapshot
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def testLeastRecentlyUsedEntryIsEvicted(clock):
+    cache = DnsCache(maxEntries=2, clock=clock)
+    cache.put("a", "10.0.0.1", 60)
+    cache.put("b", "10.0.0.2", 60)
+    cache.get("a")
+    cache.put("c", "10.0.0.3", 60)
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def testByteBudgetEvictsOldestEntries(clock):
+    cache = DnsCache(maxBytes=30, clock=clock)
+    cache.put("one.example", "10.0.0.1", 60)
+    cache.put("two.example", "10.0.0.2", 60)
+    assert len(cache) == 1
+    assert "two.example" in cache
+    assert cache.stats()["bytes"] <= 30
+
+
+def testEntryExpiresWithItsTtl(clock):
+    cache = DnsCache(clock=clock)
+    cache.put("www.example.com", "10.0.0.1", 30)
+    clock.now += 29
+    assert cache.get("www.example.com").value == "10.0.0.1"
+    clock.now += 1
+    assert cache.get("www.example.com") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 1, 1)
+    assert len(cache) == 0
+
+
+def testTtlIsCappedAndZeroTtlIsNotStored(clock):
+    cache = DnsCache(maxTtl=100, clock=clock)
+    cache.put("long", "10.0.0.1", 10 ** 9)
+    assert cache.peek("long").expiresAt == clock.now + 100
+    cache.put("zero", "10.0.0.2", 0)
+    assert "zero" not in cache.entries
+
+
+def testNegativeEntry(clock):
+    cache = DnsCache(negativeTtl=45, clock=clock)
+    cache.putNegative("nope.example.com")
+    entry = cache.get("nope.example.com")
+    assert entry.negative and entry.value is None and entry.ttl == 45
+    assert cache.stats()["negativeHits"] == 1
+
+
+def testPeekCountsNothing(clock):
+    cache = DnsCache(clock=clock)
+    cache.put("a", "10.0.0.1", 60)
+    assert cache.peek("a").value == "10.0.0.1"
+    assert cache.peek("b") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (0, 0)
+
+
+def testStaleEntryIsServedWithinItsGracePeriod(clock):
+    cache = DnsCache(staleTtl=10, clock=clock)
+    cache.put("www.example.com", "10.0.0.1", 30)
+    clock.now += 35
+    assert cache.get("www.example.com") is None
+    assert cache.getStale("www.example.com").value == "10.0.0.1"
+    clock.now += 10
+    assert cache.getStale("www.example.com") is None
+    cache.get("www.example.com")
+    assert "www.example.com" not in cache.entries
+
+
+def testFreshEntryIsNotStale(clock):
+    cache = DnsCache(staleTtl=10, clock=clock)
+    cache.put("a", "10.0.0.1", 30)
+    assert cache.getStale("a") is None
+
+
+def testHotEntryIsRefreshedAheadOfItsExpiry(clock):
+    cache = DnsCache(prefetchFraction=0.5, prefetchMinHits=2, clock=clock)
+    cache.put("a", "10.0.0.1", 100)
+    entry = cache.get("a")
+    assert not cache.shouldRefresh(entry)  # One hit is not hot
+    entry = cache.get("a")
+    assert not cache.shouldRefresh(entry)  # Hot, but early in its TTL
+    clock.now += 60
+    entry = cache.get("a")
+    assert cache.shouldRefresh(entry)
+    assert not cache.shouldRefresh(entry)  # Already being refreshed
+    cache.put("a", "10.0.0.1", 100)
+    clock.now += 50  # The old entry would have expired by now
+    cache.get("a")
+    stats = cache.stats()
+    assert (stats["refreshes"], stats["missesPrevented"]) == (1, 1)
+
+
+def testRefreshFailedAllowsAnotherRefresh(clock):
+    cache = DnsCache(prefetchFraction=0.5, prefetchMinHits=1, clock=clock)
+    cache.put("a", "10.0.0.1", 100)
+    clock.now += 60
+    entry = cache.get("a")
+    assert cache.shouldRefresh(entry)
+    cache.refreshFailed("a")
+    assert cache.shouldRefresh(cache.get("a"))
+    assert cache.stats()["refreshFailures"] == 1
+
+
+def testOnRemoveSeesEveryKeyLeavingTheCache(clock):
+    removed = []
+    cache = DnsCache(maxEntries=1, onRemove=removed.append, clock=clock)
+    cache.put("a", "10.0.0.1", 60)
+    cache.put("a", "10.0.0.2", 60)
+    cache.put("b", "10.0.0.3", 60)
+    cache.remove("b")
+    assert removed == ["a", "a", "b"]
+
+
+def testSnapshotRestoresRemainingTtlAndOrder(clock):
+    cache = DnsCache(clock=clock)
+    cache.put("short", "10.0.0.1", 5)
+    cache.put("example.com.", "192.0.2.1,192.0.2.2", 300)
+    cache.putNegative("nope.example.com", 120)
+    data = cache.snapshot(wallClock=lambda: 5000.0)
+
+    restoredClock = FakeClock(10.0)
+    restored = DnsCache(clock=restoredClock)
+    loaded, dropped = restored.restore(data, wallClock=lambda: 5010.0)
+    assert (loaded, dropped) == (2, 1)
+    assert list(restored.entries) == ["example.com.", "nope.example.com"]
+    entry = restored.peek("example.com.")
+    assert entry.value == "192.0.2.1,192.0.2.2"
+    assert entry.expiresAt == pytest.approx(restoredClock.now + 290)
+    assert restored.peek("nope.example.com").negative
+
+
+def testRestoreRejectsWhatIsNotASnapshot(clock):
+    with pytest.raises(ValueError):
+        DnsCache(clock=clock).restore(b"not a snapshot at all")
+    cache = DnsCache(clock=clock)
+    cache.put("www.example.com", "10.0.0.1", 60)
+    with pytest.raises(ValueError):
+        DnsCache(clock=clock).restore(cache.snapshot()[:-3])
+
+
+def testSnapshotFileRoundTrip(tmp_path, clock):
+    cache = DnsCache(clock=clock)
+    cache.put("www.example.com", "10.0.0.1", 60)
+    fileName = str(tmp_path / "cache.snapshot")
+    saveSnapshot(fileName, cache.snapshot())
+    restored = DnsCache()
+    assert loadSnapshot(restored, fileName) == (1, 0)
+    assert restored.peek("www.example.com").value == "10.0.0.1"
+
+
+def testEmptySnapshotFileIsRejected(tmp_path):
+    fileName = tmp_path / "empty.snapshot"
+    fileName.write_bytes(b"")
+    with pytest.raises(ValueError):
+        loadSnapshot(DnsCache(), str(fileName))
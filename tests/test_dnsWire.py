@@ -0,0 +1,134 @@
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import pytest
+from dnsWire import isWireQuery, parseQuery, buildResponse, buildFormatError, WireFormatError
+from dnsWire import RCODE_NOERROR, RCODE_NXDOMAIN, RCODE_BADVERS
+from dnsWire import TYPE_A, TYPE_AAAA, TYPE_ANY, CLASS_IN, MAX_UDP_PAYLOAD
+
+
+def wireQuery(name="www.example.com", rdtype="A", **options):
+    return dns.message.make_query(name, rdtype, **options)
+
+
+def testParsesTheQuestion():
+    message = wireQuery("WWW.Example.com", "AAAA")
+    query = parseQuery(message.to_wire())
+    assert query.id == message.id
+    assert query.name == "WWW.Example.com"
+    assert (query.type, query.qclass) == (TYPE_AAAA, CLASS_IN)
+    assert query.flags & dns.flags.RD
+    assert query.ednsPayload is None
+
+
+def testParsesFromAMemoryview():
+    query = parseQuery(memoryview(bytearray(wireQuery().to_wire())))
+    assert query.name == "www.example.com"
+    assert isinstance(query.question, bytes)
+
+
+def testReadsTheOptRecord():
+    query = parseQuery(wireQuery(use_edns=0, payload=4096).to_wire())
+    assert (query.ednsPayload, query.ednsVersion) == (4096, 0)
+    # A payload below the minimum of RFC 6891 counts as the minimum
+    assert parseQuery(wireQuery(use_edns=0, payload=100).to_wire()).ednsPayload == MAX_UDP_PAYLOAD
+
+
+def testTellsWireQueriesFromTextQueries():
+    assert isWireQuery(wireQuery().to_wire())
+    assert not isWireQuery(b"www.example.com")
+    assert not isWireQuery(b"")
+
+
+@pytest.mark.parametrize("data", [
+    b"\x00\x01",
+    dns.message.make_response(wireQuery()).to_wire(),
+    wireQuery().to_wire()[:-2],
+    wireQuery().to_wire()[:5] + b"\x02" + wireQuery().to_wire()[6:],
+])
+def testRejectsWhatIsNotAQuery(data):
+    with pytest.raises(WireFormatError):
+        parseQuery(data)
+
+
+def testRejectsCompressedAndNonAsciiNames():
+    data = bytearray(wireQuery("ab.c").to_wire())
+    data[12] = 0xC0
+    with pytest.raises(WireFormatError):
+        parseQuery(bytes(data))
+    data = bytearray(wireQuery("ab.c").to_wire())
+    data[13] = 0xFF
+    with pytest.raises(WireFormatError):
+        parseQuery(bytes(data))
+
+
+def testAnswersWithTheAddressesOfTheTypeAsked():
+    query = parseQuery(wireQuery("www.example.com", "AAAA").to_wire())
+    response = dns.message.from_wire(buildResponse(query, RCODE_NOERROR, ["10.0.0.1", "2001:db8::1", "2001:db8::2"], 60))
+    assert response.id == query.id
+    assert response.flags & dns.flags.QR and response.flags & dns.flags.RA
+    (answer,) = response.answer
+    assert answer.rdtype == dns.rdatatype.AAAA and answer.ttl == 60
+    assert sorted(resourceRecord.address for resourceRecord in answer) == ["2001:db8::1", "2001:db8::2"]
+
+
+def testAnyGetsEveryAddress():
+    query = parseQuery(wireQuery("www.example.com", "ANY").to_wire())
+    assert query.type == TYPE_ANY
+    response = dns.message.from_wire(buildResponse(query, RCODE_NOERROR, ["10.0.0.1"], 60))
+    assert response.answer[0].rdtype == dns.rdatatype.A
+
+
+def testTruncatesAnswersThatDoNotFit():
+    query = parseQuery(wireQuery().to_wire())
+    addresses = [f"10.0.{i // 256}.{i % 256}" for i in range(40)]
+    response = dns.message.from_wire(buildResponse(query, RCODE_NOERROR, addresses, 60))
+    assert response.flags & dns.flags.TC
+    assert not response.answer
+    ednsQuery = parseQuery(wireQuery(use_edns=0, payload=4096).to_wire())
+    response = dns.message.from_wire(buildResponse(ednsQuery, RCODE_NOERROR, addresses, 60))
+    assert not response.flags & dns.flags.TC
+    assert len(response.answer[0]) == 40
+
+
+def testBadVersionGoesIntoTheOptRecord():
+    query = parseQuery(wireQuery(use_edns=0).to_wire())
+    response = dns.message.from_wire(buildResponse(query, RCODE_BADVERS))
+    assert response.rcode() == dns.rcode.BADVERS
+
+
+@pytest.mark.parametrize("rcode, addresses", [(RCODE_NXDOMAIN, ()), (RCODE_NOERROR, ())])
+def testNegativeAnswersCarryAnSoaRecord(rcode, addresses):
+    query = parseQuery(wireQuery("nope.example.com").to_wire())
+    response = dns.message.from_wire(buildResponse(query, rcode, addresses, 42, zone="example.com."))
+    assert response.rcode() == rcode
+    (soa,) = response.authority
+    assert soa.rdtype == dns.rdatatype.SOA
+    assert soa.name.to_text() == "example.com." and soa.ttl == 42
+    assert soa[0].minimum == 42
+
+
+def testSoaOfTheRootZone():
+    query = parseQuery(wireQuery("nope").to_wire())
+    response = dns.message.from_wire(buildResponse(query, RCODE_NXDOMAIN, ttl=5, zone="."))
+    assert response.authority[0].name.to_text() == "."
+
+
+def testNoSoaWithoutAZoneOrWithAnswers():
+    query = parseQuery(wireQuery().to_wire())
+    assert not dns.message.from_wire(buildResponse(query, RCODE_NXDOMAIN)).authority
+    response = dns.message.from_wire(buildResponse(query, RCODE_NOERROR, ["10.0.0.1"], 60, zone="example.com."))
+    assert not response.authority
+
+
+def testFormatErrorEchoesTheId():
+    message = wireQuery()
+    response = dns.message.from_wire(buildFormatError(message.to_wire()))
+    assert response.id == message.id and response.rcode() == dns.rcode.FORMERR
+    assert buildFormatError(b"\x00") is None
+    assert buildFormatError(dns.message.make_response(message).to_wire()) is None
+
+
+def testTypeConstants():
+    assert (TYPE_A, TYPE_AAAA) == (dns.rdatatype.A, dns.rdatatype.AAAA)
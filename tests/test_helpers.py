@@ -0,0 +1,102 @@
+import asyncio
+import time
+import dns.message
+import dns.rrset
+import pytest
+from helpers import ServerRequest, ServerResponse, ProtocolError, UpstreamEndpoint
+from helpers import encodeRequest, decodeRequest, encodeResponse, decodeResponse
+from helpers import attemptTimeouts, getNegativeTtl, joinAddresses, splitAddresses
+from helpers import ADDRESS_TYPE_A, ADDRESS_TYPE_AAAA, STATUS_NOERROR, STATUS_NXDOMAIN, PROTOCOL_VERSION
+from helpers import BACKOFF_JITTER, DEFAULT_NEGATIVE_TTL, MAX_DOMAIN_NAME_LENGTH, MAX_NAME_SERVER_LENGTH
+
+
+def testRequestRoundTrip():
+    request = ServerRequest(0xDEADBEEF, "127.0.0.1,127.0.0.2", "www.example.com", False, ADDRESS_TYPE_AAAA)
+    decoded = decodeRequest(memoryview(encodeRequest(request)))
+    assert (decoded.queryId, decoded.nameServer, decoded.name) == (0xDEADBEEF, "127.0.0.1,127.0.0.2", "www.example.com")
+    assert (decoded.wantMessages, decoded.addressType) == (False, ADDRESS_TYPE_AAAA)
+    decoded = decodeRequest(encodeRequest(ServerRequest(1, "127.0.0.1", "example.com")))
+    assert (decoded.wantMessages, decoded.addressType) == (True, ADDRESS_TYPE_A)
+
+
+def testResponseRoundTrip():
+    response = ServerResponse(STATUS_NOERROR, 300, ["10.0.0.1", "2001:db8::1"], ["Asked the root", "Got ünïcode"],
+                              42, "sub.example.com.")
+    decoded = decodeResponse(memoryview(encodeResponse(response)))
+    assert (decoded.status, decoded.ttl, decoded.queryId) == (STATUS_NOERROR, 300, 42)
+    assert decoded.addresses == ["10.0.0.1", "2001:db8::1"]
+    assert decoded.messages == ["Asked the root", "Got ünïcode"]
+    assert decoded.zone == "sub.example.com."
+    decoded = decodeResponse(encodeResponse(ServerResponse(STATUS_NXDOMAIN, 60, queryId=7)))
+    assert (decoded.addresses, decoded.messages, decoded.zone) == ([], None, None)
+
+
+@pytest.mark.parametrize("decode, data", [
+    (decodeRequest, encodeRequest(ServerRequest(1, "127.0.0.1", "example.com"))),
+    (decodeResponse, encodeResponse(ServerResponse(addresses=["10.0.0.1"], messages=["hello"], queryId=1))),
+])
+def testBadVersionAndTruncatedDataAreRejected(decode, data):
+    with pytest.raises(ProtocolError):
+        decode(bytes((PROTOCOL_VERSION + 1,)) + data[1:])
+    # Cut anywhere before the text of the last string, so a length field or address is missing
+    for length in range(len(data) - 5):
+        with pytest.raises(ProtocolError):
+            decode(data[:length])
+
+
+def testTrailingBytesAfterARequestAreRejected():
+    with pytest.raises(ProtocolError):
+        decodeRequest(encodeRequest(ServerRequest(1, "127.0.0.1", "example.com")) + b"x")
+
+
+def testNameLongerThanADomainNameCanBeIsRejected():
+    # Regression: the length byte overflowed with a bare ValueError the shard forwarding did not catch
+    longestName = ".".join(["a" * 63] * 3 + ["a" * 61])
+    assert len(longestName) == MAX_DOMAIN_NAME_LENGTH
+    assert decodeRequest(encodeRequest(ServerRequest(1, "127.0.0.1", longestName + "."))).name == longestName + "."
+    with pytest.raises(ProtocolError):
+        encodeRequest(ServerRequest(1, "127.0.0.1", longestName + "a"))
+    with pytest.raises(ProtocolError):
+        encodeRequest(ServerRequest(1, "1" * (MAX_NAME_SERVER_LENGTH + 1), "example.com"))
+
+
+def testJoinedAddressesFitTheNameServerField():
+    addresses = [f"2001:db8::{i:x}" for i in range(40)]
+    joined = joinAddresses(addresses)
+    assert len(joined) <= MAX_NAME_SERVER_LENGTH
+    assert splitAddresses(joined) == addresses[:len(splitAddresses(joined))]
+    assert joinAddresses(["10.0.0.1"]) == "10.0.0.1"
+
+
+def testAttemptTimeoutsDoubleAndStopAtTheDeadline():
+    timeouts = list(attemptTimeouts(1.0, 2))
+    assert len(timeouts) == 3
+    for attempt, timeout in enumerate(timeouts):
+        assert 2 ** attempt * (1 - BACKOFF_JITTER) <= timeout <= 2 ** attempt * (1 + BACKOFF_JITTER)
+    assert all(timeout <= 0.5 for timeout in attemptTimeouts(1.0, 2, time.monotonic() + 0.5))
+    assert list(attemptTimeouts(1.0, 2, time.monotonic() - 1)) == []
+
+
+def testNegativeTtlComesFromTheSoa():
+    response = dns.message.make_response(dns.message.make_query("nope.example.com.", "A"))
+    assert getNegativeTtl(response) == DEFAULT_NEGATIVE_TTL
+    response.authority.append(dns.rrset.from_text("example.com.", 300, "IN", "SOA",
+                                                  "ns1.example.com. admin.example.com. 1 3600 600 86400 45"))
+    assert getNegativeTtl(response) == 45
+
+
+def testIcmpErrorFailsOnlyTheOldestRequest():
+    async def run():
+        loop = asyncio.get_running_loop()
+        endpoint = UpstreamEndpoint()
+        oldest, newest = loop.create_future(), loop.create_future()
+        endpoint.pending[1] = oldest
+        endpoint.pending[2] = newest
+        endpoint.error_received(ConnectionRefusedError())
+        assert isinstance(oldest.exception(), ConnectionRefusedError)
+        assert not newest.done() and list(endpoint.pending) == [2]
+        endpoint.datagram_received(encodeResponse(ServerResponse(addresses=["10.0.0.1"], queryId=2)), ("127.0.0.1", 9001))
+        assert newest.result()[0].addresses == ["10.0.0.1"]
+        endpoint.datagram_received(b"garbage", ("127.0.0.1", 9001))
+        assert endpoint.unmatched == 1
+    asyncio.run(run())
@@ -0,0 +1,272 @@
+import asyncio
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import pytest
+import localDnsServer
+from dnsCache import DnsCache
+from dnsWire import parseQuery
+from helpers import ServerRequest, ServerResponse, ProtocolError, decodeResponse
+from helpers import ROOT_SERVER_PORT, TLD_SERVER_PORT, AUTHORITATIVE_SERVER_PORT
+from helpers import ADDRESS_TYPE_A, ADDRESS_TYPE_AAAA, STATUS_NOERROR, STATUS_NXDOMAIN
+from helpers import NXDOMAIN_RESPONSE, SERVFAIL_RESPONSE, NODATA_RESPONSE
+from zoneTrie import ZoneTrie
+
+ROOT_ADDRESS = "10.0.0.1"
+TLD_ADDRESS = "10.0.0.2"
+AUTHORITATIVE_ADDRESS = "10.0.0.3"
+SUB_ADDRESS = "10.0.0.4"
+CLIENT_ADDRESS = ("127.0.0.1", 40000)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeServer:
+    '''
+    Stands in for the root, TLD or authoritative server of allInOneServer.py (see localDnsServer.inProcessServers).
+    '''
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.requests = []
+
+    async def answer(self, request):
+        self.requests.append(request)
+        return self.answers(request)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address=None):
+        self.sent.append((bytes(data), address))
+
+
+def rootAnswer(request):
+    if request.name.rsplit(".", 1)[-1] == "com":
+        return ServerResponse(addresses=[TLD_ADDRESS], ttl=3600)
+    return ServerResponse(STATUS_NXDOMAIN, 60)
+
+
+def tldAnswer(request):
+    if request.name == "example.com" or request.name.endswith(".example.com"):
+        return ServerResponse(addresses=[AUTHORITATIVE_ADDRESS], ttl=600)
+    return ServerResponse(STATUS_NXDOMAIN, 60)
+
+
+AUTHORITATIVE_ANSWERS = {
+    (AUTHORITATIVE_ADDRESS, "www.example.com", ADDRESS_TYPE_A): ServerResponse(addresses=["93.184.216.34", "93.184.216.35"], ttl=300),
+    (AUTHORITATIVE_ADDRESS, "www.example.com", ADDRESS_TYPE_AAAA): ServerResponse(addresses=["2001:db8::1"], ttl=200),
+    (AUTHORITATIVE_ADDRESS, "v6.example.com", ADDRESS_TYPE_A): ServerResponse(ttl=60),
+    (AUTHORITATIVE_ADDRESS, "v6.example.com", ADDRESS_TYPE_AAAA): ServerResponse(addresses=["2001:db8::2"], ttl=300),
+    (AUTHORITATIVE_ADDRESS, "example.com", ADDRESS_TYPE_A): ServerResponse(ttl=60),
+    (AUTHORITATIVE_ADDRESS, "www.sub.example.com", ADDRESS_TYPE_A): ServerResponse(addresses=[SUB_ADDRESS], ttl=900,
+                                                                                    zone="sub.example.com."),
+    (SUB_ADDRESS, "www.sub.example.com", ADDRESS_TYPE_A): ServerResponse(addresses=["10.4.0.1"], ttl=300),
+    (AUTHORITATIVE_ADDRESS, "www.bad.example.com", ADDRESS_TYPE_A): ServerResponse(addresses=[SUB_ADDRESS], ttl=900,
+                                                                                    zone="example.org."),
+}
+
+
+def authoritativeAnswer(request):
+    return AUTHORITATIVE_ANSWERS.get((request.nameServer, request.name, request.addressType),
+                                     ServerResponse(STATUS_NXDOMAIN, 60))
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def servers(monkeypatch, clock):
+    servers = {ROOT_SERVER_PORT: FakeServer(rootAnswer), TLD_SERVER_PORT: FakeServer(tldAnswer),
+               AUTHORITATIVE_SERVER_PORT: FakeServer(authoritativeAnswer)}
+    zoneTrie = ZoneTrie()
+    monkeypatch.setattr(localDnsServer, "zoneTrie", zoneTrie)
+    monkeypatch.setattr(localDnsServer, "cache", DnsCache(onRemove=zoneTrie.remove, clock=clock))
+    monkeypatch.setattr(localDnsServer, "inProcessServers", servers)
+    monkeypatch.setattr(localDnsServer, "rootServerAddress", ROOT_ADDRESS)
+    monkeypatch.setattr(localDnsServer, "inFlightLookups", {})
+    monkeypatch.setattr(localDnsServer, "serverStats", dict.fromkeys(localDnsServer.serverStats, 0))
+    monkeypatch.setattr(localDnsServer, "shardCount", 1)
+    monkeypatch.setattr(localDnsServer, "workerIndex", 0)
+    monkeypatch.setattr(localDnsServer, "wantMessages", False)
+    return servers
+
+
+def resolve(name, addressType=ADDRESS_TYPE_A):
+    return asyncio.run(localDnsServer.resolveWithDeadline(name, addressType))
+
+
+def askedCount(servers):
+    return [len(servers[port].requests) for port in (ROOT_SERVER_PORT, TLD_SERVER_PORT, AUTHORITATIVE_SERVER_PORT)]
+
+
+def testResolvesThroughEveryServerAndCachesEachStep(servers):
+    assert resolve("WWW.Example.com.") == "93.184.216.34,93.184.216.35"
+    assert askedCount(servers) == [1, 1, 1]
+    assert servers[TLD_SERVER_PORT].requests[0].nameServer == TLD_ADDRESS
+    cache = localDnsServer.cache
+    assert cache.peek("com.").value == TLD_ADDRESS
+    assert cache.peek("example.com.").value == AUTHORITATIVE_ADDRESS
+    assert resolve("www.example.com") == "93.184.216.34,93.184.216.35"
+    assert askedCount(servers) == [1, 1, 1]
+
+
+def testResolutionStartsFromTheDeepestKnownZone(servers, clock):
+    resolve("www.example.com")
+    clock.now += 301  # The answer expired, the servers of example.com. did not
+    resolve("www.example.com")
+    assert askedCount(servers) == [1, 1, 2]
+    assert localDnsServer.serverStats["hopsSkipped"] == 2
+
+
+def testNameWithoutAnAddressIsCachedAsNodata(servers):
+    # Regression: NOERROR without addresses was turned into SERVFAIL and never cached
+    assert resolve("example.com") == NODATA_RESPONSE
+    assert resolve("example.com") == NODATA_RESPONSE
+    assert askedCount(servers) == [1, 1, 1]
+    assert localDnsServer.serverStats["servfails"] == 0
+
+
+def testNonExistentNamesAreCached(servers):
+    assert resolve("nope.example.com") == NXDOMAIN_RESPONSE
+    assert resolve("nope.example.com") == NXDOMAIN_RESPONSE
+    assert askedCount(servers) == [1, 1, 1]
+    assert resolve("www.example.nope") == NXDOMAIN_RESPONSE
+    assert localDnsServer.cache.peek("nope.").negative
+
+
+def testAaaaAnswersAreCachedUnderTheirOwnKey(servers):
+    assert resolve("www.example.com", ADDRESS_TYPE_AAAA) == "2001:db8::1"
+    assert resolve("www.example.com") == "93.184.216.34,93.184.216.35"
+    assert resolve("www.example.com", ADDRESS_TYPE_AAAA) == "2001:db8::1"
+    assert askedCount(servers) == [1, 1, 2]
+    assert localDnsServer.cache.peek("www.example.com/AAAA").value == "2001:db8::1"
+
+
+def testReferralIsFollowedAndCachedAsADeeperZone(servers):
+    assert resolve("www.sub.example.com") == "10.4.0.1"
+    assert localDnsServer.cache.peek("sub.example.com.").value == SUB_ADDRESS
+    assert localDnsServer.zoneTrie.deepestCut("x.sub.example.com", localDnsServer.cache.__contains__) == \
+        ("sub.example.com.", 3)
+
+
+def testReferralOutsideTheNameIsAServerFailure(servers):
+    assert resolve("www.bad.example.com") == SERVFAIL_RESPONSE
+    assert "example.org." not in localDnsServer.cache.entries
+    assert localDnsServer.serverStats["servfails"] == 1
+
+
+def testTopLevelAndRootNames(servers):
+    assert resolve("com") == NXDOMAIN_RESPONSE  # Only the root server is asked, the fake has no address for "com"
+    assert askedCount(servers) == [1, 0, 1]
+    assert resolve(".") == NODATA_RESPONSE
+
+
+def testShardAnswerCarriesTheRemainingCacheTtl(servers, clock):
+    # Regression: forwarded queries were answered with a TTL of 0
+    protocol = localDnsServer.ShardProtocol(asyncio.Semaphore(1))
+    protocol.transport = FakeTransport()
+    asyncio.run(protocol.handleWorker(ServerRequest(7, "", "www.example.com", False), CLIENT_ADDRESS))
+    clock.now += 100
+    asyncio.run(protocol.handleWorker(ServerRequest(8, "", "example.com", False), CLIENT_ADDRESS))
+    asyncio.run(protocol.handleWorker(ServerRequest(9, "", "www.example.com", False), CLIENT_ADDRESS))
+    responses = [decodeResponse(data) for data, _ in protocol.transport.sent]
+    assert [(response.queryId, response.ttl) for response in responses] == [(7, 300), (8, 60), (9, 200)]
+    assert responses[0].addresses == ["93.184.216.34", "93.184.216.35"]
+    assert (responses[1].status, responses[1].addresses) == (STATUS_NOERROR, [])
+
+
+@pytest.mark.parametrize("response, expected", [
+    (ServerResponse(addresses=["10.0.0.9", "10.0.0.10"], ttl=123), ("10.0.0.9,10.0.0.10", 123)),
+    (ServerResponse(STATUS_NXDOMAIN, 45), (NXDOMAIN_RESPONSE, 45)),
+    (ServerResponse(ttl=30), (NODATA_RESPONSE, 30)),
+])
+def testForwardedAnswerKeepsTheTtlOfTheOtherWorker(servers, monkeypatch, response, expected):
+    async def otherWorker(userInput, port, nameServer, wantMessages, timeout, retries, deadline=None,
+                          addressType=ADDRESS_TYPE_A):
+        return response
+    monkeypatch.setattr(localDnsServer, "actAsTemporaryClientAsync", otherWorker)
+    assert asyncio.run(localDnsServer.forwardToShard("www.example.com", 1)) == expected
+
+
+def testNameTooLongToForwardIsAServerFailure(servers, monkeypatch):
+    async def otherWorker(*args, **kwargs):
+        raise ProtocolError("Name is longer than 253 bytes")
+    monkeypatch.setattr(localDnsServer, "actAsTemporaryClientAsync", otherWorker)
+    assert asyncio.run(localDnsServer.forwardToShard("a" * 300, 1)) == (SERVFAIL_RESPONSE, 0)
+    assert localDnsServer.serverStats["forwardFailures"] == 1
+
+
+def clientProtocol():
+    protocol = localDnsServer.LocalDnsServerProtocol(4)
+    protocol.connection_made(FakeTransport())
+    return protocol
+
+
+def testTextQueryTooLongForADomainNameIsRefused(servers):
+    # Regression: the long name made encodeRequest fail and the client got no answer
+    protocol = clientProtocol()
+    asyncio.run(protocol.handleClient("a" * 254, CLIENT_ADDRESS))
+    assert protocol.transport.sent == [(SERVFAIL_RESPONSE.encode(), CLIENT_ADDRESS)]
+    assert localDnsServer.serverStats["malformed"] == 1
+    assert askedCount(servers) == [0, 0, 0]
+
+
+def testTextQueryIsAnsweredWithOneAddress(servers):
+    protocol = clientProtocol()
+    asyncio.run(protocol.handleClient("www.example.com", CLIENT_ADDRESS))
+    asyncio.run(protocol.handleClient("v6.example.com", CLIENT_ADDRESS))
+    assert [data for data, _ in protocol.transport.sent] == [b"93.184.216.34", b"2001:db8::2"]
+    protocol.datagram_received(memoryview(b"www.example.com"), CLIENT_ADDRESS)
+    assert protocol.transport.sent[-1] == (b"93.184.216.34", CLIENT_ADDRESS)
+    assert not protocol.tasks
+
+
+def wireAnswer(protocol, name, rdtype="A", **options):
+    message = dns.message.make_query(name, rdtype, **options)
+    protocol.datagram_received(message.to_wire(), CLIENT_ADDRESS)
+    return dns.message.from_wire(protocol.transport.sent[-1][0]) if protocol.transport.sent else None
+
+
+def testCachedWireQueryIsAnsweredWithoutATask(servers, clock):
+    protocol = clientProtocol()
+    asyncio.run(protocol.handleWireClient(parseQuery(dns.message.make_query("www.example.com", "A").to_wire()),
+                                          CLIENT_ADDRESS))
+    clock.now += 100
+    response = wireAnswer(protocol, "www.example.com")
+    assert not protocol.tasks
+    assert response.answer[0].ttl == 200
+    assert sorted(resourceRecord.address for resourceRecord in response.answer[0]) == ["93.184.216.34", "93.184.216.35"]
+    assert localDnsServer.serverStats["queries"] == 2
+
+
+def testNegativeWireAnswerCarriesTheSoaOfTheDeepestZone(servers):
+    protocol = clientProtocol()
+    query = parseQuery(dns.message.make_query("nope.example.com", "A").to_wire())
+    asyncio.run(protocol.handleWireClient(query, CLIENT_ADDRESS))
+    response = dns.message.from_wire(protocol.transport.sent[-1][0])
+    assert response.rcode() == dns.rcode.NXDOMAIN
+    assert response.authority[0].rdtype == dns.rdatatype.SOA
+    assert response.authority[0].name.to_text() == "example.com."
+
+
+def testUnsupportedAndMalformedWireQueries(servers):
+    protocol = clientProtocol()
+    assert wireAnswer(protocol, "www.example.com", "MX").rcode() == dns.rcode.NOTIMP
+    assert wireAnswer(protocol, "www.example.com", use_edns=1).rcode() == dns.rcode.BADVERS
+    data = bytearray(dns.message.make_query("www.example.com", "A").to_wire())
+    data[12] = 0xC0  # A compression pointer instead of the first label
+    protocol.datagram_received(bytes(data), CLIENT_ADDRESS)
+    assert dns.message.from_wire(protocol.transport.sent[-1][0]).rcode() == dns.rcode.FORMERR
+    assert localDnsServer.serverStats["malformed"] == 1
+    assert askedCount(servers) == [0, 0, 0]
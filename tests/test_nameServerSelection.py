@@ -0,0 +1,128 @@
+import asyncio
+import dns.asyncquery
+import dns.exception
+import dns.message
+import dns.rcode
+import pytest
+from nameServerSelection import NameServerSelector, ServerRtt, queryFastest
+from nameServerSelection import FAILURE_THRESHOLD, BACKOFF_BASE, RTT_HALF_LIFE, MIN_STAGGER, MAX_STAGGER
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def testFasterServersComeFirst(clock):
+    selector = NameServerSelector(clock=clock)
+    selector.recordRtt("10.0.0.1", 0.5)
+    selector.recordRtt("10.0.0.2", 0.01)
+    selector.recordRtt("10.0.0.3", 0.1)
+    assert selector.order(["10.0.0.1", "10.0.0.2", "10.0.0.3"])[:2] == ["10.0.0.2", "10.0.0.3"]
+
+
+def testRttDecaysWhileTheServerIsNotAsked(clock):
+    selector = NameServerSelector(clock=clock)
+    selector.recordRtt("10.0.0.1", 1.0)
+    rtt = selector.rtt("10.0.0.1")
+    clock.now += RTT_HALF_LIFE
+    assert selector.rtt("10.0.0.1") == pytest.approx(rtt / 2)
+
+
+def testStaggerDelayIsBounded(clock):
+    selector = NameServerSelector(clock=clock)
+    selector.recordRtt("10.0.0.1", 0.0)
+    assert selector.staggerDelay("10.0.0.1") >= MIN_STAGGER
+    for _ in range(20):
+        selector.recordRtt("10.0.0.2", 10.0)
+    assert selector.staggerDelay("10.0.0.2") == MAX_STAGGER
+
+
+def testServerIsBackedOffAfterFailuresInARow(clock):
+    selector = NameServerSelector(clock=clock)
+    for _ in range(FAILURE_THRESHOLD):
+        selector.recordFailure("10.0.0.1")
+    selector.recordRtt("10.0.0.2", 5.0)
+    assert selector.order(["10.0.0.1", "10.0.0.2"]) == ["10.0.0.2", "10.0.0.1"]
+    assert selector.stats()["backedOff"] == 1
+    clock.now += BACKOFF_BASE
+    assert selector.stats()["backedOff"] == 0
+    selector.recordFailure("10.0.0.1")
+    assert selector.servers["10.0.0.1"].backoffUntil == clock.now + 2 * BACKOFF_BASE
+
+
+def testAnswerEndsTheBackoff(clock):
+    selector = NameServerSelector(clock=clock)
+    for _ in range(FAILURE_THRESHOLD):
+        selector.recordFailure("10.0.0.1")
+    selector.recordRtt("10.0.0.1", 0.01)
+    server = selector.servers["10.0.0.1"]
+    assert (server.failures, server.backoffUntil) == (0, 0.0)
+
+
+def testSlowerServerKeepsItsFailuresAndBackoff(clock):
+    # Regression: a hedged server that never answered was recorded as a success
+    selector = NameServerSelector(clock=clock)
+    for _ in range(FAILURE_THRESHOLD):
+        selector.recordFailure("10.0.0.1")
+    server = selector.servers["10.0.0.1"]
+    backoffUntil = server.backoffUntil
+    selector.recordSlower("10.0.0.1", 0.001)
+    selector.recordSlower("10.0.0.1", 5.0)
+    assert (server.failures, server.backoffUntil) == (FAILURE_THRESHOLD, backoffUntil)
+    assert server.rtt == 5.0
+
+
+def queryFastestWith(monkeypatch, selector, behaviours):
+    async def udp(query, address, timeout=None, port=53):
+        delay, rcode = behaviours[address]
+        await asyncio.sleep(delay)
+        if rcode is None:
+            raise OSError("unreachable")
+        response = dns.message.make_response(query)
+        response.set_rcode(rcode)
+        return response
+    monkeypatch.setattr(dns.asyncquery, "udp", udp)
+    query = dns.message.make_query("www.example.com.", "A")
+    return asyncio.run(queryFastest(selector, query, list(behaviours), timeout=0.5))
+
+
+def testQueryFastestMovesPastAFailedServer(monkeypatch):
+    selector = NameServerSelector()
+    selector.servers["10.0.0.1"] = ServerRtt(0.001, selector.clock())
+    selector.servers["10.0.0.2"] = ServerRtt(0.01, selector.clock())
+    response, address = queryFastestWith(monkeypatch, selector, {"10.0.0.1": (0, None),
+                                                                 "10.0.0.2": (0, dns.rcode.NOERROR)})
+    assert address == "10.0.0.2" and response.rcode() == dns.rcode.NOERROR
+    assert selector.servers["10.0.0.1"].failures == 1
+
+
+def testQueryFastestHedgesAndLeavesTheSlowServerUnrewarded(monkeypatch):
+    selector = NameServerSelector()
+    selector.servers["10.0.0.1"] = ServerRtt(0.001, selector.clock())
+    selector.servers["10.0.0.2"] = ServerRtt(0.01, selector.clock())
+    selector.servers["10.0.0.1"].failures = 2
+    _, address = queryFastestWith(monkeypatch, selector, {"10.0.0.1": (1.0, dns.rcode.NOERROR),
+                                                          "10.0.0.2": (0, dns.rcode.NOERROR)})
+    assert address == "10.0.0.2"
+    assert selector.hedged == 1
+    assert selector.servers["10.0.0.1"].failures == 2
+
+
+def testQueryFastestReturnsTheLastFailedResponse(monkeypatch):
+    selector = NameServerSelector()
+    response, address = queryFastestWith(monkeypatch, selector, {"10.0.0.1": (0, dns.rcode.SERVFAIL)})
+    assert (address, response.rcode()) == ("10.0.0.1", dns.rcode.SERVFAIL)
+
+
+def testQueryFastestTimesOut(monkeypatch):
+    with pytest.raises(dns.exception.Timeout):
+        queryFastestWith(monkeypatch, NameServerSelector(), {"10.0.0.1": (1.0, dns.rcode.NOERROR)})
@@ -0,0 +1,100 @@
+import dns.name
+import dns.rdatatype
+import pytest
+from zoneStore import ZoneStore, ANSWER, NODATA, NXDOMAIN, REFERRAL
+
+EXAMPLE_ZONE = """$TTL 300
+@   IN SOA ns1.example.com. admin.example.com. 1 3600 600 86400 60
+@   IN NS ns1.example.com.
+ns1 IN A 127.0.0.1
+www IN A 93.184.216.34
+www IN AAAA 2001:db8::1
+alias IN CNAME www
+other IN CNAME www.example.org.
+out IN CNAME www.example.net.
+x.y IN A 1.1.1.1
+sub IN NS ns.sub.example.com.
+ns.sub IN A 127.0.0.2
+"""
+
+ORG_ZONE = """$ORIGIN example.org.
+$TTL 120
+@   IN SOA ns1.example.org. admin.example.org. 1 3600 600 86400 30
+@   IN NS ns1.example.org.
+www IN A 10.0.0.9
+"""
+
+
+@pytest.fixture
+def zoneDirectory(tmp_path):
+    (tmp_path / "example.com.zone").write_text(EXAMPLE_ZONE)
+    (tmp_path / "org.db").write_text(ORG_ZONE)
+    (tmp_path / "notes.txt").write_text("not a zone")
+    return tmp_path
+
+
+@pytest.fixture
+def store(zoneDirectory):
+    store = ZoneStore([str(zoneDirectory)])
+    assert store.load() == 2
+    return store
+
+
+def addresses(answer):
+    return [resourceRecord.address for resourceRecord in answer.rdatasets[-1]]
+
+
+def testAnswer(store):
+    answer = store.lookup("www.example.com.")
+    assert answer.kind == ANSWER and answer.ttl == 300
+    assert addresses(answer) == ["93.184.216.34"]
+    answer = store.lookup(dns.name.from_text("WWW.example.com."), dns.rdatatype.AAAA)
+    assert addresses(answer) == ["2001:db8::1"]
+
+
+def testNodataAtTheApexAndForAnEmptyNonTerminal(store):
+    answer = store.lookup("example.com.", dns.rdatatype.A)
+    assert answer.kind == NODATA and answer.ttl == 60
+    assert store.lookup("y.example.com.").kind == NODATA
+
+
+def testNxdomainNamesTheClosestName(store):
+    answer = store.lookup("nope.example.com.")
+    assert answer.kind == NXDOMAIN and answer.ttl == 60
+    assert answer.closestName == dns.name.from_text("alias.example.com.")
+
+
+def testCnameIsFollowedInsideAndAcrossTheZones(store):
+    answer = store.lookup("alias.example.com.")
+    assert answer.kind == ANSWER
+    assert [rdataset.rdtype for rdataset in answer.rdatasets] == [dns.rdatatype.CNAME, dns.rdatatype.A]
+    assert answer.names == [dns.name.from_text("alias.example.com."), dns.name.from_text("www.example.com.")]
+    answer = store.lookup("other.example.com.")
+    assert addresses(answer) == ["10.0.0.9"] and answer.ttl == 120
+
+
+def testCnameLeavingTheZonesReturnsTheChain(store):
+    answer = store.lookup("out.example.com.")
+    assert answer.kind == ANSWER
+    assert [rdataset.rdtype for rdataset in answer.rdatasets] == [dns.rdatatype.CNAME]
+
+
+def testReferralBelowADelegation(store):
+    answer = store.lookup("www.sub.example.com.")
+    assert answer.kind == REFERRAL
+    assert answer.names == [dns.name.from_text("sub.example.com.")]
+    assert store.glue("ns.sub.example.com.") == (["127.0.0.2"], 300)
+    assert store.glue("ns.nowhere.example.com.") == ([], None)
+
+
+def testNamesOutsideTheZones(store):
+    assert store.lookup("www.example.net.") is None
+    assert store.stats()["misses"] == 1
+
+
+def testFailedReloadKeepsTheOldZones(store, zoneDirectory):
+    (zoneDirectory / "broken.zone").write_text("@ IN SOA this is not a zone\n")
+    store.reload()
+    assert len(store) == 2
+    assert store.stats()["reloadFailures"] == 1
+    assert store.lookup("www.example.com.").kind == ANSWER
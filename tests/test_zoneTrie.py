@@ -0,0 +1,57 @@
+from zoneTrie import ZoneTrie
+
+
+def always(key):
+    return True
+
+
+def testDeepestKnownCutIsFound():
+    trie = ZoneTrie()
+    for zoneName in ("com.", "example.com.", "a.b.example.com."):
+        trie.insert(zoneName)
+    assert trie.deepestCut("www.example.com", always) == ("example.com.", 2)
+    assert trie.deepestCut("x.a.b.example.com", always) == ("a.b.example.com.", 4)
+    assert trie.deepestCut("b.example.com", always) == ("example.com.", 2)
+    assert trie.deepestCut("www.example.org", always) == (None, 0)
+
+
+def testCutsTheCacheNoLongerHoldsAreSkipped():
+    trie = ZoneTrie()
+    trie.insert("com.")
+    trie.insert("example.com.")
+    assert trie.deepestCut("www.example.com", lambda key: key != "example.com.") == ("com.", 1)
+
+
+def testLabelsAreCaseInsensitive():
+    trie = ZoneTrie()
+    trie.insert("Example.COM.")
+    assert trie.deepestCut("WWW.example.com", always) == ("Example.COM.", 2)
+
+
+def testRemovePrunesNodesThatLeadNowhere():
+    trie = ZoneTrie()
+    trie.insert("com.")
+    trie.insert("a.b.example.com.")
+    assert len(trie) == 2
+    trie.remove("a.b.example.com.")
+    assert len(trie) == 1
+    assert list(trie.root.children["com"].children) == []
+    trie.remove("a.b.example.com.")
+    trie.remove("never.inserted.")
+    assert len(trie) == 1
+
+
+def testInsertingTwiceCountsOnce():
+    trie = ZoneTrie()
+    trie.insert("example.com.")
+    trie.insert("example.com.")
+    assert len(trie) == 1
+
+
+def testRemovingAnAnswerKeepsTheZoneWithTheSameLabels():
+    # Regression: the answer "google.com" and the zone "google.com." share a node
+    trie = ZoneTrie()
+    trie.insert("google.com.")
+    trie.remove("google.com")
+    assert len(trie) == 1
+    assert trie.deepestCut("www.google.com", always) == ("google.com.", 2)
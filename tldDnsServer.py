@@ -1,44 +1,84 @@
-import socket
+import argparse
+import logging
 import dns
-import dns.resolver
-import dns.query
 import dns.message
 import dns.message
-import warnings
-from helpers import LOCAL_HOST, TLD_SERVER_PORT, BUFFER_SIZE
+from helpers import LOCAL_HOST, TLD_SERVER_PORT
 from helpers import splitInput
 from helpers import getInput
-from helpers import customPrint
-from helpers import displayMessages
+from helpers import getNegativeTtl
+from helpers import DNS_QUERY_TIMEOUT
+from helpers import ServerResponse
+from helpers import ADDRESS_TYPE_A
+from helpers import STATUS_NXDOMAIN, STATUS_SERVFAIL
+from helpers import TLD_METRICS_PORT
+from helpers import splitAddresses
+from helpers import transportStats, TRANSPORT_METRICS
+from workers import runWorkers, DEFAULT_WORKERS
+from serverLog import configureLogging, addLoggingArguments, debug
+from metrics import serverMetrics, serveMetrics
+from lookupServer import LookupServerProtocol, runLookupServer, DEFAULT_MAX_IN_FLIGHT
+from delegationTable import DelegationTable, glueForNameServers, DELEGATION_METRICS
+from nameServerSelection import NameServerSelector, queryFastest, SELECTION_METRICS
 
+log = logging.getLogger("tldDnsServer")
+serverStats = {"queries": 0, "failures": 0, "malformed": 0, "shed": 0}
+delegationTable = DelegationTable()  # Referrals loaded with --delegations or learned from earlier lookups
+metrics = serverMetrics(serverStats)
+metrics.exportStats(lambda: transportStats, TRANSPORT_METRICS)
+metrics.exportStats(delegationTable.stats, DELEGATION_METRICS)
+selector = NameServerSelector()  # The RTT of every name server this process asks
+metrics.exportStats(selector.stats, SELECTION_METRICS)
+LOOKUP_STAGE = (("stage", "findOutAuthoritative"),)
 
-def findOutAuthoritative(userInput, nameServer):
+
+async def findOutAuthoritative(userInput, nameServer, returnMessage=None, addressType=ADDRESS_TYPE_A):
     '''
     Takes user input and the TLD DNS server as arguments.
 Performs a DNS query to the TLD DNS server for the authoritative server information.
-Returns messages about the lookup process.
+nameServer may list several addresses (see joinAddresses in helpers.py), the fastest one is asked (see queryFastest).
+Returns a ServerResponse with the status, TTL and the IP addresses of the authoritative servers, fastest first.
+Messages about the lookup process are appended to returnMessage, unless it is None.
+addressType is not used, the authoritative servers are the same whatever type of address is resolved.
     '''
-    returnMessage = []
-    defaultResolver = dns.resolver.get_default_resolver()
-    converToDomainName = dns.name.from_text(userInput)
     numberOfWords = 2
     tldInput = getInput(userInput, numberOfWords)
-    customPrint("Customized tldInput", tldInput)
-    if len(splitInput(userInput)) > 2:
-        message = f"I dont know the address \"{userInput}\" but I know the address of \"{tldInput}\""
-        returnMessage.append(message)
-    returnMessage.append(f"Looking up \"{tldInput}\" on \"{nameServer}\"")
+    debug(log, "Customized tldInput: %s", tldInput)
+    if returnMessage is not None:
+        if len(splitInput(userInput)) > 2:
+            message = f"I dont know the address \"{userInput}\" but I know the address of \"{tldInput}\""
+            returnMessage.append(message)
+        returnMessage.append(f"Looking up \"{tldInput}\" on \"{nameServer}\"")
+    knownDelegation = delegationTable.lookup(tldInput)
+    if knownDelegation is not None:
+        delegation, ttl = knownDelegation
+        if delegation is None:
+            if returnMessage is not None:
+                returnMessage.append(f"\"{tldInput}\" does not exist (delegation table).")
+                returnMessage.append("Please enter a legible domain")
+            return ServerResponse(STATUS_NXDOMAIN, ttl, messages=returnMessage)
+        if delegation.addresses:
+            if returnMessage is not None:
+                returnMessage.append(
+                    f"\"{delegation.nameServers[0]}\" is authoritative for \"{tldInput}\" (delegation table)")
+                returnMessage.append(
+                    f"Ip Address of \"{delegation.nameServers[0]}\" is \"{delegation.addresses[0]}\"")
+            return ServerResponse(ttl=ttl, addresses=selector.order(delegation.addresses), messages=returnMessage)
     query = dns.message.make_query(tldInput, dns.rdatatype.NS)
-    response = dns.query.udp(query, nameServer)
+    response, nameServer = await queryFastest(selector, query, splitAddresses(nameServer), DNS_QUERY_TIMEOUT)
     responseCode = response.rcode()
     if responseCode != dns.rcode.NOERROR:
         if responseCode == dns.rcode.NXDOMAIN:
-            returnMessage.append(f"\"{tldInput}\" does not exist.")
-            returnMessage.append("Please enter a legible domain")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append(f"\"{tldInput}\" does not exist.")
+                returnMessage.append("Please enter a legible domain")
+            negativeTtl = getNegativeTtl(response)
+            delegationTable.learnNonExistent(tldInput, negativeTtl)
+            return ServerResponse(STATUS_NXDOMAIN, negativeTtl, messages=returnMessage)
         else:
-            returnMessage.append("Please enter a legible domain.")
-            return returnMessage
+            if returnMessage is not None:
+                returnMessage.append("Please enter a legible domain.")
+            return ServerResponse(STATUS_SERVFAIL, 0, messages=returnMessage)
     resourceRecordSet = None
     if len(response.authority) > 0:
         resourceRecordSet = response.authority[0]
@@ -46,55 +86,65 @@ Returns messages about the lookup process.
         resourceRecordSet = response.answer[0]
     resourceRecord = resourceRecordSet[0]
     if resourceRecord.rdtype == dns.rdatatype.SOA:
-        returnMessage.append(
-            f"Same server is authoritative for \"{tldInput}\"")
-    else:
-        authoritativeServerName = resourceRecord.target
+        if returnMessage is not None:
+            returnMessage.append(
+                f"Same server is authoritative for \"{tldInput}\"")
+        return ServerResponse(ttl=resourceRecordSet.ttl, addresses=[nameServer],
+                              messages=returnMessage)
+    authoritativeServerName = resourceRecord.target
+    if returnMessage is not None:
         returnMessage.append(
             f"\"{authoritativeServerName}\" is authoritative for \"{tldInput}\"")
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
-        ipAddressofAuthoritative = defaultResolver.query(
-            authoritativeServerName).rrset[0].to_text()
+    # Every authoritative server of the zone is handed out, so the next hop can pick the fastest
+    glueAddresses, glueTtl = await glueForNameServers(
+        response, [resourceRecord.target for resourceRecord in resourceRecordSet], delegationTable)
+    authoritativeAddresses = selector.order(glueAddresses)
+    if returnMessage is not None:
         returnMessage.append(
-            f"Ip Address of \"{authoritativeServerName}\" is \"{ipAddressofAuthoritative}\"")
-        returnMessage.append(str(authoritativeServerName))
-        returnMessage.append(ipAddressofAuthoritative)
-    return returnMessage
+            f"Ip Addresses of the authoritative servers for \"{tldInput}\" are \"{', '.join(authoritativeAddresses)}\"")
+    ttl = min(resourceRecordSet.ttl, glueTtl)
+    nameServers = [resourceRecord.target.to_text() for resourceRecord in resourceRecordSet]
+    delegationTable.learn(tldInput, nameServers, glueAddresses, ttl)
+    return ServerResponse(ttl=ttl, addresses=authoritativeAddresses, messages=returnMessage)
 
 
-def tldDnsServer():
+def tldDnsServer(reusePort=False, metricsPort=TLD_METRICS_PORT, maxInFlight=DEFAULT_MAX_IN_FLIGHT):
     '''
     Sets up a UDP socket for the TLD DNS server.
 Listens for incoming requests from root DNS servers.
-Calls findOutAuthoritative to perform authoritative server lookups.
+Calls findOutAuthoritative to perform authoritative server lookups, up to maxInFlight of them at the same time (see lookupServer.py).
 Sends the result back to the root DNS server.
+reusePort: Set by the workers started with --workers, so that all of them can bind the same port.
+metricsPort: The HTTP port the Prometheus metrics are served on, 0 to not serve them.
     '''
-    tldDnsServerSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        tldDnsServerSocket.bind((LOCAL_HOST, TLD_SERVER_PORT))
-        print(
-            f"TLD Server is up and running at port:{TLD_SERVER_PORT}")
-        while True:
-            nameServer, _ = tldDnsServerSocket.recvfrom(BUFFER_SIZE)
-            nameServer = nameServer.decode()
-            clientMessage, clientAddress = tldDnsServerSocket.recvfrom(
-                BUFFER_SIZE)
-            userInput = clientMessage.decode()
-            print(f"Talking to Client at Address:{clientAddress}")
-            print(f"Client Message:{userInput}")
-            result = findOutAuthoritative(userInput, nameServer)
-            displayMessages(result)
-            serverMessage = str(result).encode()
-            tldDnsServerSocket.sendto(serverMessage, clientAddress)
-    except KeyboardInterrupt:
-        print("\nStopping the server")
-        print("........")
-        print("........")
-        print("You Stopped the server")
-        exit()
-    except:
-        print("Enter Eligible Domain Name")
+        serveMetrics(metrics, LOCAL_HOST, metricsPort)
+        runLookupServer("TLD Server", TLD_SERVER_PORT, lambda: LookupServerProtocol(
+            findOutAuthoritative, log, metrics, serverStats, LOOKUP_STAGE, maxInFlight), log, reusePort)
+    except Exception:
+        log.exception("The TLD server stopped on an unexpected error")
         exit()
 
 
-tldDnsServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TLD DNS server")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--delegations", action="append", default=[], metavar="FILE",
+                        help="file of NS and glue records in the root hints format to answer referrals from (can be repeated)")
+    parser.add_argument("--metrics-port", type=int, default=TLD_METRICS_PORT,
+                        help="HTTP port of the Prometheus metrics (worker i uses the port + i), 0 to not serve them")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="maximum number of lookups of one process running at the same time")
+    addLoggingArguments(parser)
+    arguments = parser.parse_args()
+    configureLogging(arguments.log_level, arguments.trace_rate)
+    for fileName in arguments.delegations:
+        log.info("Loaded %d delegations from %s", delegationTable.load(fileName), fileName)
+    if arguments.workers > 1:
+        runWorkers("TLD Server", arguments.workers, lambda workerIndex: tldDnsServer(
+                       reusePort=True, metricsPort=arguments.metrics_port and arguments.metrics_port + workerIndex,
+                       maxInFlight=arguments.max_in_flight),
+                   lambda: dict(serverStats, delegations=delegationTable.stats(), selection=selector.stats()))
+    else:
+        tldDnsServer(metricsPort=arguments.metrics_port, maxInFlight=arguments.max_in_flight)
@@ -0,0 +1,145 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import time
+from serverLog import stopLogWriter
+
+'''
+The workers.py file starts several worker processes for one server so that it can use every core of the machine.
+All workers bind the same port with SO_REUSEPORT (see enableReusePort in helpers.py) and the kernel spreads the incoming datagrams over them.
+'''
+
+DEFAULT_WORKERS = 1
+SHUTDOWN_GRACE = 5.0  # Seconds a worker gets to finish after being asked to stop, before it is killed
+RESTART_MIN_UPTIME = 1.0  # A worker that dies sooner than this crashed while starting, it is restarted after a backoff
+RESTART_BACKOFF = 0.5  # Seconds before the first restart of a worker that crashed while starting, doubled on every crash
+MAX_STARTUP_CRASHES = 5  # A worker crashing this many times in a row while starting is left stopped
+log = logging.getLogger("workers")
+
+
+def runWorkers(serverName, workerCount, serve, collectStats):
+    '''
+    Purpose: Runs workerCount copies of a server, each in its own process, until the user stops them.
+Parameters:
+serverName: The name logged in the messages about the workers.
+workerCount: How many worker processes to start.
+serve: The function run by every worker, called with the index of the worker (0 to workerCount - 1).
+collectStats: A function run by every worker when it stops, returning a dictionary of its counters.
+Actions:
+Starts the workers with the fork start method, so they inherit the configuration of the server.
+Restarts a worker that stopped on its own. One that crashed while starting is restarted after RESTART_BACKOFF seconds, doubled on every crash in a row, and left stopped after MAX_STARTUP_CRASHES of them, while the other workers keep serving.
+Returns once no worker is left running.
+Forwards SIGHUP to every worker.
+On Ctrl+C or SIGTERM asks every worker to stop (SIGTERM), waits up to SHUTDOWN_GRACE seconds for it and logs the counters of every worker.
+    '''
+    context = multiprocessing.get_context("fork")
+    statsQueue = context.Queue()
+    processes = {}
+    startedAt = {}
+    startupCrashes = {}  # Worker index -> how many times in a row it crashed while starting
+    restartAt = {}  # Worker index -> when the worker waiting for its backoff is started again
+    leftStopped = set()  # Workers that crashed MAX_STARTUP_CRASHES times in a row
+
+    def startWorker(workerIndex):
+        process = context.Process(target=workerMain, name=f"{serverName} worker {workerIndex}",
+                                  args=(workerIndex, serve, collectStats, statsQueue))
+        process.start()
+        processes[workerIndex] = process
+        startedAt[workerIndex] = time.monotonic()
+        log.info("%s worker %d started with pid %d", serverName, workerIndex, process.pid)
+
+    def forwardSignal(signalNumber, frame):
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signalNumber)
+
+    previousHandler = signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if hasattr(signal, "SIGHUP"):
+        # SIGHUP asks the servers to reload their data (see authoritativeDnsServer.py)
+        signal.signal(signal.SIGHUP, forwardSignal)
+    try:
+        for workerIndex in range(workerCount):
+            startWorker(workerIndex)
+        while True:
+            sentinels = {process.sentinel: workerIndex for workerIndex, process in processes.items()
+                         if workerIndex not in restartAt and workerIndex not in leftStopped}
+            if not sentinels and not restartAt:
+                log.error("No %s worker is left running, stopping the server", serverName)
+                return
+            timeout = max(0, min(restartAt.values()) - time.monotonic()) if restartAt else None
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout):
+                workerIndex = sentinels[sentinel]
+                process = processes[workerIndex]
+                process.join()
+                log.warning("%s worker %d stopped with exit code %s", serverName, workerIndex, process.exitcode)
+                if time.monotonic() - startedAt[workerIndex] >= RESTART_MIN_UPTIME:
+                    startupCrashes[workerIndex] = 0
+                    startWorker(workerIndex)
+                    continue
+                startupCrashes[workerIndex] = startupCrashes.get(workerIndex, 0) + 1
+                if startupCrashes[workerIndex] >= MAX_STARTUP_CRASHES:
+                    log.error("%s worker %d crashed %d times while starting, leaving it stopped",
+                              serverName, workerIndex, startupCrashes[workerIndex])
+                    leftStopped.add(workerIndex)
+                    continue
+                backoff = RESTART_BACKOFF * 2 ** (startupCrashes[workerIndex] - 1)
+                log.warning("%s worker %d crashed while starting, restarting it in %.1f seconds",
+                            serverName, workerIndex, backoff)
+                restartAt[workerIndex] = time.monotonic() + backoff
+            for workerIndex, startAt in list(restartAt.items()):
+                if startAt <= time.monotonic():
+                    del restartAt[workerIndex]
+                    startWorker(workerIndex)
+    except KeyboardInterrupt:
+        log.info("Stopping the %s workers", serverName)
+    finally:
+        # A second Ctrl+C must not cut the shutdown short, stopWorkers() kills the slow workers itself
+        previousIntHandler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stopWorkers(processes)
+        logWorkerStats(serverName, statsQueue)
+        signal.signal(signal.SIGINT, previousIntHandler)
+        signal.signal(signal.SIGTERM, previousHandler)
+
+
+def workerMain(workerIndex, serve, collectStats, statsQueue):
+    # Ctrl+C reaches the whole process group, only the parent reacts to it and then stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if hasattr(signal, "SIGHUP"):
+        # Servers that reload on SIGHUP install their own handler
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        serve(workerIndex)
+    finally:
+        statsQueue.put((workerIndex, os.getpid(), collectStats()))
+        # The worker leaves with os._exit(), which skips the atexit handler writing the last records
+        stopLogWriter()
+
+
+def stopWorkers(processes):
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    stopAt = time.monotonic() + SHUTDOWN_GRACE
+    for process in processes.values():
+        process.join(max(0, stopAt - time.monotonic()))
+        if process.is_alive():
+            log.warning("%s did not stop in time, killing it", process.name)
+            process.kill()
+            process.join()
+
+
+def logWorkerStats(serverName, statsQueue):
+    '''
+    Purpose: Logs the counters the workers sent when they stopped, one line per worker process.
+    '''
+    while True:
+        try:
+            workerIndex, pid, stats = statsQueue.get(timeout=0.5)
+        except queue.Empty:
+            break
+        log.info("%s worker %d (pid %d): %s", serverName, workerIndex, pid, stats)
@@ -0,0 +1,274 @@
+import bisect
+import logging
+import os
+import threading
+import dns.name
+import dns.rdatatype
+import dns.zone
+from metrics import COUNTER, GAUGE
+
+'''
+The zoneStore.py file keeps the zone files served by the authoritative DNS server in memory, indexed so that a lookup is a couple of dictionary accesses.
+'''
+
+ZONE_FILE_SUFFIXES = (".zone", ".db")
+log = logging.getLogger("zoneStore")
+MAX_CNAME_CHAIN = 8
+# How the counters of ZoneStore.stats() are published by Metrics.exportStats() (see metrics.py)
+ZONE_METRICS = {
+    "zones": ("dns_zones", GAUGE, "Zones loaded"),
+    "records": ("dns_zone_rdatasets", GAUGE, "Record sets in the loaded zones"),
+    "answers": ("dns_zone_answers_total", COUNTER, "Lookups answered from the zones"),
+    "negativeAnswers": ("dns_zone_negative_answers_total", COUNTER, "NXDOMAIN and NODATA answers from the zones"),
+    "referrals": ("dns_zone_referrals_total", COUNTER, "Lookups below a delegation of the zones"),
+    "misses": ("dns_zone_misses_total", COUNTER, "Lookups for names outside the zones"),
+    "reloads": ("dns_zone_reloads_total", COUNTER, "Successful loads of the zone files"),
+    "reloadFailures": ("dns_zone_reload_failures_total", COUNTER, "Failed reloads of the zone files"),
+}
+SUPPORTED_TYPES = (dns.rdatatype.A, dns.rdatatype.AAAA, dns.rdatatype.NS,
+                   dns.rdatatype.CNAME, dns.rdatatype.SOA)
+
+ANSWER = "answer"
+NODATA = "nodata"
+NXDOMAIN = "nxdomain"
+REFERRAL = "referral"
+
+
+class ZoneAnswer:
+    '''
+    Purpose: The result of looking up a name and type in a ZoneStore.
+Attributes:
+kind: ANSWER, NODATA, NXDOMAIN or REFERRAL.
+rdatasets: The rdatasets of the answer, in order (the CNAME records followed, then the records of the asked type).
+ttl: How long the answer may be cached: the smallest TTL of the answer, or the negative TTL of the zone.
+names: The owner name of every rdataset, in the same order.
+closestName: For NXDOMAIN and NODATA, the name of the zone sorted right before the asked one (like an NSEC record would prove).
+    '''
+    __slots__ = ("kind", "rdatasets", "ttl", "names", "closestName")
+
+    def __init__(self, kind, rdatasets=None, ttl=0, names=None, closestName=None):
+        self.kind = kind
+        self.rdatasets = rdatasets if rdatasets is not None else []
+        self.ttl = ttl
+        self.names = names if names is not None else []
+        self.closestName = closestName
+
+
+class ZoneIndex:
+    '''
+    Purpose: The in-memory index of one zone.
+Attributes:
+origin: The name at the apex of the zone.
+records: The rdataset of every (owner name, type) pair.
+names: Every owner name of the zone, in DNSSEC canonical order, to tell NXDOMAIN from NODATA with a binary search.
+delegations: The names below the apex that have NS records, the zone is not authoritative for them and their subdomains.
+negativeTtl: How long a negative answer may be cached (the smaller of the SOA TTL and its minimum field).
+    '''
+    __slots__ = ("origin", "records", "names", "delegations", "negativeTtl")
+
+    def __init__(self, zone):
+        self.origin = zone.origin
+        self.records = {}
+        names = set()
+        for name, rdataset in zone.iterate_rdatasets():
+            names.add(name)
+            if rdataset.rdtype in SUPPORTED_TYPES:
+                self.records[(name, rdataset.rdtype)] = rdataset
+        self.names = sorted(names)
+        self.delegations = {name for (name, rdtype) in self.records
+                            if rdtype == dns.rdatatype.NS and name != self.origin}
+        soa = self.records[(self.origin, dns.rdatatype.SOA)]
+        self.negativeTtl = min(soa.ttl, soa[0].minimum)
+
+    def findDelegation(self, name):
+        while name != self.origin:
+            if name in self.delegations:
+                return name
+            name = name.parent()
+        return None
+
+    def nameExists(self, name):
+        '''
+        Returns True when name owns records, or is an empty non-terminal (a name without records that has names below it).
+Also returns the name sorted right before it.
+        '''
+        position = bisect.bisect_left(self.names, name)
+        if position < len(self.names) and self.names[position] == name:
+            return True, name
+        closestName = self.names[position - 1] if position > 0 else self.origin
+        # In canonical order the names below a name come right after it
+        if position < len(self.names) and self.names[position].is_subdomain(name):
+            return True, closestName
+        return False, closestName
+
+
+class ZoneStore:
+    '''
+    Purpose: Answers A, AAAA, NS, CNAME and SOA lookups from zone files, without asking any other server.
+Actions:
+load() and reload() read the zone files into new ZoneIndex objects and swap them in with one assignment, so a lookup always sees either the old or the new zones.
+reloadInBackground() does it on a separate thread so the server keeps answering while the files are parsed.
+Keeps hit and reload counters that can be read through stats().
+    '''
+
+    def __init__(self, paths=()):
+        self.paths = list(paths)
+        self.zones = {}
+        self.reloadLock = threading.Lock()
+        self.answers = 0
+        self.negativeAnswers = 0
+        self.referrals = 0
+        self.misses = 0
+        self.reloads = 0
+        self.reloadFailures = 0
+
+    def __len__(self):
+        return len(self.zones)
+
+    def load(self):
+        '''
+        Purpose: Reads every zone file of the paths given to the store (a path can be a file or a directory of .zone and .db files).
+Actions:
+Replaces all the zones at once, raising the error of the first file that cannot be loaded and keeping the old zones in that case.
+        '''
+        with self.reloadLock:
+            zones = {}
+            for fileName in zoneFiles(self.paths):
+                zoneIndex = loadZoneFile(fileName)
+                zones[zoneIndex.origin] = zoneIndex
+            self.zones = zones
+            self.reloads += 1
+        return len(zones)
+
+    def reload(self):
+        try:
+            zoneCount = self.load()
+        except Exception as error:
+            self.reloadFailures += 1
+            log.error("Could not reload the zone files, keeping the old ones: %r", error)
+            return
+        log.info("Loaded %d zones", zoneCount)
+
+    def reloadInBackground(self):
+        thread = threading.Thread(target=self.reload, name="zone reload", daemon=True)
+        thread.start()
+        return thread
+
+    def findZone(self, name):
+        zones = self.zones
+        while True:
+            zoneIndex = zones.get(name)
+            if zoneIndex is not None:
+                return zoneIndex
+            if name == dns.name.root:
+                return None
+            name = name.parent()
+
+    def lookup(self, name, rdtype=dns.rdatatype.A):
+        '''
+        Purpose: Looks up a name and type in the zones of the store.
+Parameters:
+name: The dns.name.Name (absolute) or text of the name being resolved.
+rdtype: The type of the records wanted.
+Actions:
+Follows CNAME records, also across the zones of the store, for at most MAX_CNAME_CHAIN steps.
+Returns a ZoneAnswer, or None when no zone of the store is authoritative for the name.
+When the CNAME chain leaves the store, the answer only holds the CNAME records and the caller has to resolve the last target itself.
+        '''
+        if isinstance(name, str):
+            name = dns.name.from_text(name)
+        rdatasets = []
+        names = []
+        for _ in range(MAX_CNAME_CHAIN):
+            zoneIndex = self.findZone(name)
+            if zoneIndex is None:
+                break
+            delegation = zoneIndex.findDelegation(name)
+            if delegation is not None:
+                self.referrals += 1
+                nsRdataset = zoneIndex.records[(delegation, dns.rdatatype.NS)]
+                return ZoneAnswer(REFERRAL, [nsRdataset], nsRdataset.ttl, [delegation])
+            rdataset = zoneIndex.records.get((name, rdtype))
+            if rdataset is not None:
+                rdatasets.append(rdataset)
+                names.append(name)
+                self.answers += 1
+                return ZoneAnswer(ANSWER, rdatasets, min(r.ttl for r in rdatasets), names)
+            cname = zoneIndex.records.get((name, dns.rdatatype.CNAME))
+            if cname is not None and rdtype != dns.rdatatype.CNAME:
+                rdatasets.append(cname)
+                names.append(name)
+                name = cname[0].target
+                continue
+            exists, closestName = zoneIndex.nameExists(name)
+            self.negativeAnswers += 1
+            kind = NODATA if exists else NXDOMAIN
+            ttl = min([zoneIndex.negativeTtl] + [r.ttl for r in rdatasets])
+            return ZoneAnswer(kind, rdatasets, ttl, names, closestName)
+        if rdatasets:
+            self.answers += 1
+            return ZoneAnswer(ANSWER, rdatasets, min(r.ttl for r in rdatasets), names)
+        self.misses += 1
+        return None
+
+    def glue(self, nameServer):
+        '''
+        Purpose: Returns the A and AAAA addresses the zones hold for a name server as an (addresses, ttl) pair, also below a delegation (the glue of the delegation).
+Actions:
+Returns no addresses, and a ttl of None, when the zones hold none.
+        '''
+        if isinstance(nameServer, str):
+            nameServer = dns.name.from_text(nameServer)
+        addresses = []
+        ttl = None
+        zoneIndex = self.findZone(nameServer)
+        if zoneIndex is not None:
+            for rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
+                rdataset = zoneIndex.records.get((nameServer, rdtype))
+                if rdataset is not None:
+                    addresses.extend(resourceRecord.address for resourceRecord in rdataset)
+                    ttl = rdataset.ttl if ttl is None else min(ttl, rdataset.ttl)
+        return addresses, ttl
+
+    def stats(self):
+        '''
+        Purpose: Returns the zone store counters as a dictionary, for printing or exporting.
+        '''
+        zones = self.zones
+        return {
+            "zones": len(zones),
+            "records": sum(len(zoneIndex.records) for zoneIndex in zones.values()),
+            "answers": self.answers,
+            "negativeAnswers": self.negativeAnswers,
+            "referrals": self.referrals,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "reloadFailures": self.reloadFailures,
+        }
+
+
+def zoneFiles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for fileName in sorted(os.listdir(path)):
+                if fileName.endswith(ZONE_FILE_SUFFIXES):
+                    yield os.path.join(path, fileName)
+        else:
+            yield path
+
+
+def loadZoneFile(fileName):
+    '''
+    Purpose: Reads one zone file in the standard master file format into a ZoneIndex.
+Actions:
+Uses the $ORIGIN of the file, or else the file name without its .zone or .db suffix (example.com.zone is the zone example.com).
+    '''
+    try:
+        zone = dns.zone.from_file(fileName, relativize=False)
+    except dns.zone.UnknownOrigin:
+        origin = os.path.basename(fileName)
+        for suffix in ZONE_FILE_SUFFIXES:
+            if origin.endswith(suffix):
+                origin = origin[:-len(suffix)]
+        zone = dns.zone.from_file(fileName, origin=origin, relativize=False)
+    return ZoneIndex(zone)
@@ -0,0 +1,85 @@
+'''
+The zoneTrie.py file contains the trie the local DNS server uses to find, for a domain name, the deepest zone whose name server it already knows.
+Zone names are stored label by label from the right ("www.example.com." is stored as com -> example -> www), so all the zones above a name lie on one path.
+'''
+
+
+class ZoneTrieNode:
+    __slots__ = ("children", "key")
+
+    def __init__(self):
+        self.children = {}
+        self.key = None  # The cache key of the zone ending at this node, None when no zone ends here
+
+
+class ZoneTrie:
+    '''
+    Purpose: Indexes the zone cuts held in the cache by their reversed labels.
+Actions:
+insert() and remove() keep the trie in step with the cache, deepestCut() walks the labels of a name once and returns the deepest zone still known.
+    '''
+
+    def __init__(self):
+        self.root = ZoneTrieNode()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def reversedLabels(name):
+        labels = name.lower().rstrip(".").split(".")
+        labels.reverse()
+        return labels
+
+    def insert(self, zoneName):
+        node = self.root
+        for label in self.reversedLabels(zoneName):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = ZoneTrieNode()
+            node = child
+        if node.key is None:
+            self.size += 1
+        node.key = zoneName
+
+    def remove(self, zoneName):
+        '''
+        Purpose: Forgets a zone, and drops the nodes that no longer lead to any zone.
+Does nothing unless the node holds exactly zoneName: the final answer "google.com" and the zone "google.com." share a node, and removing one from the cache must not forget the other.
+        '''
+        path = [self.root]
+        labels = self.reversedLabels(zoneName)
+        for label in labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].key != zoneName:
+            return
+        path[-1].key = None
+        self.size -= 1
+        for depth in range(len(labels), 0, -1):
+            node = path[depth]
+            if node.key is not None or node.children:
+                break
+            del path[depth - 1].children[labels[depth - 1]]
+
+    def deepestCut(self, name, isKnown):
+        '''
+        Purpose: Finds the deepest zone above (or at) name that is still known.
+Parameters:
+name: The domain name being resolved.
+isKnown: Tells whether the cache still holds a valid entry for a zone key.
+Actions:
+Returns (key, depth), the cache key of that zone and its number of labels, or (None, 0) when no zone of the name is known.
+        '''
+        node = self.root
+        deepest = (None, 0)
+        for depth, label in enumerate(self.reversedLabels(name), 1):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.key is not None and isKnown(node.key):
+                deepest = (node.key, depth)
+        return deepest